@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""Benchmark beban bot.py terhadap Bot API tiruan (fake_bot_api.py).
+
+Menjalankan Application asli dari build_application() dengan database sementara,
+lalu mensimulasikan ribuan pengguna yang bersamaan melalui alur pembelian:
+
+    /start -> inline (@bot produk ...) -> list_kategori -> list_produk -> beli -> konfirmasi_beli
+
+Sementara itu satu admin mengimpor file stok (--import-items) lewat alur percakapan impor,
+sehingga batch tulis impor bersaing dengan pembelian seperti di produksi.
+
+Update diberikan ke Application.process_update(), jalur yang sama yang dipakai
+polling dan webhook setelah update diterima; transport getUpdates tidak ikut diukur.
+Semua panggilan Bot API dari handler (editMessageText, sendMessage, answerCallbackQuery)
+benar-benar dikirim lewat HTTP ke server tiruan.
+
+Hasil ditulis sebagai JSON yang stabil (kunci terurut) agar bisa di-diff antar rilis:
+
+    python benchmark.py --users 2000 --output hasil-baru.json
+    python benchmark.py --users 2000 --compare hasil-lama.json --max-regression 10
+
+Dengan --compare, skrip keluar dengan kode 1 jika p95/p99 atau updates/detik memburuk
+melebihi --max-regression persen, atau jika ditemukan kesalahan konsistensi stok.
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+import fake_bot_api
+from telegram import Update
+
+ROUTES = ("/start", "inline", "list_kategori", "list_produk", "beli", "konfirmasi_beli", "impor_stok")
+IMPORT_PRODUCT_CODE = "B00P000"  # Produk yang stoknya ditambah admin lewat impor file selama benchmark
+
+# Diset selama Application.process_update() sebuah update benchmark (ikut ke task yang dibuat handler),
+# agar waktu database pengirim, flush persistensi, dan job berkala tidak dihitung sebagai waktu handler.
+_in_handler = contextvars.ContextVar("in_handler", default=False)
+
+# Metrik yang dibandingkan dengan --compare: (path, True jika nilai lebih besar lebih baik).
+COMPARED_METRICS = [
+    ("updates_per_second", True),
+    ("latency_ms.p50", False),
+    ("latency_ms.p95", False),
+    ("latency_ms.p99", False),
+    ("db_time_share", False),
+]
+
+
+def percentile(sorted_values, pct):
+    """Persentil nearest-rank dari daftar yang sudah terurut."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+def summarize(samples):
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3) if values else 0.0,
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(values[-1], 3) if values else 0.0,
+    }
+
+
+class Recorder:
+    """Mengumpulkan latensi per rute, waktu database, dan hasil pembelian yang dilihat pengguna."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.db_seconds = 0.0
+        self.handler_seconds = 0.0
+        self.errors = Counter()
+        self.outcomes = Counter()
+        self._lock = threading.Lock()
+
+    def on_api_call(self, method, params, result):
+        # Dipanggil dari thread server tiruan.
+        if method == "answerInlineQuery":
+            # Setiap pencarian benchmark diambil dari nama produk yang ada, jadi selalu harus ada hasil.
+            with self._lock:
+                self.outcomes["inline_answered" if params.get("results") else "inline_empty"] += 1
+            return
+        if method != "editMessageText":
+            return
+        text = params.get("text") or ""
+        if "TRANSAKSI BERHASIL" in text:
+            outcome = "success"
+        elif "stok produk ini habis" in text:
+            outcome = "sold_out"
+        elif "Saldo Anda tidak mencukupi" in text:
+            outcome = "insufficient_balance"
+        elif text.startswith("✅ Impor stok"):
+            outcome = "import_done"
+        else:
+            return
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def instrument_database(self, db):
+        """Membungkus db.run/db.transaction untuk menghitung waktu database yang ditunggu handler."""
+        for name in ("run", "transaction"):
+            original = getattr(db, name)
+
+            async def timed(fn, *args, _original=original):
+                if not _in_handler.get():
+                    return await _original(fn, *args)
+                started = time.perf_counter()
+                try:
+                    return await _original(fn, *args)
+                finally:
+                    self.db_seconds += time.perf_counter() - started
+
+            setattr(db, name, timed)
+
+
+_update_ids = itertools.count(1)
+
+class VirtualUser:
+    def __init__(self, user_id, purchases, inline_queries):
+        self.user_id = user_id
+        self.purchases = purchases
+        self.inline_queries = inline_queries
+
+
+async def _feed(app, recorder, route, data):
+    data["update_id"] = next(_update_ids)
+    update = Update.de_json(data, app.bot)
+    token = _in_handler.set(True)
+    started = time.perf_counter()
+    try:
+        await app.process_update(update)
+    finally:
+        elapsed = time.perf_counter() - started
+        _in_handler.reset(token)
+    recorder.latencies[route].append(elapsed * 1000)
+    recorder.handler_seconds += elapsed
+
+async def run_user(app, api, bot_module, recorder, user, categories, rng):
+    async def feed(route, data):
+        await _feed(app, recorder, route, data)
+
+    await feed("/start", fake_bot_api.make_command_update(user.user_id, "/start"))
+    for _ in range(user.inline_queries):
+        # Awalan kode produk dengan panjang acak: sebagian pencarian sama persis (cache), sebagian baru (FTS).
+        code = rng.choice(list(bot_module.catalog.products_by_code))
+        query = f"produk {code[:rng.randint(3, len(code))].lower()}"
+        await feed("inline", fake_bot_api.make_inline_query_update(user.user_id, query))
+    for _ in range(user.purchases):
+        # Setiap pembelian memakai pesan menu baru, seperti pengguna yang membuka /start lagi.
+        message_id = api.next_message_id()
+        category = rng.choice(categories)
+        product = rng.choice(bot_module.catalog.products_by_category.get(category) or [{}])
+        product_args = (product.get("id", 0), product.get("fingerprint", 0))
+        steps = [
+            ("list_kategori", bot_module.callback_data("list_kategori")),
+            ("list_produk", bot_module.callback_data("list_produk", bot_module.category_key(category))),
+            ("beli", bot_module.callback_data("beli", *product_args)),
+            ("konfirmasi_beli", bot_module.callback_data("konfirmasi_beli", *product_args)),
+        ]
+        for route, data in steps:
+            await feed(route, fake_bot_api.make_callback_update(user.user_id, data, message_id))
+
+
+async def run_import(app, api, bot_module, recorder, items):
+    """Admin mengimpor file stok (alur percakapan lengkap, termasuk unduhan getFile) selama pembeli aktif.
+
+    Ketiga langkah dicatat di rute impor_stok; latensinya didominasi langkah file.
+    """
+    admin_id = bot_module.ADMIN_IDS[0]
+    file_id = "bench-import"
+    content = "".join(f"{IMPORT_PRODUCT_CODE}-IMPORT-{i}\n" for i in range(items)).encode()
+    api.files[file_id] = content
+    steps = [
+        fake_bot_api.make_callback_update(admin_id, bot_module.callback_data("admin_import_stock"), api.next_message_id()),
+        fake_bot_api.make_command_update(admin_id, IMPORT_PRODUCT_CODE),
+        fake_bot_api.make_document_update(admin_id, file_id, "stok.txt", len(content)),
+    ]
+    for data in steps:
+        await _feed(app, recorder, "impor_stok", data)
+
+
+def _seed(conn, bot_module, args, first_user_id):
+    """Mengisi produk, stok, dan pengguna dengan saldo untuk benchmark."""
+    conn.execute("BEGIN IMMEDIATE")
+    for c in range(args.categories):
+        for p in range(args.products_per_category):
+            code = f"B{c:02d}P{p:03d}"
+            bot_module._insert_product(conn, {
+                "category": f"Kategori {c}", "code": code, "name": f"Produk {code}", "price": args.price,
+                "desc": "Produk benchmark", "stock": "|".join(f"{code}-ITEM-{i}" for i in range(args.stock)),
+            })
+    conn.executemany(
+        "INSERT INTO users (id, username, first_name, balance) VALUES (?, ?, ?, ?)",
+        [(first_user_id + i, f"user{first_user_id + i}", f"User{first_user_id + i}", args.balance)
+         for i in range(args.users)]
+    )
+    conn.execute("COMMIT")
+
+def check_consistency(conn, args, recorder, catalog):
+    """Memeriksa bahwa stok, transaksi, saldo, dan cache katalog saling cocok."""
+    problems = []
+    for row in conn.execute("""
+        SELECT p.product_code, p.name, p.stock_numeric,
+               (SELECT COUNT(*) FROM stock_items s WHERE s.product_id = p.id AND s.status = 'AVAILABLE') AS available,
+               (SELECT COUNT(*) FROM stock_items s WHERE s.product_id = p.id AND s.status = 'SOLD') AS sold,
+               (SELECT COUNT(*) FROM transactions t WHERE t.product_name = p.name) AS transactions
+        FROM products p
+    """):
+        expected = args.stock + (args.import_items if row["product_code"] == IMPORT_PRODUCT_CODE else 0)
+        if row["available"] + row["sold"] != expected:
+            problems.append(f"{row['product_code']}: {row['available'] + row['sold']} item tercatat, seharusnya {expected}")
+        if row["stock_numeric"] != row["available"]:
+            problems.append(f"{row['product_code']}: stock_numeric={row['stock_numeric']} tetapi item tersedia={row['available']}")
+        if row["sold"] != row["transactions"]:
+            problems.append(f"{row['product_code']}: {row['sold']} item terjual tetapi {row['transactions']} transaksi")
+        cached = catalog.products_by_code.get(row["product_code"])
+        if cached and cached["stock_numeric"] != row["stock_numeric"]:
+            problems.append(f"{row['product_code']}: cache katalog {cached['stock_numeric']} != DB {row['stock_numeric']}")
+    for row in conn.execute("SELECT details, COUNT(*) AS n FROM transactions WHERE transaction_id LIKE 'TRX-%' "
+                            "GROUP BY details HAVING n > 1"):
+        problems.append(f"item {row['details']} diberikan {row['n']} kali")
+    spent, bought = conn.execute(
+        "SELECT (SELECT COALESCE(SUM(? - balance), 0) FROM users), (SELECT COALESCE(SUM(price), 0) FROM transactions)",
+        (args.balance,)
+    ).fetchone()
+    if spent != bought:
+        problems.append(f"total saldo terpotong Rp{spent:,.0f} tetapi total transaksi Rp{bought:,.0f}")
+    negative = conn.execute("SELECT COUNT(*) FROM users WHERE balance < 0").fetchone()[0]
+    if negative:
+        problems.append(f"{negative} pengguna bersaldo negatif")
+    transactions = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    if transactions != recorder.outcomes["success"]:
+        problems.append(f"{recorder.outcomes['success']} pembelian sukses terlihat pengguna tetapi {transactions} transaksi")
+    if recorder.outcomes["inline_empty"]:
+        problems.append(f"{recorder.outcomes['inline_empty']} pencarian inline tanpa hasil")
+    if args.import_items and not recorder.outcomes["import_done"]:
+        problems.append("impor stok admin tidak selesai")
+    rolled_up = conn.execute(
+        "SELECT COALESCE(SUM(sales), 0) FROM sales_rollups WHERE scope = 'total' AND period = 'month'"
+    ).fetchone()[0]
+    if rolled_up != transactions:
+        problems.append(f"rollup penjualan mencatat {rolled_up} penjualan tetapi {transactions} transaksi")
+    return problems
+
+
+async def run_benchmark(args, bot_module, api):
+    recorder = Recorder()
+    api.listeners.append(recorder.on_api_call)
+    rng = random.Random(args.seed)
+    first_user_id = 1_000_000
+
+    await bot_module.setup_database()
+    await bot_module.db.run(_seed, bot_module, args, first_user_id)
+
+    app = bot_module.build_application()
+
+    async def count_error(update, context):
+        recorder.errors[type(context.error).__name__] += 1
+
+    app.add_error_handler(count_error)
+    await app.initialize()
+    await app.post_init(app)
+    recorder.instrument_database(bot_module.db)
+    categories = list(bot_module.catalog.categories)
+
+    users = [VirtualUser(first_user_id + i, args.purchases, args.inline_queries) for i in range(args.users)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user):
+        async with semaphore:
+            await run_user(app, api, bot_module, recorder, user, categories, rng)
+
+    started = time.perf_counter()
+    imports = [run_import(app, api, bot_module, recorder, args.import_items)] if args.import_items else []
+    await asyncio.gather(*imports, *(limited(user) for user in users))
+    duration = time.perf_counter() - started
+    await app.post_stop(app)  # Menunggu pesan yang masih antre terkirim
+    await app.shutdown()
+    await app.post_shutdown(app)  # Menghentikan pengirim lalu menutup database
+
+    conn = sqlite3.connect(bot_module.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    try:
+        problems = check_consistency(conn, args, recorder, bot_module.catalog)
+        # Diperiksa pada database yang sudah terisi, karena pilihan planner bergantung pada statistiknya.
+        plan_problems, _ = bot_module.check_query_plans(conn)
+    finally:
+        conn.close()
+
+    search = bot_module.product_search
+    searches = search.hits + search.misses
+    all_latencies = [ms for samples in recorder.latencies.values() for ms in samples]
+    updates = len(all_latencies)
+    return {
+        "updates": updates,
+        "duration_seconds": round(duration, 3),
+        "updates_per_second": round(updates / duration, 1) if duration else 0.0,
+        "latency_ms": summarize(all_latencies),
+        "latency_ms_by_route": {route: summarize(recorder.latencies[route]) for route in ROUTES},
+        "db_time_share": round(recorder.db_seconds / recorder.handler_seconds, 4) if recorder.handler_seconds else 0.0,
+        "purchases": {k: recorder.outcomes[k] for k in ("success", "sold_out", "insufficient_balance")},
+        "inline_cache_hit_rate": round(search.hits / searches, 4) if searches else 0.0,
+        "handler_errors": dict(recorder.errors),
+        "stock_consistency_errors": len(problems),
+        "stock_consistency_details": problems[:20],
+        "query_plan_problems": plan_problems,
+    }
+
+
+def _get(metrics, path):
+    for key in path.split("."):
+        metrics = metrics[key]
+    return metrics
+
+def compare(old, new, max_regression):
+    """Mencetak selisih metrik dan mengembalikan daftar regresi yang melewati ambang."""
+    regressions = []
+    print(f"{'metrik':<24}{'lama':>12}{'baru':>12}{'selisih':>10}")
+    for path, higher_is_better in COMPARED_METRICS:
+        try:
+            before, after = _get(old["metrics"], path), _get(new["metrics"], path)
+        except KeyError:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{path:<24}{before:>12}{after:>12}{change:>+9.1f}%")
+        worse = -change if higher_is_better else change
+        if worse > max_regression:
+            regressions.append(f"{path} memburuk {worse:.1f}% (batas {max_regression}%)")
+    if new["metrics"]["stock_consistency_errors"]:
+        regressions.append(f"{new['metrics']['stock_consistency_errors']} kesalahan konsistensi stok")
+    for problem in new["metrics"].get("query_plan_problems", []):
+        regressions.append(f"query plan {problem}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000, help="jumlah pengguna simulasi")
+    parser.add_argument("--concurrency", type=int, default=200, help="pengguna yang aktif bersamaan")
+    parser.add_argument("--purchases", type=int, default=1, help="pembelian per pengguna")
+    parser.add_argument("--inline-queries", type=int, default=1, help="pencarian inline (@bot ...) per pengguna")
+    parser.add_argument("--categories", type=int, default=5)
+    parser.add_argument("--products-per-category", type=int, default=4)
+    parser.add_argument("--stock", type=int, default=80, help="item stok per produk (kurang dari permintaan = ada yang habis)")
+    parser.add_argument("--import-items", type=int, default=10000,
+                        help=f"item yang diimpor admin ke {IMPORT_PRODUCT_CODE} lewat file selama benchmark (0 = tanpa impor)")
+    parser.add_argument("--price", type=int, default=10000)
+    parser.add_argument("--balance", type=int, default=50000, help="saldo awal tiap pengguna")
+    parser.add_argument("--send-rate", type=float, default=1000,
+                        help="batas kirim global pengirim (Telegram asli: 30/detik; nilai kecil membuat antrean mendominasi)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="jeda buatan per panggilan Bot API (detik)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="benchmark-results.json", help="berkas hasil JSON")
+    parser.add_argument("--compare", help="berkas hasil sebelumnya untuk dibandingkan")
+    parser.add_argument("--max-regression", type=float, default=10.0, help="ambang regresi dalam persen")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    api = fake_bot_api.FakeBotAPI(latency=args.api_latency)
+    server = fake_bot_api.serve(api, port=0)
+    host, port = server.server_address[:2]
+    workdir = tempfile.TemporaryDirectory(prefix="bot-bench-")
+
+    # bot.py membaca konfigurasi ini saat di-import.
+    os.environ["BOT_API_BASE_URL"] = f"http://{host}:{port}/bot"
+    os.environ["BOT_API_FILE_URL"] = f"http://{host}:{port}/file/bot"
+    os.environ["BOT_DB_PATH"] = os.path.join(workdir.name, "bench.db")
+    os.environ["BOT_GLOBAL_SEND_RATE"] = str(args.send_rate)
+    os.environ["BOT_METRICS_PORT"] = "0"
+    import bot
+    import telegram
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    try:
+        metrics = asyncio.run(run_benchmark(args, bot, api))
+    finally:
+        server.shutdown()
+        workdir.cleanup()
+
+    results = {
+        "meta": {
+            "bot_version": bot.BOT_VERSION,
+            "python": platform.python_version(),
+            "python_telegram_bot": telegram.__version__,
+            "sqlite": sqlite3.sqlite_version,
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "max_regression")},
+        },
+        "metrics": metrics,
+        "bot_api_calls": dict(sorted(api.calls.items())),
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+    m = metrics
+    print(f"{m['updates']} update dalam {m['duration_seconds']} detik ({m['updates_per_second']} update/detik)")
+    print(f"Latensi handler (ms): p50={m['latency_ms']['p50']} p95={m['latency_ms']['p95']} p99={m['latency_ms']['p99']}")
+    for route, summary in m["latency_ms_by_route"].items():
+        print(f"  {route:<16} p50={summary['p50']:>8} p95={summary['p95']:>8} p99={summary['p99']:>8}")
+    print(f"Porsi waktu database dalam handler: {m['db_time_share']:.1%}")
+    print(f"Pembelian: {m['purchases']}")
+    print(f"Cache pencarian inline: {m['inline_cache_hit_rate']:.1%} hit")
+    print(f"Kesalahan konsistensi stok: {m['stock_consistency_errors']}")
+    for problem in m["stock_consistency_details"]:
+        print(f"  - {problem}")
+    for problem in m["query_plan_problems"]:
+        print(f"GAGAL  query plan {problem}")
+    if m["handler_errors"]:
+        print(f"Error handler: {m['handler_errors']}")
+    print(f"Hasil ditulis ke {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        regressions = compare(old, results, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESI  {regression}")
+        return 1 if regressions else 0
+    return 1 if m["stock_consistency_errors"] or m["query_plan_problems"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
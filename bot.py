@@ -1,11 +1,45 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import base64
+import binascii
+import bisect
+import csv
+import gzip
+import hashlib
+import heapq
+import hmac
+import itertools
 import logging
 import json
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import shutil
+import signal
 import sqlite3
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import httpx
+from telegram import (
+    Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler, ConversationHandler
+    Application, ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler, ConversationHandler,
+    BasePersistence, ExtBot, InlineQueryHandler, PersistenceInput, TypeHandler
 )
 
 # --- Konfigurasi dan Inisialisasi ---
@@ -18,6 +52,83 @@ DEFAULT_BALANCE = 0
 ENABLE_DIGITAL_PRODUCTS = True
 BOT_VERSION = "v.1.2" # Menambahkan variabel versi
 
+# Pengaturan database. Nilai bisa ditimpa lewat environment variable saat deploy.
+DB_PATH = os.environ.get("BOT_DB_PATH", "bot.db")
+DB_POOL_SIZE = int(os.environ.get("BOT_DB_POOL_SIZE", "4"))  # Jumlah thread pekerja database
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("BOT_DB_BUSY_TIMEOUT_MS", "5000"))
+ADMIN_USERS_PAGE_SIZE = 20  # Jumlah pengguna per halaman di panel admin
+
+# Alamat Bot API. Bisa diarahkan ke fake_bot_api.py untuk pengujian lokal.
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+BOT_API_FILE_URL = os.environ.get("BOT_API_FILE_URL", "https://api.telegram.org/file/bot")
+
+# Batas pengiriman pesan keluar (batas resmi Telegram: 30 pesan/detik global, 1 pesan/detik per chat).
+GLOBAL_SEND_RATE = float(os.environ.get("BOT_GLOBAL_SEND_RATE", "30"))
+PER_CHAT_SEND_RATE = float(os.environ.get("BOT_PER_CHAT_SEND_RATE", "1"))
+SENDER_WORKERS = 8
+SENDER_DRAIN_TIMEOUT = 10  # Detik menunggu pesan yang masih antre saat bot berhenti
+BROADCAST_BATCH_SIZE = 500  # Jumlah penerima yang dibaca dari DB per batch
+IMPORT_BATCH_SIZE = 5000  # Jumlah item stok per transaksi saat impor file
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # Batas unduh file Bot API (20 MB)
+EXPORT_CHUNK_SIZE = 5000  # Baris per query saat ekspor (setiap query adalah transaksi baca tersendiri)
+EXPORT_PART_SIZE = 45 * 1024 * 1024  # Ukuran maksimum satu file .gz (batas unggah Bot API 50 MB)
+
+# Mode penerimaan update: "polling" (bawaan) atau "webhook".
+# Mode webhook menjalankan penerima HTTP bawaan yang membagi update ke beberapa proses worker.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("BOT_WEBHOOK_URL", "")  # URL publik, misal: https://bot.domain.com/telegram
+WEBHOOK_PATH = urlparse(WEBHOOK_URL).path or "/telegram"
+WEBHOOK_LISTEN = os.environ.get("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("BOT_WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("BOT_WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.environ.get("BOT_WEBHOOK_WORKERS", "4"))
+CATALOG_REFRESH_SECONDS = 15  # Interval sinkronisasi cache katalog antar worker
+VIEW_CACHE_SIZE = 50000  # Jumlah pesan yang diingat tampilannya untuk melewati edit yang sama
+VIEW_CACHE_TTL = 3600  # Detik; setelah itu edit selalu dikirim ulang (pesan bisa diubah proses lain)
+USER_CACHE_SIZE = 100000  # Jumlah profil pengguna yang disimpan di memori
+USER_CACHE_TTL = 60  # Detik sebelum profil dibaca ulang (saldo bisa diubah worker lain di mode webhook)
+USER_PROFILE_FLUSH_INTERVAL = 2  # Detik antara penulisan perubahan username/nama ke database
+INLINE_RESULTS_LIMIT = 50  # Hasil maksimum per pencarian inline (dibagi per halaman INLINE_PAGE_SIZE)
+INLINE_PAGE_SIZE = 20
+INLINE_RANK_CANDIDATES = 2000  # Kecocokan FTS maksimum yang diurutkan per pencarian
+INLINE_CACHE_SIZE = 5000  # Jumlah string pencarian yang hasilnya disimpan di memori
+PERSISTENCE_UPDATE_INTERVAL = 10  # Detik antara penulisan user_data/state percakapan ke database
+REPORT_UTC_OFFSET_HOURS = 7  # Zona waktu laporan penjualan (WIB); menentukan batas jam/hari/bulan rollup
+REPORT_TOP_LIMIT = 10  # Jumlah produk di laporan produk terlaris
+ACCOUNT_HISTORY_PAGE_SIZE = 10  # Transaksi per halaman riwayat di menu Akun Saya
+
+# Arsip riwayat: transaksi dan item stok terjual yang lebih tua dari ARCHIVE_AFTER_DAYS dipindahkan
+# ke database arsip bulanan di ARCHIVE_DIR oleh job berkala (0 = nonaktif).
+ARCHIVE_AFTER_DAYS = int(os.environ.get("BOT_ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_DIR = os.environ.get("BOT_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "archive"))
+ARCHIVE_INTERVAL_SECONDS = 6 * 3600
+ARCHIVE_BATCH_SIZE = 2000  # Baris per transaksi tulis, agar pembelian tidak menunggu lama
+RETENTION_INTERVAL_SECONDS = 3600  # Bucket rollup jam tertutup setiap jam; daftar pembelinya dibuang berkala
+ARCHIVE_VACUUM_PAGES = 1000  # Halaman yang dikembalikan ke sistem file per langkah incremental vacuum
+PURCHASE_LEDGER_DAYS = 7  # Umur baris ledger idempotensi pembelian sebelum dihapus
+
+# Top up otomatis lewat payment gateway (API gaya Tripay). Invoice dibuat lewat API gateway dan
+# pembayaran dikonfirmasi lewat callback HTTP yang ditandatangani HMAC-SHA256 dengan private key.
+# PAYMENT_API_URL kosong = top up otomatis nonaktif (pengguna diarahkan ke admin seperti sebelumnya).
+PAYMENT_API_URL = os.environ.get("BOT_PAYMENT_API_URL", "")  # misal: https://tripay.co.id/api
+PAYMENT_API_KEY = os.environ.get("BOT_PAYMENT_API_KEY", "")
+PAYMENT_PRIVATE_KEY = os.environ.get("BOT_PAYMENT_PRIVATE_KEY", "")
+PAYMENT_MERCHANT_CODE = os.environ.get("BOT_PAYMENT_MERCHANT_CODE", "")
+PAYMENT_METHOD = os.environ.get("BOT_PAYMENT_METHOD", "QRIS")
+PAYMENT_CALLBACK_LISTEN = os.environ.get("BOT_PAYMENT_CALLBACK_LISTEN", "0.0.0.0")
+PAYMENT_CALLBACK_PORT = int(os.environ.get("BOT_PAYMENT_CALLBACK_PORT", "8444"))
+PAYMENT_CALLBACK_PATH = "/tripay-callback"
+DEPOSIT_AMOUNTS = (10000, 25000, 50000, 100000, 250000)
+DEPOSIT_EXPIRY_SECONDS = 24 * 3600
+DEPOSIT_MAX_PENDING = 3  # Invoice belum dibayar per pengguna sebelum diminta menyelesaikan yang lama
+TOPUP_BATCH_SIZE = 500  # Konfirmasi pembayaran maksimum per transaksi database
+TOPUP_BATCH_WINDOW = 0.02  # Detik menunggu konfirmasi lain sebelum batch di-commit
+
+# Endpoint metrik Prometheus (GET /metrics). Port 0 = nonaktif. Di mode webhook,
+# worker ke-i memakai port METRICS_PORT + i karena setiap worker punya metriknya sendiri.
+METRICS_LISTEN = os.environ.get("BOT_METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("BOT_METRICS_PORT", "9200"))
+
 # Membuat dictionary 'config' tiruan agar bagian kode lain yang mungkin menggunakannya tidak error
 config = {
     "BOT_TOKEN": BOT_TOKEN,
@@ -28,17 +139,367 @@ config = {
 }
 
 
-# --- Pengaturan Database ---
+# --- Metrik ---
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Histogram latensi bergaya Prometheus dengan batas bucket tetap (detik)."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Bucket terakhir = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Perkiraan kuantil dengan interpolasi linear di dalam bucket, seperti histogram_quantile()."""
+        rank = q * self.count
+        cumulative, lower = 0, 0.0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            if n and cumulative + n >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / n
+            cumulative += n
+            lower = bound
+        return lower
+
+
+class Metrics:
+    """Registri metrik dalam proses, diekspor dalam format teks Prometheus.
+
+    Setiap pencatatan hanya mengambil satu lock singkat dan menambah beberapa angka,
+    sehingga aman dibiarkan aktif di bawah beban penuh.
+    """
+
+    # nama -> (jenis, nama label, keterangan)
+    DEFINITIONS = {
+        "bot_handler_seconds": ("histogram", "route", "Latensi handler per rute callback/perintah."),
+        "bot_handler_errors_total": ("counter", "route", "Exception yang lolos dari handler."),
+        "bot_sql_seconds": ("histogram", "statement", "Waktu eksekusi statement SQL."),
+        "bot_sql_rows_total": ("counter", "statement", "Baris yang dikembalikan statement SQL."),
+        "bot_api_seconds": ("histogram", "method", "Latensi panggilan Bot API."),
+        "bot_api_errors_total": ("counter", "method", "Panggilan Bot API yang gagal (HTTP >= 400 atau error jaringan)."),
+        "bot_archived_rows_total": ("counter", "table", "Baris yang dipindahkan ke arsip atau dihapus oleh retensi."),
+    }
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._callbacks = {}
+
+    def observe(self, name, label, seconds):
+        key = (name, label)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, label, amount=1):
+        key = (name, label)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_callback(self, name, kind, help_text, fn):
+        """Mendaftarkan metrik tanpa label yang nilainya dibaca saat diekspor (misal: panjang antrean)."""
+        self._callbacks[name] = (kind, help_text, fn)
+
+    def histograms(self, name):
+        with self._lock:
+            return {label: h for (n, label), h in self._histograms.items() if n == name}
+
+    def counters(self, name):
+        with self._lock:
+            return {label: v for (n, label), v in self._counters.items() if n == name}
+
+    def render(self):
+        """Menghasilkan teks format eksposisi Prometheus 0.0.4."""
+        lines = []
+        for name, (kind, label_name, help_text) in self.DEFINITIONS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "histogram":
+                for label, h in sorted(self.histograms(name).items()):
+                    tag = f'{label_name}="{_escape_label(label)}"'
+                    cumulative = 0
+                    for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), h.counts):
+                        cumulative += n
+                        lines.append(f'{name}_bucket{{{tag},le="{bound}"}} {cumulative}')
+                    lines.append(f"{name}_sum{{{tag}}} {h.sum}")
+                    lines.append(f"{name}_count{{{tag}}} {h.count}")
+            else:
+                for label, value in sorted(self.counters(name).items()):
+                    lines.append(f'{name}{{{label_name}="{_escape_label(label)}"}} {value}')
+        for name, (kind, help_text, fn) in self._callbacks.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {fn()}"]
+        lines += ["# HELP process_start_time_seconds Waktu mulai proses (unix).",
+                  "# TYPE process_start_time_seconds gauge", f"process_start_time_seconds {self.started}"]
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+
+_sql_labels = {}
+
+def _sql_label(sql):
+    """Label metrik untuk satu statement: SQL yang dirapikan spasinya dan dipotong."""
+    label = _sql_labels.get(sql)
+    if label is None:
+        label = " ".join(sql.split())[:80]
+        if len(_sql_labels) < 1000:  # SQL dibangun dari template tetap, jadi jumlahnya terbatas
+            _sql_labels[sql] = label
+    return label
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor yang menghitung baris yang dikembalikan ke label statement-nya."""
+
+    label = None
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            metrics.inc("bot_sql_rows_total", self.label)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        metrics.inc("bot_sql_rows_total", self.label, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        metrics.inc("bot_sql_rows_total", self.label, len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        metrics.inc("bot_sql_rows_total", self.label)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Koneksi SQLite yang mencatat waktu setiap execute()/executemany() ke metrik."""
+
+    def _timed(self, method, sql, parameters):
+        cursor = self.cursor(_TimedCursor)
+        cursor.label = _sql_label(sql)
+        started = time.perf_counter()
+        try:
+            getattr(cursor, method)(sql, parameters)
+        finally:
+            metrics.observe("bot_sql_seconds", cursor.label, time.perf_counter() - started)
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self._timed("execute", sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._timed("executemany", sql, parameters)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest yang mencatat latensi dan error setiap panggilan Bot API per method."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            metrics.inc("bot_api_errors_total", api_method)
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", api_method, time.perf_counter() - started)
+        if code >= 400:
+            metrics.inc("bot_api_errors_total", api_method)
+        return code, payload
+
+
+def _handler_route(update, callback):
+    """Label rute untuk metrik: nama rute callback_data, nama perintah, atau nama fungsi handler."""
+    if isinstance(update, Update):
+        if update.callback_query and update.callback_query.data:
+            decoded = decode_callback(update.callback_query.data)
+            return decoded[0] if decoded else "invalid"
+        message = update.effective_message
+        if message and message.text and message.text.startswith("/"):
+            return message.text.split()[0].split("@")[0]
+    return callback.__name__
+
+def _timed_callback(callback):
+    async def timed(update, context):
+        route = _handler_route(update, callback)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", route)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", route, time.perf_counter() - started)
+    timed.__name__ = callback.__name__
+    return timed
+
+def instrument_handlers(handlers):
+    """Membungkus callback setiap handler (termasuk isi ConversationHandler) dengan pencatat latensi."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        else:
+            handler.callback = _timed_callback(handler.callback)
+
+def _make_metrics_handler():
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if urlparse(self.path).path != "/metrics":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return MetricsHandler
+
+def start_metrics_server(port, listen=METRICS_LISTEN):
+    """Menjalankan endpoint /metrics di thread latar belakang. Mengembalikan servernya, atau None."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((listen, port), _make_metrics_handler())
+    except OSError as e:
+        logger.error(f"Endpoint metrik tidak bisa dibuka di {listen}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Endpoint metrik berjalan di http://{listen}:{port}/metrics")
+    return server
+
 
-conn = sqlite3.connect("bot.db", check_same_thread=False, isolation_level=None)
-conn.row_factory = sqlite3.Row
-cursor = conn.cursor()
+# --- Pengaturan Database ---
 
-def setup_database():
-    """Membuat tabel database dan melakukan migrasi otomatis jika perlu."""
-    # 1. Definisikan skema yang benar dalam pernyataan CREATE TABLE.
-    # Ini berfungsi untuk database baru.
-    cursor.execute("""
+class Database:
+    """Lapisan akses SQLite asinkron.
+
+    Query dijalankan di thread pool terbatas agar tidak memblokir event loop.
+    Setiap thread pekerja memiliki koneksinya sendiri (mode WAL + busy timeout),
+    sehingga handler yang berjalan bersamaan tidak pernah berbagi cursor.
+    """
+
+    def __init__(self, path, max_workers=DB_POOL_SIZE, busy_timeout_ms=DB_BUSY_TIMEOUT_MS):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # check_same_thread=False hanya agar close() bisa dipanggil dari thread utama;
+        # selama bot berjalan setiap koneksi hanya dipakai oleh thread pemiliknya.
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                               check_same_thread=False, factory=InstrumentedConnection)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, fn, args):
+        return fn(self._connection(), *args)
+
+    def _call_in_transaction(self, fn, args):
+        conn = self._connection()
+        # BEGIN IMMEDIATE mengambil write lock di awal sehingga pembacaan di dalam
+        # transaksi (ledger, saldo saat ditolak) konsisten dengan penulisan sesudahnya.
+        # Potong saldo dan klaim stok sendiri berupa UPDATE bersyarat, tidak bergantung pada ini.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    async def run(self, fn, *args):
+        """Menjalankan fn(conn, *args) di thread pekerja database."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args)
+
+    async def transaction(self, fn, *args):
+        """Seperti run(), tetapi fn dijalankan di dalam satu transaksi atomik."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call_in_transaction, fn, args)
+
+    async def execute(self, sql, params=()):
+        """Menjalankan satu statement tulis dan mengembalikan jumlah baris yang berubah."""
+        return await self.run(_execute, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(_fetchall, sql, params)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).rowcount
+
+def _fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+def _fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+
+db = Database(DB_PATH)
+
+# Migrasi skema berversi. Nomor versi yang sudah diterapkan disimpan di PRAGMA user_version,
+# sehingga saat start hanya migrasi yang belum pernah dijalankan yang dieksekusi.
+# Setiap migrasi harus aman dijalankan pada database lama yang dibuat sebelum sistem ini ada.
+
+def _migration_1_base_schema(conn):
+    """Tabel inti, plus penambahan kolom untuk database dengan skema lama."""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY,
             username TEXT,
@@ -48,14 +509,14 @@ def setup_database():
             transaction_count INTEGER DEFAULT 0
         )
     """)
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT NOT NULL, product_code TEXT UNIQUE NOT NULL,
             name TEXT NOT NULL, price REAL NOT NULL, description TEXT,
             stock_data TEXT, stock_numeric INTEGER DEFAULT 0
         )
     """)
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS transactions (
             id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_id TEXT UNIQUE NOT NULL, user_id INTEGER NOT NULL,
             product_name TEXT NOT NULL, price REAL NOT NULL, details TEXT, status TEXT DEFAULT 'SUCCESS',
@@ -63,29 +524,394 @@ def setup_database():
         )
     """)
 
-    # 2. Untuk database yang sudah ada, lakukan migrasi untuk menambahkan kolom yang hilang.
-    # Ini menangani kasus di mana DB dibuat dengan skema yang lebih lama.
-    try:
-        logger.info("Memeriksa skema database untuk migrasi...")
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [row['name'].lower() for row in cursor.fetchall()]
-        
-        if 'first_name' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN first_name TEXT")
-            logger.info("Migrasi DB: Menambahkan kolom 'first_name' ke tabel 'users'.")
-        if 'last_name' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN last_name TEXT")
-            logger.info("Migrasi DB: Menambahkan kolom 'last_name' ke tabel 'users'.")
-        if 'balance' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN balance REAL DEFAULT 0")
-            logger.info("Migrasi DB: Menambahkan kolom 'balance' ke tabel 'users'.")
-        if 'transaction_count' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN transaction_count INTEGER DEFAULT 0")
-            logger.info("Migrasi DB: Menambahkan kolom 'transaction_count' ke tabel 'users'.")
+    columns = [row['name'].lower() for row in conn.execute("PRAGMA table_info(users)").fetchall()]
+    for column, definition in (("first_name", "TEXT"), ("last_name", "TEXT"),
+                               ("balance", "REAL DEFAULT 0"), ("transaction_count", "INTEGER DEFAULT 0")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+            logger.info(f"Migrasi DB: Menambahkan kolom '{column}' ke tabel 'users'.")
+
+def _migration_2_stock_items(conn):
+    """Satu baris per item stok; stok lama (kolom stock_data dipisah '|') dipindahkan ke sini."""
+    # Index parsial hanya memuat item yang belum terjual, jadi klaim item pertama
+    # tetap O(log n) berapa pun riwayat penjualannya.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stock_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER NOT NULL, data TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'AVAILABLE', sold_to INTEGER, sold_at DATETIME,
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_stock_items_available ON stock_items (product_id, id) WHERE status = 'AVAILABLE'"
+    )
+    # Index untuk deteksi item duplikat saat menambah/impor stok.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_items_product_data ON stock_items (product_id, data)")
+
+    rows = conn.execute(
+        "SELECT id, stock_data FROM products WHERE stock_data IS NOT NULL AND stock_data != ''"
+    ).fetchall()
+    for row in rows:
+        # Satu baris per item lama, tanpa pemeriksaan duplikat: item yang tercatat dua kali di
+        # stock_data juga terjual dua kali oleh kode lama, jadi jumlah stok tidak boleh berubah.
+        items = [item.strip() for item in row['stock_data'].split('|')]
+        conn.executemany("INSERT INTO stock_items (product_id, data) VALUES (?, ?)",
+                         ((row['id'], item) for item in items if item))
+        duplicates = sum(count - 1 for count in Counter(item for item in items if item).values())
+        if duplicates:
+            logger.warning(f"Migrasi DB: Produk {row['id']} memiliki {duplicates} item stok duplikat; "
+                           f"semuanya dipindahkan sebagai item terpisah.")
+        conn.execute("UPDATE products SET stock_data = NULL WHERE id = ?", (row['id'],))
+    # stock_numeric sekarang menjadi penghitung stok tersedia yang dijaga oleh setiap penjualan.
+    conn.execute("""
+        UPDATE products SET stock_numeric = (
+            SELECT COUNT(*) FROM stock_items WHERE stock_items.product_id = products.id AND status = 'AVAILABLE'
+        )
+    """)
+    if rows:
+        logger.info(f"Migrasi DB: Memindahkan stok {len(rows)} produk ke tabel 'stock_items'.")
+
+def _migration_3_hot_query_indexes(conn):
+    """Index untuk query yang paling sering dijalankan, lalu statistik untuk query planner."""
+    # Riwayat transaksi per pengguna: WHERE user_id = ? ORDER BY timestamp DESC.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_timestamp ON transactions (user_id, timestamp)")
+    # Daftar produk per kategori: WHERE category = ? ORDER BY name.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_category_name ON products (category, name)")
+    # Pencarian awalan (prefix) username/nama di panel admin.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (lower(username))")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_first_name_lower ON users (lower(first_name))")
+    conn.execute("ANALYZE")
+
+def _migration_4_purchase_ledger(conn):
+    """Ledger idempotensi pembelian: satu baris per pesan konfirmasi yang berhasil dibeli."""
+    # callback_query_id menangkap update yang dikirim ulang; message_ref ("chat_id:message_id" pesan
+    # konfirmasi) menangkap ketukan ganda, yang menghasilkan callback query berbeda dari pesan yang sama.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS purchase_requests (
+            callback_query_id TEXT PRIMARY KEY, message_ref TEXT UNIQUE NOT NULL, user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL, transaction_id TEXT NOT NULL, item TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
 
-    except sqlite3.Error as e:
-        logger.error(f"Gagal melakukan migrasi database: {e}")
+def _migration_5_persistence(conn):
+    """Tabel untuk SQLitePersistence: user_data/chat_data per kunci dan state ConversationHandler."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS persistence_data (
+            kind TEXT NOT NULL, owner_id INTEGER NOT NULL, key BLOB NOT NULL, value BLOB NOT NULL,
+            PRIMARY KEY (kind, owner_id, key)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    """)
 
+def _migration_6_sales_rollups(conn):
+    """Rollup penjualan per jam/hari/bulan untuk total, kategori, dan produk, diisi dari riwayat transaksi."""
+    # Transaksi lama hanya menyimpan nama produk; product_id diisi dari nama produk yang sekarang ada.
+    columns = [row['name'].lower() for row in conn.execute("PRAGMA table_info(transactions)").fetchall()]
+    if "product_id" not in columns:
+        conn.execute("ALTER TABLE transactions ADD COLUMN product_id INTEGER")
+    conn.execute("CREATE TEMP TABLE _product_names (name TEXT PRIMARY KEY, id INTEGER NOT NULL)")
+    conn.execute("INSERT INTO _product_names SELECT name, MIN(id) FROM products GROUP BY name")
+    conn.execute("""
+        UPDATE transactions SET product_id = (SELECT id FROM _product_names WHERE name = transactions.product_name)
+        WHERE status = 'SUCCESS'
+    """)
+    conn.execute("DROP TABLE _product_names")
+
+    # Urutan primary key (scope, period, bucket, key) membuat satu deret waktu dan semua produk
+    # dalam satu bucket sama-sama berdampingan di B-tree.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sales_rollups (
+            scope TEXT NOT NULL, period TEXT NOT NULL, bucket TEXT NOT NULL, key TEXT NOT NULL,
+            sales INTEGER NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0, buyers INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, period, bucket, key)
+        ) WITHOUT ROWID
+    """)
+    # Pembeli yang sudah dihitung per baris rollup, agar kolom buyers bisa dinaikkan secara inkremental.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sales_rollup_buyers (
+            scope TEXT NOT NULL, period TEXT NOT NULL, bucket TEXT NOT NULL, key TEXT NOT NULL, user_id INTEGER NOT NULL,
+            PRIMARY KEY (scope, period, bucket, key, user_id)
+        ) WITHOUT ROWID
+    """)
+
+    offset = f"{REPORT_UTC_OFFSET_HOURS:+d} hours"
+    for scope, key_sql in ROLLUP_SCOPES_SQL.items():
+        for period, fmt in ROLLUP_PERIODS.items():
+            source = f"""
+                SELECT strftime('{fmt}', t.timestamp, '{offset}') AS bucket, {key_sql} AS key, t.user_id, t.price
+                FROM transactions t LEFT JOIN products p ON p.id = t.product_id
+                WHERE t.status = 'SUCCESS' AND {key_sql} IS NOT NULL
+            """
+            conn.execute(f"""
+                INSERT INTO sales_rollups (scope, period, bucket, key, sales, revenue, buyers)
+                SELECT ?, ?, bucket, key, COUNT(*), SUM(price), COUNT(DISTINCT user_id) FROM ({source})
+                GROUP BY bucket, key
+            """, (scope, period))
+            conn.execute(f"""
+                INSERT OR IGNORE INTO sales_rollup_buyers (scope, period, bucket, key, user_id)
+                SELECT ?, ?, bucket, key, user_id FROM ({source})
+            """, (scope, period))
+    sales = conn.execute("SELECT COUNT(*) FROM transactions WHERE status = 'SUCCESS'").fetchone()[0]
+    if sales:
+        logger.info(f"Migrasi DB: Rollup penjualan diisi dari {sales} transaksi.")
+
+def _migration_7_archive_indexes(conn):
+    """Index untuk job arsip: mencari baris tertua tanpa memindai seluruh tabel."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_timestamp ON transactions (timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_items_sold_at ON stock_items (sold_at) WHERE status = 'SOLD'")
+
+def _migration_8_deposits(conn):
+    """Invoice top up saldo; merchant_ref juga dipakai sebagai transaction_id saat saldo dikreditkan."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS deposits (
+            merchant_ref TEXT PRIMARY KEY, user_id INTEGER NOT NULL, amount REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'UNPAID', reference TEXT, checkout_url TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP, expires_at DATETIME, paid_at DATETIME
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deposits_user_status ON deposits (user_id, status, created_at)")
+
+def _migration_9_user_version(conn):
+    """Nomor versi baris users, naik setiap saldo berubah, agar cache pengguna tidak menimpa data baru dengan data lama."""
+    columns = [row['name'].lower() for row in conn.execute("PRAGMA table_info(users)").fetchall()]
+    if "version" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+def _migration_10_archive_user_months(conn):
+    """Bulan arsip yang berisi transaksi tiap pengguna, agar riwayat hanya membuka arsip yang relevan."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archive_user_months (
+            user_id INTEGER NOT NULL, month TEXT NOT NULL, PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    """)
+    # ATTACH tidak bisa di dalam transaksi migrasi, jadi arsip yang sudah ada dibaca lewat koneksi sendiri.
+    for month in archive_months():
+        archive = sqlite3.connect(f"file:{archive_path(month)}?mode=ro", uri=True)
+        try:
+            user_ids = [row[0] for row in archive.execute("SELECT DISTINCT user_id FROM transactions")]
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Migrasi DB: Arsip {month} tidak bisa dibaca: {e}")
+            continue
+        finally:
+            archive.close()
+        conn.executemany("INSERT OR IGNORE INTO archive_user_months (user_id, month) VALUES (?, ?)",
+                         ((user_id, month) for user_id in user_ids))
+
+def _migration_11_catalog_version(conn):
+    """Nomor versi katalog yang naik lewat trigger setiap data produk (selain stok) berubah.
+
+    Worker webhook membandingkannya untuk memutuskan apakah katalog perlu dimuat ulang penuh.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS catalog_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)")
+    bump = "BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END"
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS catalog_version_insert AFTER INSERT ON products {bump}")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS catalog_version_delete AFTER DELETE ON products {bump}")
+    conn.execute("CREATE TRIGGER IF NOT EXISTS catalog_version_update "
+                 f"AFTER UPDATE OF category, product_code, name, price, description ON products {bump}")
+
+MIGRATIONS = [
+    _migration_1_base_schema,
+    _migration_2_stock_items,
+    _migration_3_hot_query_indexes,
+    _migration_4_purchase_ledger,
+    _migration_5_persistence,
+    _migration_6_sales_rollups,
+    _migration_7_archive_indexes,
+    _migration_8_deposits,
+    _migration_9_user_version,
+    _migration_10_archive_user_months,
+    _migration_11_catalog_version,
+]
+
+def _run_migrations(conn):
+    """Menjalankan migrasi yang belum diterapkan, masing-masing dalam satu transaksi."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Migrasi DB: Menjalankan versi {number} ({migration.__name__}).")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    # Memperbarui statistik planner hanya jika perlu; dibatasi agar tetap murah saat start.
+    conn.execute("PRAGMA analysis_limit = 400")
+    conn.execute("PRAGMA optimize")
+
+# Klaim satu item stok. INDEXED BY memastikan klaim tidak pernah memindai semua item
+# produk, berapa pun statistik yang dikumpulkan PRAGMA optimize.
+CLAIM_STOCK_SQL = """
+    UPDATE stock_items SET status = 'SOLD', sold_to = ?, sold_at = CURRENT_TIMESTAMP
+    WHERE id = (
+        SELECT id FROM stock_items INDEXED BY idx_stock_items_available
+        WHERE product_id = ? AND status = 'AVAILABLE' ORDER BY id LIMIT 1
+    )
+    RETURNING data
+"""
+
+_SEARCH_USERS_SELECT = "SELECT *, lower(username) AS _u, lower(first_name) AS _f FROM users WHERE "
+
+# Query yang paling sering dijalankan (SQL yang sama dengan yang dieksekusi handler) beserta index
+# yang wajib dipakainya. Diperiksa oleh check_query_plans() agar perubahan skema/query tidak diam-diam
+# kembali ke full scan.
+HOT_QUERIES = {
+    "get_user": ("SELECT * FROM users WHERE id = ?", (1,), "INTEGER PRIMARY KEY"),
+    "get_products_by_category": ("SELECT * FROM products WHERE category = ? ORDER BY name", ("X",),
+                                 "idx_products_category_name"),
+    "get_user_transactions": ("SELECT * FROM transactions WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (1, 10),
+                              "idx_transactions_user_timestamp"),
+    "claim_stock_item": (CLAIM_STOCK_SQL, (1, 1), "idx_stock_items_available"),
+    "stock_item_exists": ("SELECT 1 FROM stock_items WHERE product_id = ? AND data = ?", (1, "X"),
+                          "idx_stock_items_product_data"),
+    "purchase_ledger": ("SELECT r.item, r.transaction_id, t.product_name FROM purchase_requests r "
+                        "LEFT JOIN transactions t ON t.transaction_id = r.transaction_id "
+                        "WHERE r.callback_query_id = ? OR r.message_ref = ?", ("1", "1:1"),
+                        "sqlite_autoindex_purchase_requests_2"),
+    "sales_rollup": ("SELECT * FROM sales_rollups WHERE scope = ? AND period = ? AND bucket = ? AND key = ?",
+                     ("total", "day", "2024-01-01", ""), "PRIMARY KEY"),
+    "sales_rollup_series": ("SELECT * FROM sales_rollups WHERE scope = 'total' AND period = ? AND bucket >= ? ORDER BY bucket",
+                            ("hour", "2024-01-01 00"), "PRIMARY KEY"),
+    "search_users": (_SEARCH_USERS_SELECT + "lower(username) >= ? AND lower(username) < ? "
+                     "ORDER BY lower(username) ASC, id ASC LIMIT ?", ("a", "b", 11), "idx_users_username_lower"),
+    "search_users_after": (_SEARCH_USERS_SELECT + "lower(first_name) = ? AND id > ? ORDER BY id ASC LIMIT ?",
+                           ("a", 1, 11), "idx_users_first_name_lower"),
+}
+
+# Di bawah jumlah baris ini full scan memang lebih murah, jadi planner boleh memilihnya setelah ANALYZE.
+QUERY_PLAN_MIN_ROWS = 1000
+
+def _table_is_small(conn, table):
+    return conn.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM {table} LIMIT ?)",
+                        (QUERY_PLAN_MIN_ROWS,)).fetchone()[0] < QUERY_PLAN_MIN_ROWS
+
+def check_query_plans(conn):
+    """Memeriksa rencana eksekusi HOT_QUERIES. Mengembalikan (masalah, catatan).
+
+    Rencana tanpa index pada tabel yang semuanya masih kecil hanya menjadi catatan, karena di sana
+    pilihan planner tidak berpengaruh; masalah baru dilaporkan begitu tabelnya cukup besar.
+    """
+    problems, notes = [], []
+    for name, (sql, params, expected_index) in HOT_QUERIES.items():
+        try:
+            details = [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        except sqlite3.OperationalError as e:  # Misalnya index yang disebut INDEXED BY tidak ada
+            problems.append(f"{name}: {e}")
+            continue
+        plan = " | ".join(details)
+        if expected_index not in plan:
+            problem = f"{name}: index {expected_index} tidak dipakai ({plan})"
+        elif "USE TEMP B-TREE" in plan:
+            problem = f"{name}: masih membutuhkan sort tambahan ({plan})"
+        else:
+            continue
+        tables = {match.group(1) for detail in details for match in re.finditer(r"\b(?:SCAN|SEARCH) (\w+)", detail)}
+        if tables and all(_table_is_small(conn, table) for table in tables):
+            notes.append(f"{problem} [tabel < {QUERY_PLAN_MIN_ROWS} baris]")
+        else:
+            problems.append(problem)
+    return problems, notes
+
+def _fts5_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("DROP TABLE temp._fts5_probe")
+    return True
+
+def _ensure_search_index(conn):
+    """Membuat index FTS5 products_fts beserta trigger sinkronisasinya jika belum ada.
+
+    Bukan migrasi bernomor karena FTS5 opsional: database yang dimigrasi dengan SQLite tanpa
+    FTS5 tetap mendapat index-nya begitu dijalankan dengan SQLite yang mendukung FTS5.
+    Mengembalikan True jika pencarian FTS5 bisa dipakai.
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'").fetchone():
+        return True
+    if not _fts5_available(conn):
+        logger.warning("SQLite tanpa FTS5: pencarian inline memakai pencocokan sederhana di memori.")
+        return False
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE products_fts USING fts5(
+                name, description, category, content='products', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER products_fts_ai AFTER INSERT ON products BEGIN
+                INSERT INTO products_fts (rowid, name, description, category)
+                VALUES (new.id, new.name, new.description, new.category);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER products_fts_ad AFTER DELETE ON products BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name, description, category)
+                VALUES ('delete', old.id, old.name, old.description, old.category);
+            END
+        """)
+        # Hanya kolom yang diindeks: stock_numeric berubah di setiap penjualan dan tidak boleh menyentuh FTS.
+        conn.execute("""
+            CREATE TRIGGER products_fts_au AFTER UPDATE OF name, description, category ON products BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name, description, category)
+                VALUES ('delete', old.id, old.name, old.description, old.category);
+                INSERT INTO products_fts (rowid, name, description, category)
+                VALUES (new.id, new.name, new.description, new.category);
+            END
+        """)
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    logger.info("Index pencarian produk (FTS5) dibuat.")
+    return True
+
+def _ensure_incremental_vacuum(conn, convert=False):
+    """Mengaktifkan auto_vacuum=INCREMENTAL agar ruang bekas baris yang diarsipkan bisa dikembalikan.
+
+    Database baru langsung dibuat dengan mode ini. Database lama butuh satu kali VACUUM penuh yang
+    mengunci dan menulis ulang seluruh file, jadi hanya dijalankan jika convert=True
+    (python bot.py --check-db); saat start biasa cukup diberi peringatan.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    if not conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        conn.execute("VACUUM")  # Database kosong (hanya header WAL): seketika
+        return
+    if not convert:
+        logger.warning("Database belum memakai auto_vacuum=INCREMENTAL; file tidak mengecil setelah arsip. "
+                       "Jalankan 'python bot.py --check-db' saat bot berhenti untuk mengonversinya (VACUUM penuh).")
+        return
+    size = os.path.getsize(DB_PATH) / 1024 / 1024 if os.path.exists(DB_PATH) else 0
+    logger.info(f"Mengonversi database ({size:.0f} MB) ke auto_vacuum=INCREMENTAL dengan VACUUM penuh...")
+    started = time.perf_counter()
+    conn.execute("VACUUM")
+    logger.info(f"Database dikonversi ke auto_vacuum=INCREMENTAL dalam {time.perf_counter() - started:.1f} detik.")
+
+def _setup_schema(conn, maintenance=False):
+    _ensure_incremental_vacuum(conn, convert=maintenance)
+    _run_migrations(conn)
+    _ensure_search_index(conn)
+    problems, notes = check_query_plans(conn)
+    for problem in problems:
+        logger.warning(f"Query plan: {problem}")
+    for note in notes:
+        logger.info(f"Query plan: {note}")
+
+async def setup_database(maintenance=False):
+    """Menyiapkan skema. maintenance=True juga menjalankan konversi yang menulis ulang seluruh file."""
+    await db.run(_setup_schema, maintenance)
     print("Database berhasil disiapkan.")
 
 
@@ -96,87 +922,1529 @@ logger = logging.getLogger(__name__)
 # --- State untuk ConversationHandler ---
 (SELECTING_ACTION, ADD_PRODUCT_CATEGORY, ADD_PRODUCT_CODE, ADD_PRODUCT_NAME, 
  ADD_PRODUCT_PRICE, ADD_PRODUCT_DESC, ADD_PRODUCT_STOCK,
- MANAGE_USER_BALANCE) = range(8)
-
-# --- Fungsi Helper Database ---
+ MANAGE_USER_BALANCE, SEARCH_USER, BROADCAST_MESSAGE,
+ IMPORT_STOCK_PRODUCT, IMPORT_STOCK_FILE) = range(12)
+
+# --- ID Transaksi ---
+
+class TransactionIdGenerator:
+    """Pembuat ID transaksi yang monoton, bisa diurutkan, dan bebas bentrok antar proses.
+
+    Format: PREFIX-<12 hex milidetik><6 hex PID><4 hex urutan>.
+    Di dalam satu proses ID selalu naik (urutan direset tiap milidetik dan jam yang
+    mundur diabaikan). Proses yang berjalan bersamaan di satu host (worker webhook) selalu
+    punya PID berbeda, dan PID Linux muat dalam 24 bit (pid_max maksimal 2^22). Proses baru
+    yang kebetulan mendapat PID lama mulai dari milidetik sesudah proses lama berhenti.
+    """
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._seq = 0
+
+    def next(self, prefix):
+        with self._lock:
+            if self._pid != os.getpid():  # Juga benar setelah fork: proses anak memakai PID-nya sendiri
+                self._pid, self._last_ms, self._seq = os.getpid(), 0, 0
+            now_ms = time.time_ns() // 1_000_000
+            if now_ms > self._last_ms:
+                self._last_ms, self._seq = now_ms, 0
+            else:
+                self._seq += 1
+                if self._seq > 0xFFFF:
+                    # Lebih dari 65536 ID dalam satu milidetik: pinjam milidetik berikutnya.
+                    self._last_ms, self._seq = self._last_ms + 1, 0
+            return f"{prefix}-{self._last_ms:012X}{self._pid & 0xFFFFFF:06X}{self._seq:04X}"
+
+
+transaction_ids = TransactionIdGenerator()
+
+
+# --- Cache Pengguna ---
+
+PROFILE_FIELDS = ("username", "first_name", "last_name")
+
+
+def _write_profiles(conn, profiles):
+    """Menulis perubahan username/nama dalam satu statement (dipanggil di dalam transaksi)."""
+    conn.executemany("UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE id = ?", profiles)
+
+
+class UserCache:
+    """LRU + TTL baris users per id; sumber utama pembacaan profil dan saldo pengguna.
+
+    Perubahan saldo dan transaction_count tidak ditulis lewat cache: setiap penulis memakai
+    UPDATE ... RETURNING di dalam transaksinya lalu memanggil apply() setelah commit. Kolom
+    version (naik di setiap perubahan saldo) memastikan hasil yang tiba tidak berurutan, atau
+    hasil baca yang lebih lama dari hasil tulis, tidak menimpa data yang lebih baru.
+    Perubahan username/nama dari Telegram langsung terlihat di cache dan ditulis ke database
+    secara berkala: beberapa perubahan untuk pengguna yang sama digabung menjadi satu tulisan.
+    """
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # user_id -> (row dict atau None jika belum terdaftar, expires)
+        self._loading = {}  # user_id -> Task pembacaan yang sedang berjalan
+        self._written = OrderedDict()  # user_id -> hasil tulis terakhir untuk pengguna yang belum ada di cache
+        self._dirty = {}  # user_id -> (username, first_name, last_name) yang belum ditulis
+        self._flusher = None
+        self.hits = 0
+        self.misses = 0
+        self.profile_writes = 0
+
+    async def get(self, user_id, fresh=False):
+        """Baris pengguna (dict, jangan diubah) atau None jika belum terdaftar.
+
+        fresh=True selalu membaca ulang dari database, misalnya sebelum menolak pembelian
+        karena saldo di cache kurang (saldo bisa sudah ditambah worker lain).
+        """
+        entry = self._items.get(user_id)
+        if entry is not None and not fresh:
+            row, expires = entry
+            if expires >= time.monotonic():
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return row
+        self.misses += 1
+        # Pembacaan bersamaan untuk pengguna yang sama (misalnya dua tombol ditekan cepat) digabung.
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,)))
+            self._loading[user_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        row = await task
+        return self._store(user_id, dict(row) if row is not None else None)
+
+    def _store(self, user_id, row):
+        entry = self._items.get(user_id)
+        current = entry[0] if entry is not None else None
+        written = self._written.pop(user_id, None)
+        if row is None and written is not None:
+            return None  # Hasil baca lebih lama dari pendaftaran yang sudah di-commit; jangan disimpan
+        if row is not None:
+            if current is not None and current['version'] > row['version']:
+                row = current  # Hasil tulis yang sudah diterapkan lebih baru dari hasil baca ini
+            if written is not None and written['version'] > row['version']:
+                row.update(written)  # Saldo dari tulisan yang selesai saat pembacaan ini masih berjalan
+            pending = self._dirty.get(user_id)
+            if pending is not None:
+                row.update(zip(PROFILE_FIELDS, pending))
+        self._items[user_id] = (row, time.monotonic() + self.ttl)
+        self._items.move_to_end(user_id)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return row
+
+    def put(self, row):
+        """Menyimpan baris lengkap yang baru saja dibaca atau dibuat (misalnya hasil INSERT ... RETURNING)."""
+        self._store(row['id'], dict(row))
+
+    def apply(self, account):
+        """Menerapkan hasil RETURNING (id, balance, transaction_count, version) setelah transaksi commit.
+
+        Untuk pengguna yang tidak ada di cache, hasilnya diingat sampai baris pengguna itu disimpan,
+        agar pembacaan yang sudah berjalan sebelum commit tidak menyimpan saldo lama.
+        """
+        user_id = account['id']
+        entry = self._items.get(user_id)
+        row = entry[0] if entry is not None else None
+        if row is not None:
+            if account['version'] > row['version']:
+                row.update(account)
+            return
+        if entry is not None:
+            del self._items[user_id]  # Terdaftar lewat jalur lain; baca ulang saat dibutuhkan
+        written = self._written.get(user_id)
+        if written is None or account['version'] > written['version']:
+            self._written[user_id] = dict(account)
+        self._written.move_to_end(user_id)
+        if len(self._written) > self.maxsize:
+            self._written.popitem(last=False)
+
+    def forget(self, user_id):
+        self._items.pop(user_id, None)
+
+    def observe(self, user):
+        """Mencatat username/nama terbaru dari Telegram untuk pengguna yang ada di cache."""
+        entry = self._items.get(user.id)
+        if entry is None or entry[0] is None:
+            return
+        row = entry[0]
+        profile = (user.username, user.first_name, user.last_name)
+        if tuple(row[field] for field in PROFILE_FIELDS) != profile:
+            row.update(zip(PROFILE_FIELDS, profile))
+            self._dirty[user.id] = profile
+
+    @property
+    def pending(self):
+        return len(self._dirty)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    async def flush(self):
+        """Menulis semua perubahan profil yang tertunda dalam satu transaksi."""
+        if not self._dirty:
+            return
+        pending, self._dirty = self._dirty, {}
+        try:
+            await db.transaction(_write_profiles, [(*profile, user_id) for user_id, profile in pending.items()])
+            self.profile_writes += len(pending)
+        except sqlite3.Error as e:
+            logger.error(f"Gagal menyimpan {len(pending)} perubahan profil pengguna: {e}")
+            # Dicoba lagi di flush berikutnya, kecuali sudah ada perubahan yang lebih baru.
+            for user_id, profile in pending.items():
+                self._dirty.setdefault(user_id, profile)
+
+    async def _flush_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def start(self, interval=USER_PROFILE_FLUSH_INTERVAL):
+        self._flusher = asyncio.create_task(self._flush_periodically(interval))
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+
+user_cache = UserCache()
+
+metrics.register_callback("bot_user_cache_hits_total", "counter", "Pembacaan pengguna yang dilayani dari cache.",
+                          lambda: user_cache.hits)
+metrics.register_callback("bot_user_cache_misses_total", "counter", "Pembacaan pengguna yang membaca database.",
+                          lambda: user_cache.misses)
+metrics.register_callback("bot_user_profile_writes_total", "counter",
+                          "Perubahan username/nama pengguna yang ditulis ke database.",
+                          lambda: user_cache.profile_writes)
+metrics.register_callback("bot_user_profile_pending", "gauge", "Perubahan profil pengguna yang belum ditulis.",
+                          lambda: user_cache.pending)
+
+
+async def track_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Memuat pengguna ke cache dan mencatat perubahan username/nama dari setiap update."""
+    user = update.effective_user
+    if user is None or user.is_bot:
+        return
+    if await user_cache.get(user.id) is not None:
+        user_cache.observe(user)
 
-def get_user(user_id):
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    return cursor.fetchone()
 
-def get_all_users():
-    cursor.execute("SELECT * FROM users ORDER BY id")
-    return cursor.fetchall()
+# --- Fungsi Helper Database ---
 
-def register_user(user):
+async def get_user(user_id, fresh=False):
+    return await user_cache.get(user_id, fresh)
+
+def _search_column(conn, column, prefix, upper, after, backward, chunk):
+    """Pengguna yang kolomnya diawali prefix, urut (lower(kolom), id), mulai setelah posisi after.
+
+    Dibaca per chunk dengan keyset pada index lower(kolom): setiap query hanya membaca
+    maksimal chunk baris, berapa pun jumlah pengguna yang cocok.
+    """
+    expr = f"lower({column})"
+    op, order = ("<", "DESC") if backward else (">", "ASC")
+    select = _SEARCH_USERS_SELECT
+    tail = f" ORDER BY {expr} {order}, id {order} LIMIT ?"
+    while True:
+        if after is None:
+            rows = conn.execute(select + f"{expr} >= ? AND {expr} < ?" + tail, (prefix, upper, chunk)).fetchall()
+        else:
+            key, last_id = after
+            # Sisa baris dengan kunci yang sama dulu, lalu kunci berikutnya; keduanya memakai seek index.
+            rows = conn.execute(select + f"{expr} = ? AND id {op} ? ORDER BY id {order} LIMIT ?",
+                                (key, last_id, chunk)).fetchall()
+            if len(rows) < chunk:
+                edge, edge_op = (prefix, ">=") if backward else (upper, "<")
+                rows += conn.execute(select + f"{expr} {op} ? AND {expr} {edge_op} ?" + tail,
+                                     (key, edge, chunk - len(rows))).fetchall()
+        yield from rows
+        if len(rows) < chunk:
+            return
+        after = (rows[-1]['_u' if column == "username" else '_f'], rows[-1]['id'])
+
+def _search_position(row, prefix, upper):
+    """Posisi baris di hasil pencarian: (kunci yang cocok, kolom asal, id).
+
+    Pengguna yang username dan first_name-nya sama-sama cocok hanya ditampilkan sekali, di posisi
+    kunci terkecil (username jika sama).
+    """
+    keys = [(row[alias], column) for alias, column in (('_u', "username"), ('_f', "first_name"))
+            if row[alias] is not None and prefix <= row[alias] < upper]
+    if not keys:
+        return None
+    key, column = min(keys)
+    return key, column, row['id']
+
+def _search_stream(conn, column, prefix, upper, after, backward, chunk):
+    """(posisi, baris) dari satu kolom; baris yang posisinya ada di kolom lain dilewati."""
+    for row in _search_column(conn, column, prefix, upper, after, backward, chunk):
+        position = _search_position(row, prefix, upper)
+        if position is not None and position[1] == column:
+            yield position, row
+
+def _search_users_page(conn, prefix, cursor_id, backward, limit):
+    upper = prefix + "\U0010ffff"
+    after = None
+    if cursor_id:
+        row = conn.execute("SELECT id, lower(username) AS _u, lower(first_name) AS _f FROM users WHERE id = ?",
+                           (cursor_id,)).fetchone()
+        position = _search_position(row, prefix, upper) if row else None
+        after = (position[0], position[2]) if position else None
+    streams = [_search_stream(conn, column, prefix, upper, after, backward, limit + 1)
+               for column in ("username", "first_name")]
+    merged = heapq.merge(*streams, key=lambda item: (item[0][0], item[0][2]), reverse=backward)
+    return [row for _, row in itertools.islice(merged, limit + 1)]
+
+def _users_page(conn, cursor_id, backward, limit):
+    op, order = ("<", "DESC") if backward else (">", "ASC")
+    return conn.execute(f"SELECT * FROM users WHERE id {op} ? ORDER BY id {order} LIMIT ?",
+                        (cursor_id, limit)).fetchall()
+
+async def get_users_page(cursor_id=0, backward=False, search=None, limit=ADMIN_USERS_PAGE_SIZE):
+    """Mengambil satu halaman pengguna dengan keyset pagination.
+
+    Mengembalikan (rows, has_more) di mana has_more berarti masih ada halaman lain
+    ke arah yang diminta. Tanpa search, halaman diurutkan berdasarkan id. Jika search
+    diisi, hanya pengguna yang username atau first_name-nya diawali teks tersebut (tanpa
+    membedakan huruf besar/kecil), diurutkan berdasarkan teks yang cocok lalu id;
+    cursor_id tetap id baris batas halaman, posisinya dibaca ulang dari tabel.
+    """
+    if search:
+        # SQLite lower() hanya mengubah huruf ASCII, jadi awalan diperlakukan sama.
+        prefix = "".join(c.lower() if c.isascii() else c for c in search)
+        rows = await db.run(_search_users_page, prefix, cursor_id, backward, limit)
+    else:
+        rows = await db.run(_users_page, cursor_id, backward, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+async def register_user(user):
     try:
-        cursor.execute(
-            "INSERT OR IGNORE INTO users (id, username, first_name, last_name, balance) VALUES (?, ?, ?, ?, ?)",
+        row = await db.fetchone(
+            "INSERT INTO users (id, username, first_name, last_name, balance) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO NOTHING RETURNING *",
             (user.id, user.username, user.first_name, user.last_name, DEFAULT_BALANCE)
         )
-        logger.info(f"Pengguna baru terdaftar: {user.id} - {user.username}")
     except sqlite3.Error as e:
         logger.error(f"Gagal mendaftarkan pengguna {user.id}: {e}")
-
-def get_product_by_code(product_code):
-    cursor.execute("SELECT * FROM products WHERE product_code = ?", (product_code,))
-    return cursor.fetchone()
-
-def get_categories():
-    cursor.execute("SELECT DISTINCT category FROM products ORDER BY category")
-    return [row['category'] for row in cursor.fetchall()]
-
-def get_products_by_category(category):
-    cursor.execute("SELECT * FROM products WHERE category = ? ORDER BY name", (category,))
-    return cursor.fetchall()
-
-def get_user_transactions(user_id, limit=10):
-    cursor.execute("SELECT * FROM transactions WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?", (user_id, limit))
-    return cursor.fetchall()
-
-def create_transaction(user_id, product, details):
-    trx_id = f"TRX-{user_id}-{int(datetime.now().timestamp())}"
-    cursor.execute(
-        "INSERT INTO transactions (transaction_id, user_id, product_name, price, details) VALUES (?, ?, ?, ?, ?)",
-        (trx_id, user_id, product['name'], product['price'], details)
+        return
+    if row is None:
+        user_cache.forget(user.id)  # Sudah terdaftar (misalnya oleh worker lain); dibaca ulang saat dibutuhkan
+        return
+    user_cache.put(row)
+    logger.info(f"Pengguna baru terdaftar: {user.id} - {user.username}")
+
+async def get_products_by_category(category):
+    return await db.fetchall("SELECT * FROM products WHERE category = ? ORDER BY name", (category,))
+
+async def get_user_transactions(user_id, limit=10, before=None):
+    """Transaksi pengguna (termasuk arsip), terbaru dulu. before=(timestamp, id) melanjutkan dari halaman sebelumnya."""
+    return await db.run(_fetch_user_history, user_id, limit, before)
+
+def _debit_purchase(conn, user_id, price):
+    """Memotong saldo hanya jika cukup (dipanggil di dalam transaksi).
+
+    Cek dan potong adalah satu UPDATE bersyarat, jadi dua pembelian yang berjalan bersamaan
+    tidak pernah bisa membuat saldo minus. Mengembalikan baris users terbaru, atau None jika
+    saldo tidak cukup (tidak ada yang ditulis).
+    """
+    account = conn.execute(
+        "UPDATE users SET balance = balance - ?, transaction_count = transaction_count + 1, version = version + 1 "
+        "WHERE id = ? AND balance >= ? RETURNING id, balance, transaction_count, version",
+        (price, user_id, price)
+    ).fetchone()
+    return dict(account) if account is not None else None
+
+def _insert_purchase(conn, user_id, product, details):
+    """Mencatat transaksi pembelian dan memperbarui rollup (dipanggil di dalam transaksi, setelah _debit_purchase)."""
+    trx_id = transaction_ids.next("TRX")
+    now = datetime.now(timezone.utc)
+    conn.execute(
+        "INSERT INTO transactions (transaction_id, user_id, product_id, product_name, price, details, timestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (trx_id, user_id, product['id'], product['name'], product['price'], details, now.strftime('%Y-%m-%d %H:%M:%S'))
     )
-    cursor.execute(
-        "UPDATE users SET balance = balance - ?, transaction_count = transaction_count + 1 WHERE id = ?",
-        (product['price'], user_id)
+    _record_sale(conn, user_id, product, now)
+    return trx_id
+
+def _insert_stock_items(conn, product_id, items):
+    """Menambahkan item stok (dipanggil di dalam transaksi). Mengembalikan jumlah item yang masuk.
+
+    Item kosong dilewati, dan item yang sudah pernah ada untuk produk ini
+    (tersedia maupun terjual) tidak dimasukkan lagi. Item terjual yang sudah dipindahkan
+    ke arsip (lebih tua dari ARCHIVE_AFTER_DAYS) tidak ikut diperiksa.
+    """
+    before = conn.total_changes
+    conn.executemany(
+        "INSERT INTO stock_items (product_id, data) SELECT ?, ? "
+        "WHERE NOT EXISTS (SELECT 1 FROM stock_items WHERE product_id = ? AND data = ?)",
+        ((product_id, item, product_id, item) for item in (i.strip() for i in items) if item)
     )
-
-def admin_update_balance(user_id, amount, reason):
-    """Mencatat perubahan saldo oleh admin dan memperbarui saldo pengguna."""
-    cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
-    trx_id = f"ADM-{user_id}-{int(datetime.now().timestamp())}"
+    inserted = conn.total_changes - before
+    conn.execute("UPDATE products SET stock_numeric = stock_numeric + ? WHERE id = ?", (inserted, product_id))
+    return inserted
+
+def _claim_stock_item(conn, product_id, user_id):
+    """Menandai satu item stok tersedia sebagai terjual dan mengembalikan isinya (atau None)."""
+    row = conn.execute(CLAIM_STOCK_SQL, (user_id, product_id)).fetchone()
+    if row is None:
+        return None
+    conn.execute("UPDATE products SET stock_numeric = stock_numeric - 1 WHERE id = ?", (product_id,))
+    return row['data']
+
+def _insert_product(conn, product):
+    """Menyimpan produk baru beserta stok awalnya."""
+    product_id = conn.execute(
+        "INSERT INTO products (category, product_code, name, price, description) VALUES (?, ?, ?, ?, ?)",
+        (product['category'], product['code'], product['name'], product['price'], product['desc'])
+    ).lastrowid
+    return _insert_stock_items(conn, product_id, product['stock'].split('|'))
+
+def _admin_update_balance(conn, user_id, amount, reason):
+    account = conn.execute(
+        "UPDATE users SET balance = balance + ?, version = version + 1 WHERE id = ? "
+        "RETURNING id, balance, transaction_count, version",
+        (amount, user_id)
+    ).fetchone()
+    trx_id = transaction_ids.next("ADM")
     action = "Ditambah" if amount > 0 else "Dipotong"
     desc = f"Saldo {action} oleh Admin"
-    cursor.execute(
+    conn.execute(
         "INSERT INTO transactions (transaction_id, user_id, product_name, price, details, status) VALUES (?, ?, ?, ?, ?, ?)",
         (trx_id, user_id, desc, abs(amount), reason, "ADMIN_ACTION")
     )
+    return account
+
+async def admin_update_balance(user_id, amount, reason):
+    """Mencatat perubahan saldo oleh admin dan memperbarui saldo pengguna."""
+    account = await db.transaction(_admin_update_balance, user_id, amount, reason)
+    if account is not None:
+        user_cache.apply(dict(account))
     logger.info(f"Admin mengubah saldo user {user_id} sebesar {amount}. Alasan: {reason}")
 
 
+# --- Analitik Penjualan (Rollup) ---
+
+# Format bucket per periode, sama dengan strftime() SQLite agar backfill dan penjualan baru cocok.
+ROLLUP_PERIODS = {"hour": "%Y-%m-%d %H", "day": "%Y-%m-%d", "month": "%Y-%m"}
+# Kunci rollup per scope sebagai ekspresi SQL atas transactions t JOIN products p (untuk backfill).
+ROLLUP_SCOPES_SQL = {"total": "''", "category": "p.category", "product": "CAST(t.product_id AS TEXT)"}
+
+_ROLLUP_BUYER = "INSERT OR IGNORE INTO sales_rollup_buyers (scope, period, bucket, key, user_id) VALUES (?, ?, ?, ?, ?)"
+_ROLLUP_UPSERT = """
+    INSERT INTO sales_rollups (scope, period, bucket, key, sales, revenue, buyers) VALUES (?, ?, ?, ?, 1, ?, ?)
+    ON CONFLICT (scope, period, bucket, key) DO UPDATE SET
+        sales = sales + 1, revenue = revenue + excluded.revenue, buyers = buyers + excluded.buyers
+"""
+
+def report_time(now=None):
+    """Waktu sekarang (atau now, UTC) di zona waktu laporan."""
+    return (now or datetime.now(timezone.utc)) + timedelta(hours=REPORT_UTC_OFFSET_HOURS)
+
+def rollup_bucket(period, local_time):
+    return local_time.strftime(ROLLUP_PERIODS[period])
+
+def _record_sale(conn, user_id, product, now):
+    """Menambahkan satu penjualan ke semua baris rollup terkait (dipanggil di dalam transaksi penjualan)."""
+    local_time = report_time(now)
+    for period in ROLLUP_PERIODS:
+        bucket = rollup_bucket(period, local_time)
+        for scope, key in (("total", ""), ("category", product['category']), ("product", str(product['id']))):
+            new_buyer = conn.execute(_ROLLUP_BUYER, (scope, period, bucket, key, user_id)).rowcount
+            conn.execute(_ROLLUP_UPSERT, (scope, period, bucket, key, product['price'], new_buyer))
+
+def _fetch_rollups(conn, scope, period, buckets, key=""):
+    """Baris rollup untuk bucket-bucket tertentu sebagai dict bucket -> row (bucket tanpa penjualan tidak ada)."""
+    rows = conn.execute(
+        f"SELECT * FROM sales_rollups WHERE scope = ? AND period = ? AND key = ? "
+        f"AND bucket IN ({', '.join('?' * len(buckets))})",
+        (scope, period, key, *buckets)
+    ).fetchall()
+    return {row['bucket']: row for row in rows}
+
+def _fetch_rollup_series(conn, period, since):
+    """Baris rollup total sejak bucket since (inklusif), urut waktu."""
+    return conn.execute(
+        "SELECT * FROM sales_rollups WHERE scope = 'total' AND period = ? AND bucket >= ? ORDER BY bucket",
+        (period, since)
+    ).fetchall()
+
+def _fetch_top_rollups(conn, scope, period, bucket, limit):
+    """Baris rollup teratas (menurut omzet) untuk satu bucket; hanya membaca baris bucket tersebut."""
+    return conn.execute(
+        "SELECT * FROM sales_rollups WHERE scope = ? AND period = ? AND bucket = ? "
+        "ORDER BY revenue DESC, sales DESC LIMIT ?",
+        (scope, period, bucket, limit)
+    ).fetchall()
+
+
+# --- Arsip Riwayat ---
+
+# Tabel yang diarsipkan: kolom waktu penentu umur/bulan arsip, filter baris, dan kolom yang disalin.
+ARCHIVE_TABLES = {
+    "transactions": ("timestamp", "1",
+                     "id, transaction_id, user_id, product_id, product_name, price, details, status, timestamp"),
+    "stock_items": ("sold_at", "status = 'SOLD'", "id, product_id, data, status, sold_to, sold_at"),
+}
+_ARCHIVE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS archive.transactions (
+        id INTEGER PRIMARY KEY, transaction_id TEXT UNIQUE NOT NULL, user_id INTEGER NOT NULL, product_id INTEGER,
+        product_name TEXT NOT NULL, price REAL NOT NULL, details TEXT, status TEXT, timestamp DATETIME
+    )""",
+    "CREATE INDEX IF NOT EXISTS archive.idx_transactions_user_timestamp ON transactions (user_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_transactions_timestamp ON transactions (timestamp)",
+    """CREATE TABLE IF NOT EXISTS archive.stock_items (
+        id INTEGER PRIMARY KEY, product_id INTEGER NOT NULL, data TEXT NOT NULL, status TEXT NOT NULL,
+        sold_to INTEGER, sold_at DATETIME
+    )""",
+)
+_ARCHIVE_PREFIX, _ARCHIVE_SUFFIX = "history-", ".db"
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"{_ARCHIVE_PREFIX}{month}{_ARCHIVE_SUFFIX}")
+
+def archive_months():
+    """Bulan (YYYY-MM) yang punya database arsip, terbaru dulu."""
+    try:
+        names = os.listdir(ARCHIVE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((name[len(_ARCHIVE_PREFIX):-len(_ARCHIVE_SUFFIX)] for name in names
+                   if name.startswith(_ARCHIVE_PREFIX) and name.endswith(_ARCHIVE_SUFFIX)), reverse=True)
+
+def _next_month(month):
+    year, number = int(month[:4]), int(month[5:7])
+    return f"{year + number // 12:04d}-{number % 12 + 1:02d}-01"
+
+def _archive_batch(conn, table, cutoff, limit=ARCHIVE_BATCH_SIZE):
+    """Memindahkan maksimal limit baris tertua (lebih tua dari cutoff) ke arsip bulannya.
+
+    Semua baris dalam satu batch berasal dari bulan yang sama. Dalam mode WAL transaksi lintas
+    database tidak atomik sebagai satu kesatuan, jadi pemindahan dilakukan dalam dua transaksi:
+    salinan ke arsip di-commit lebih dulu, lalu baris di DB utama dihapus hanya jika salinannya
+    sudah ada di arsip. Jika terputus di antaranya, batch berikutnya menyalin ulang (INSERT OR
+    IGNORE) lalu menghapus; baris tidak pernah hilang. ATTACH tidak bisa di dalam transaksi,
+    jadi arsip dipasang dan dilepas di sekitar keduanya. Mengembalikan jumlah baris yang dipindahkan.
+    """
+    time_column, where, columns = ARCHIVE_TABLES[table]
+    oldest = conn.execute(
+        f"SELECT {time_column} FROM {table} WHERE {where} AND {time_column} < ? ORDER BY {time_column} LIMIT 1",
+        (cutoff,)
+    ).fetchone()
+    if oldest is None:
+        return 0
+    month = oldest[0][:7]
+    upper = min(cutoff, _next_month(month))
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path(month),))
+    try:
+        conn.execute("PRAGMA archive.synchronous = FULL")
+        for statement in _ARCHIVE_SCHEMA:
+            conn.execute(statement)
+        # Transaksi 1: hanya menulis arsip (BEGIN biasa, agar pembelian di DB utama tidak ikut menunggu).
+        conn.execute("BEGIN")
+        try:
+            selected = [row[0] for row in conn.execute(
+                f"SELECT id FROM main.{table} WHERE {where} AND {time_column} < ? ORDER BY {time_column} LIMIT ?",
+                (upper, limit)
+            )]
+            ids = json.dumps(selected)
+            conn.execute(f"INSERT OR IGNORE INTO archive.{table} ({columns}) SELECT {columns} FROM main.{table} "
+                         f"WHERE id IN (SELECT value FROM json_each(?))", (ids,))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        # Transaksi 2: hanya menghapus baris yang salinannya (id dan waktu sama) sudah tersimpan di arsip.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if table == "transactions":
+                conn.execute(
+                    "INSERT OR IGNORE INTO main.archive_user_months (user_id, month) SELECT DISTINCT user_id, ? "
+                    "FROM main.transactions WHERE id IN (SELECT value FROM json_each(?)) AND EXISTS ("
+                    "SELECT 1 FROM archive.transactions AS copy WHERE copy.id = transactions.id "
+                    "AND copy.timestamp = transactions.timestamp)",
+                    (month, ids)
+                )
+            moved = conn.execute(
+                f"DELETE FROM main.{table} WHERE id IN (SELECT value FROM json_each(?)) AND EXISTS ("
+                f"SELECT 1 FROM archive.{table} AS copy WHERE copy.id = {table}.id "
+                f"AND copy.{time_column} = {table}.{time_column})",
+                (ids,)
+            ).rowcount
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.execute("DETACH DATABASE archive")
+    if moved < len(selected):
+        logger.warning(f"Arsip {month}: {len(selected) - moved} baris {table} tidak cocok dengan salinan "
+                       f"di arsip dan dibiarkan di DB utama.")
+    return moved
+
+def _retention_deletes(now):
+    """Statement hapus batch untuk data bantu yang tidak dibutuhkan lagi: (label, sql, params)."""
+    ledger_cutoff = (now - timedelta(days=PURCHASE_LEDGER_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    deletes = [("purchase_requests",
+                "DELETE FROM purchase_requests WHERE rowid IN "
+                "(SELECT rowid FROM purchase_requests WHERE created_at < ? LIMIT ?)", (ledger_cutoff,))]
+    # Daftar pembeli hanya dipakai untuk menghitung pembeli unik bucket yang masih berjalan;
+    # bucket yang sudah lewat (disisakan satu bucket untuk selisih jam antar proses) bisa dibuang.
+    local_time = report_time(now)
+    last_month = local_time.replace(day=1) - timedelta(days=1)
+    closed = {"hour": local_time - timedelta(hours=1), "day": local_time - timedelta(days=1), "month": last_month}
+    for period, boundary in closed.items():
+        for scope in ROLLUP_SCOPES_SQL:
+            deletes.append(("sales_rollup_buyers",
+                            "DELETE FROM sales_rollup_buyers WHERE (scope, period, bucket, key, user_id) IN ("
+                            "SELECT scope, period, bucket, key, user_id FROM sales_rollup_buyers "
+                            "WHERE scope = ? AND period = ? AND bucket < ? LIMIT ?)",
+                            (scope, period, rollup_bucket(period, boundary))))
+    return deletes
+
+def _delete_batch(conn, sql, params, limit=ARCHIVE_BATCH_SIZE):
+    return conn.execute(sql, (*params, limit)).rowcount
+
+def _incremental_vacuum_step(conn, pages=ARCHIVE_VACUUM_PAGES):
+    """Mengembalikan maksimal pages halaman kosong ke sistem file. Mengembalikan jumlah halaman yang dilepas."""
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if not before:
+        return 0
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+async def run_retention():
+    """Menghapus data bantu kedaluwarsa (ledger pembelian, daftar pembeli bucket rollup yang sudah tutup).
+
+    Berjalan sebagai job sendiri, tidak bergantung pada pengarsipan: sales_rollup_buyers bertambah
+    sembilan baris per penjualan dan tetap harus dipangkas walaupun arsip dimatikan.
+    """
+    counts = {}
+    for label, sql, params in _retention_deletes(datetime.now(timezone.utc)):
+        while deleted := await db.transaction(_delete_batch, sql, params):
+            counts[label] = counts.get(label, 0) + deleted
+            metrics.inc("bot_archived_rows_total", label, deleted)
+    if counts:
+        logger.info(f"Retensi data bantu: {counts}.")
+    return counts
+
+async def retention_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job JobQueue berkala untuk run_retention()."""
+    try:
+        await run_retention()
+    except sqlite3.Error as e:
+        logger.error(f"Job retensi data bantu gagal: {e}")
+
+async def run_archival(max_age_days=ARCHIVE_AFTER_DAYS):
+    """Mengarsipkan riwayat lama, lalu mengecilkan file database.
+
+    Setiap batch adalah panggilan database tersendiri, sehingga pembelian tetap dilayani di antaranya.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(days=max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+    counts = {}
+    for table in ARCHIVE_TABLES:
+        while moved := await db.run(_archive_batch, table, cutoff):
+            counts[table] = counts.get(table, 0) + moved
+            metrics.inc("bot_archived_rows_total", table, moved)
+    pages = 0
+    while released := await db.run(_incremental_vacuum_step):
+        pages += released
+    await db.run(_execute, "PRAGMA wal_checkpoint(PASSIVE)", ())
+    if counts or pages:
+        logger.info(f"Arsip riwayat: {counts or 'tidak ada baris'}, {pages} halaman dikembalikan.")
+    return counts, pages
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job JobQueue berkala untuk run_archival()."""
+    try:
+        await run_archival()
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Job arsip riwayat gagal: {e}")
+
+def _history_cursor(trx):
+    """Posisi (detik epoch, id) sebuah transaksi untuk tombol halaman berikutnya."""
+    stamp = datetime.strptime(trx['timestamp'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return int(stamp.timestamp()), trx['id']
+
+def _fetch_user_history(conn, user_id, limit, before=None):
+    """Transaksi pengguna terbaru dulu dari DB utama, lalu dari arsip bulanan (terbaru dulu).
+
+    Arsip selalu lebih tua dari isi DB utama, jadi hasilnya tetap urut. before=(detik epoch, id).
+    Arsip hanya dibuka jika halaman belum penuh, dan hanya bulan yang berisi transaksi pengguna ini
+    (archive_user_months); pembacaan berhenti begitu limit baris terkumpul.
+    """
+    condition, params, month_limit = "", (), "9999-99"
+    if before:
+        stamp = datetime.fromtimestamp(before[0], timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        condition, params = "AND (timestamp < ? OR (timestamp = ? AND id < ?))", (stamp, stamp, before[1])
+        month_limit = stamp[:7]
+    sql = f"SELECT * FROM transactions WHERE user_id = ? {condition} ORDER BY timestamp DESC, id DESC LIMIT ?"
+    rows = [dict(row) for row in conn.execute(sql, (user_id, *params, limit))]
+    if len(rows) >= limit:
+        return rows
+    months = [row[0] for row in conn.execute(
+        "SELECT month FROM archive_user_months WHERE user_id = ? AND month <= ? ORDER BY month DESC",
+        (user_id, month_limit)
+    )]
+    seen = {row['transaction_id'] for row in rows}
+    for month in months:
+        if len(rows) >= limit:
+            break
+        archive = sqlite3.connect(f"file:{archive_path(month)}?mode=ro", uri=True)
+        archive.row_factory = sqlite3.Row
+        try:
+            for row in archive.execute(sql, (user_id, *params, limit - len(rows))):
+                if row['transaction_id'] not in seen:
+                    rows.append(dict(row))
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Arsip {month} tidak bisa dibaca: {e}")
+        finally:
+            archive.close()
+    return rows
+
+
+# --- Persistensi (SQLite) ---
+
+PICKLE_PROTOCOL = 4  # Tetap, agar hasil pickle nilai yang sama selalu identik dan bisa dibandingkan
+
+_PERSIST_UPSERT = "INSERT OR REPLACE INTO persistence_data (kind, owner_id, key, value) VALUES (?, ?, ?, ?)"
+_PERSIST_DELETE = "DELETE FROM persistence_data WHERE kind = ? AND owner_id = ? AND key = ?"
+_PERSIST_DROP = "DELETE FROM persistence_data WHERE kind = ? AND owner_id = ?"
+_CONVERSATION_UPSERT = "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)"
+_CONVERSATION_DELETE = "DELETE FROM conversations WHERE name = ? AND key = ?"
+
+def _apply_persistence_ops(conn, ops):
+    """Menjalankan daftar (sql, params) berurutan; statement yang sama berturut-turut digabung."""
+    for sql, group in itertools.groupby(ops, key=lambda op: op[0]):
+        conn.executemany(sql, [params for _, params in group])
+
+def _load_persistence_rows(conn, kind, owner_id):
+    return conn.execute("SELECT key, value FROM persistence_data WHERE kind = ? AND owner_id = ?",
+                        (kind, owner_id)).fetchall()
+
+class SQLitePersistence(BasePersistence):
+    """Persistensi user_data, chat_data, dan state ConversationHandler di bot.db.
+
+    - Data dimuat per pengguna/chat saat pertama kali diakses (refresh_*_data), sehingga
+      waktu start tidak bergantung pada jumlah pengguna; get_user_data() mengembalikan {}.
+    - Setiap kunci disimpan sebagai satu baris (pickle). Saat update, hanya kunci yang nilainya
+      berubah yang ditulis, dan semua perubahan dari satu putaran update_persistence digabung
+      dalam satu transaksi.
+    - bot_data tidak disimpan: isinya hanya penanda proses berjalan (misal broadcast_running)
+      yang tidak boleh bertahan setelah restart.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self._snapshots = {}  # (kind, owner_id) -> {key_pickle: value_pickle} yang terakhir ditulis
+        self._loaded = set()  # (kind, owner_id) yang datanya sudah dimuat di proses ini
+        self._loading = {}  # (kind, owner_id) -> Task pemuatan yang sedang berjalan
+        self._ops = []
+        self._write_task = None
+        self._write_lock = asyncio.Lock()
+
+    # --- Pemuatan ---
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        # Hanya percakapan yang sedang berlangsung yang tersimpan, jadi jumlahnya kecil.
+        rows = await db.fetchall("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(row['key'])): pickle.loads(row['state']) for row in rows}
+
+    async def _refresh(self, kind, owner_id, data):
+        owner = (kind, owner_id)
+        if owner in self._loaded:
+            return
+        task = self._loading.get(owner)
+        if task is None:
+            # Update yang bersamaan untuk pengguna yang sama menunggu pemuatan yang sama,
+            # sehingga data hanya dimasukkan sekali dan tidak menimpa perubahan handler.
+            task = self._loading[owner] = asyncio.ensure_future(self._load(owner, data))
+        await task
+
+    async def _load(self, owner, data):
+        try:
+            rows = await db.run(_load_persistence_rows, *owner)
+        finally:
+            del self._loading[owner]
+        self._loaded.add(owner)
+        if rows:
+            self._snapshots[owner] = {row['key']: row['value'] for row in rows}
+            for row in rows:
+                data.setdefault(pickle.loads(row['key']), pickle.loads(row['value']))
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh("chat", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Penulisan ---
+
+    def _diff(self, kind, owner_id, data):
+        owner = (kind, owner_id)
+        old = self._snapshots.get(owner, {})
+        new = {pickle.dumps(k, PICKLE_PROTOCOL): pickle.dumps(v, PICKLE_PROTOCOL) for k, v in data.items()}
+        for key, value in new.items():
+            if old.get(key) != value:
+                self._ops.append((_PERSIST_UPSERT, (kind, owner_id, key, value)))
+        for key in old.keys() - new.keys():
+            self._ops.append((_PERSIST_DELETE, (kind, owner_id, key)))
+        if new:
+            self._snapshots[owner] = new
+        else:
+            self._snapshots.pop(owner, None)
+
+    def _schedule_write(self):
+        if self._write_task is None:
+            self._write_task = asyncio.ensure_future(self._write())
+        return self._write_task
+
+    async def _write(self):
+        # Semua update_* dari satu putaran update_persistence berjalan dalam asyncio.gather;
+        # satu kali yield membiarkan semuanya menaruh perubahan sebelum batch diambil.
+        await asyncio.sleep(0)
+        self._write_task = None
+        ops, self._ops = self._ops, []
+        if not ops:
+            return
+        async with self._write_lock:  # Batch ditulis berurutan sesuai waktu pembuatannya
+            try:
+                await db.transaction(_apply_persistence_ops, ops)
+            except sqlite3.Error as e:
+                logger.error(f"Gagal menyimpan persistensi ({len(ops)} perubahan): {e}")
+                # Snapshot sudah tidak cocok dengan isi DB; tulis ulang semua kunci pada update berikutnya.
+                for sql, params in ops:
+                    if sql in (_PERSIST_UPSERT, _PERSIST_DELETE, _PERSIST_DROP):
+                        self._snapshots.pop((params[0], params[1]), None)
+
+    async def update_user_data(self, user_id, data):
+        self._diff("user", user_id, data)
+        await self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        self._diff("chat", chat_id, data)
+        await self._schedule_write()
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        key = json.dumps(key)
+        if new_state is None:
+            self._ops.append((_CONVERSATION_DELETE, (name, key)))
+        else:
+            self._ops.append((_CONVERSATION_UPSERT, (name, key, pickle.dumps(new_state, PICKLE_PROTOCOL))))
+        await self._schedule_write()
+
+    async def _drop(self, kind, owner_id):
+        self._snapshots.pop((kind, owner_id), None)
+        self._ops.append((_PERSIST_DROP, (kind, owner_id)))
+        await self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        await self._drop("user", user_id)
+
+    async def drop_chat_data(self, chat_id):
+        await self._drop("chat", chat_id)
+
+    async def flush(self):
+        await self._schedule_write()
+        async with self._write_lock:
+            pass
+
+
+# --- Callback Data ---
+
+CALLBACK_CODEC_VERSION = 1
+
+# Rute tombol inline: nama -> (id tetap, jumlah argumen integer). Id tidak boleh diubah atau dipakai
+# ulang, karena tombol lama di chat pengguna tetap membawa id tersebut.
+CALLBACK_ROUTES = {
+    "main_menu": (1, 0),
+    "list_kategori": (2, 0),
+    "list_produk": (3, 1),  # kunci kategori
+    "beli": (4, 2),  # id produk, sidik jari produk
+    "konfirmasi_beli": (5, 2),  # id produk, sidik jari produk
+    "my_account": (6, 0),
+    "deposit": (7, 0),
+    "deposit_amount": (9, 1),  # indeks di DEPOSIT_AMOUNTS
+    "my_account_older": (8, 2),  # posisi transaksi terakhir yang tampil: detik epoch, id
+    "admin_main": (20, 0),
+    "admin_manage_users": (21, 0),
+    "admin_users_page": (22, 2),  # arah (0 = berikutnya, 1 = sebelumnya), id kursor
+    "admin_user_details": (23, 1),  # id pengguna
+    "admin_manage_products": (24, 0),
+    "admin_add_product": (25, 0),
+    "admin_user_balance": (26, 1),  # id pengguna
+    "admin_user_search": (27, 0),
+    "admin_broadcast": (28, 0),
+    "admin_import_stock": (29, 0),
+    "admin_reports": (30, 0),
+    "admin_report_hourly": (31, 0),
+    "admin_report_top": (32, 1),  # periode: 0 hari ini, 1 bulan ini
+}
+CALLBACK_ROUTE_NAMES = {route_id: name for name, (route_id, _) in CALLBACK_ROUTES.items()}
+
+def callback_data(route, *args):
+    """Menyusun callback_data ringkas: varint versi codec, id rute, dan argumen, lalu base64 urlsafe.
+
+    Panjangnya tidak bergantung pada nama kategori/produk (biasanya < 16 karakter),
+    jadi batas 64 byte Telegram tidak pernah terlampaui.
+    """
+    out = bytearray()
+    for value in (CALLBACK_CODEC_VERSION, CALLBACK_ROUTES[route][0], *args):
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return base64.urlsafe_b64encode(out).rstrip(b"=").decode()
+
+@lru_cache(maxsize=4096)
+def decode_callback(data):
+    """Mengembalikan (nama rute, argumen) atau None jika data rusak, usang, atau berformat lama."""
+    try:
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    values, value, shift = [], 0, 0
+    for byte in raw:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value, shift = 0, 0
+    if shift or len(values) < 2 or values[0] != CALLBACK_CODEC_VERSION:
+        return None
+    name = CALLBACK_ROUTE_NAMES.get(values[1])
+    if name is None or len(values) - 2 != CALLBACK_ROUTES[name][1]:
+        return None
+    return name, tuple(values[2:])
+
+def callback_pattern(route):
+    """Pattern untuk CallbackQueryHandler yang cocok dengan satu rute (dipakai entry point percakapan)."""
+    def matches(data):
+        decoded = decode_callback(data) if isinstance(data, str) else None
+        return decoded is not None and decoded[0] == route
+    return matches
+
+def category_key(category):
+    """Kunci integer stabil untuk nama kategori (sama di semua worker dan setelah restart)."""
+    return zlib.crc32(category.encode())
+
+def product_fingerprint(product):
+    """Sidik jari 16-bit dari data produk yang tampil di tombol. Tombol yang dibuat sebelum nama,
+    harga, atau deskripsi berubah akan ditolak alih-alih membeli dengan data yang sudah tidak berlaku."""
+    fields = (product['product_code'], product['name'], product['category'], product['description'], product['price'])
+    return zlib.crc32("\0".join(map(str, fields)).encode()) & 0xFFFF
+
+
+# --- Cache Katalog ---
+
+class CatalogCache:
+    """Salinan katalog produk di memori beserta keyboard yang sudah dirender.
+
+    Katalog hanya berubah lewat aksi admin dan penjualan, sedangkan sebagian besar
+    trafik adalah menjelajah menu. Dengan cache ini, menjelajah kategori/produk
+    tidak menyentuh database sama sekali.
+    """
+
+    def __init__(self):
+        self.categories = []
+        self.products_by_category = {}
+        self.products_by_code = {}
+        self.products_by_id = {}
+        self.categories_by_key = {}
+        self.categories_markup = None
+        self.category_markups = {}
+        self.confirmation_views = {}
+        self.version = None
+
+    async def load(self, announce=True):
+        """Memuat ulang seluruh katalog dari database."""
+        # Versi dibaca lebih dulu: perubahan yang terjadi selama memuat akan terlihat di sync() berikutnya.
+        self.version = (await db.fetchone("SELECT version FROM catalog_version WHERE id = 1"))[0]
+        rows = await db.fetchall("SELECT * FROM products ORDER BY category, name")
+        self.products_by_category = {}
+        self.products_by_code = {}
+        self.products_by_id = {}
+        self.confirmation_views = {}
+        for row in rows:
+            product = dict(row)
+            product['fingerprint'] = product_fingerprint(product)
+            self.products_by_category.setdefault(product['category'], []).append(product)
+            self.products_by_code[product['product_code']] = product
+            self.products_by_id[product['id']] = product
+            self._render_confirmation(product)
+        product_search.clear()
+        self.categories = sorted(self.products_by_category)
+        self._index_categories()
+        self.category_markups = {}
+        for category in self.categories:
+            self._render_category(category)
+        self._render_categories()
+        if announce:
+            logger.info(f"Katalog dimuat: {len(self.products_by_code)} produk dalam {len(self.categories)} kategori.")
+
+    async def sync(self):
+        """Mengambil perubahan dari proses lain. Katalog dimuat ulang penuh (dan cache pencarian
+        dikosongkan) hanya jika data produk berubah; selain itu hanya penghitung stok yang disalin."""
+        version = (await db.fetchone("SELECT version FROM catalog_version WHERE id = 1"))[0]
+        if version != self.version:
+            await self.load(announce=False)
+            return
+        for row in await db.fetchall("SELECT product_code, stock_numeric FROM products"):
+            self.set_stock(row['product_code'], row['stock_numeric'])
+
+    async def refresh_category(self, category):
+        """Memuat ulang satu kategori saja, misalnya setelah admin menambah produk."""
+        for product in self.products_by_category.pop(category, []):
+            self.products_by_code.pop(product['product_code'], None)
+            self.products_by_id.pop(product['id'], None)
+            self.confirmation_views.pop(product['product_code'], None)
+        self.category_markups.pop(category, None)
+
+        products = [dict(row) for row in await get_products_by_category(category)]
+        for product in products:
+            product['fingerprint'] = product_fingerprint(product)
+        if products:
+            self.products_by_category[category] = products
+            for product in products:
+                self.products_by_code[product['product_code']] = product
+                self.products_by_id[product['id']] = product
+                self._render_confirmation(product)
+            self._render_category(category)
+        product_search.clear()
+        if sorted(self.products_by_category) != self.categories:
+            self.categories = sorted(self.products_by_category)
+            self._index_categories()
+            self._render_categories()
+
+    def set_stock(self, product_code, count):
+        """Memperbarui penghitung stok produk; keyboard dirender ulang hanya saat status habis berubah."""
+        product = self.products_by_code.get(product_code)
+        if product is None:
+            return
+        was_available = product['stock_numeric'] > 0
+        product['stock_numeric'] = max(count, 0)
+        if was_available != (product['stock_numeric'] > 0):
+            self._render_category(product['category'])
+            product_search.availability_changed()
+
+    def adjust_stock(self, product_code, delta):
+        product = self.products_by_code.get(product_code)
+        if product is not None:
+            self.set_stock(product_code, product['stock_numeric'] + delta)
+
+    def _index_categories(self):
+        self.categories_by_key = {}
+        for category in self.categories:
+            key = category_key(category)
+            if key in self.categories_by_key:
+                logger.warning(f"Kunci kategori bentrok: '{category}' dan '{self.categories_by_key[key]}'.")
+            self.categories_by_key[key] = category
+
+    def _render_categories(self):
+        keyboard = [[InlineKeyboardButton(cat, callback_data=callback_data("list_produk", category_key(cat)))]
+                    for cat in self.categories]
+        keyboard.append([InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("main_menu"))])
+        self.categories_markup = InlineKeyboardMarkup(keyboard)
+
+    def _render_category(self, category):
+        keyboard = []
+        for p in self.products_by_category[category]:
+            label = f"{p['name']} - Rp{p['price']:,.0f}"
+            if p['stock_numeric'] <= 0:
+                label += " (Habis)"
+            keyboard.append([InlineKeyboardButton(label, callback_data=callback_data("beli", p['id'], p['fingerprint']))])
+        keyboard.append([InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("list_kategori"))])
+        self.category_markups[category] = InlineKeyboardMarkup(keyboard)
+
+    def _render_confirmation(self, product):
+        text = (f"<b>KONFIRMASI PESANAN</b>\n\nAnda akan membeli:\n<b>{product['name']}</b>\n\n"
+                f"Harga: <b>Rp{product['price']:,.0f}</b>\nDeskripsi: {product['description']}\n\nLanjutkan pesanan?")
+        keyboard = [[InlineKeyboardButton("✅ YA, LANJUTKAN", callback_data=callback_data(
+                        "konfirmasi_beli", product['id'], product['fingerprint']))],
+                    [InlineKeyboardButton("❌ BATALKAN", callback_data=callback_data(
+                        "list_produk", category_key(product['category'])))] ]
+        self.confirmation_views[product['product_code']] = (text, InlineKeyboardMarkup(keyboard))
+
+
+catalog = CatalogCache()
+
+
+# --- Pencarian Produk (Inline Mode) ---
+
+def _search_terms(text):
+    """Memecah teks pencarian menjadi kata (huruf/angka) kecil; tanda baca diabaikan."""
+    return "".join(ch if ch.isalnum() else " " for ch in text.lower()).split()
+
+def _fts_search(conn, match, limit):
+    # Bobot bm25 per kolom (name, description, category): nama paling menentukan. Hanya
+    # INLINE_RANK_CANDIDATES kecocokan pertama yang diberi skor, agar awalan yang sangat umum
+    # ("n", "pre") pada katalog besar tetap cepat; kata kunci yang lebih spesifik tetap terurut penuh.
+    return [row[0] for row in conn.execute("""
+        SELECT rowid FROM (
+            SELECT rowid, bm25(products_fts, 10.0, 1.0, 4.0) AS score FROM products_fts
+            WHERE products_fts MATCH ? LIMIT ?
+        ) ORDER BY score LIMIT ?
+    """, (match, INLINE_RANK_CANDIDATES, limit))]
+
+class ProductSearch:
+    """Pencarian produk untuk inline mode: FTS5 dengan pencocokan awalan, hasil di-cache per string.
+
+    Cache berisi id produk dan dikosongkan setiap kali data produk berubah; harga dan status stok
+    selalu diambil dari cache katalog saat hasil dirender, jadi perubahan stok tidak mengosongkannya.
+    """
+
+    def __init__(self, maxsize=INLINE_CACHE_SIZE):
+        self.fts_enabled = False
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._haystacks = None  # Teks produk yang sudah dinormalisasi, hanya untuk pencarian cadangan
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self._cache.clear()
+        self._haystacks = None
+
+    def availability_changed(self):
+        # Hanya daftar tanpa kata kunci yang menyaring produk habis.
+        self._cache.pop((), None)
+
+    async def search(self, text):
+        """Mengembalikan daftar id produk yang cocok, terurut dari yang paling relevan."""
+        terms = tuple(_search_terms(text))
+        ids = self._cache.get(terms)
+        if ids is not None:
+            self._cache.move_to_end(terms)
+            self.hits += 1
+            return ids
+        self.misses += 1
+        if not terms:
+            ids = [p['id'] for p in catalog.products_by_id.values() if p['stock_numeric'] > 0][:INLINE_RESULTS_LIMIT]
+        elif self.fts_enabled:
+            # Setiap kata diberi tanda kutip (aman dari sintaks FTS) dan * untuk pencocokan awalan.
+            match = " ".join(f'"{term}"*' for term in terms)
+            ids = await db.run(_fts_search, match, INLINE_RESULTS_LIMIT)
+        else:
+            ids = self._scan(terms)
+        self._cache[terms] = ids
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return ids
+
+    def _scan(self, terms):
+        """Cadangan tanpa FTS5: setiap kata harus menjadi awalan salah satu kata di produk."""
+        if self._haystacks is None:
+            self._haystacks = [
+                (product['id'], " " + " ".join(_search_terms(
+                    f"{product['name']} {product['description']} {product['category']}")))
+                for product in catalog.products_by_id.values()
+            ]
+        needles = [f" {term}" for term in terms]
+        ids = []
+        for product_id, haystack in self._haystacks:
+            if all(needle in haystack for needle in needles):
+                ids.append(product_id)
+                if len(ids) >= INLINE_RESULTS_LIMIT:
+                    break
+        return ids
+
+
+product_search = ProductSearch()
+
+metrics.register_callback("bot_inline_cache_hits_total", "counter", "Pencarian inline yang dijawab dari cache.",
+                          lambda: product_search.hits)
+metrics.register_callback("bot_inline_cache_misses_total", "counter", "Pencarian inline yang menjalankan query.",
+                          lambda: product_search.misses)
+
+def _inline_result(product, bot_username):
+    stock = "Habis" if product['stock_numeric'] <= 0 else f"Stok {product['stock_numeric']}"
+    text = (f"<b>{escape(product['name'])}</b>\nHarga: <b>Rp{product['price']:,.0f}</b>\n"
+            f"Kategori: {escape(product['category'])}\n\n{escape(product['description'] or '')}")
+    return InlineQueryResultArticle(
+        id=str(product['id']),
+        title=f"{product['name']} - Rp{product['price']:,.0f}",
+        description=f"{product['category']} • {stock}",
+        input_message_content=InputTextMessageContent(text, parse_mode='HTML'),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+            "🛒 Beli", url=f"https://t.me/{bot_username}?start=beli_{product['id']}")]]),
+    )
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Menjawab @bot <kata kunci> dengan daftar produk yang cocok."""
+    inline_query = update.inline_query
+    ids = await product_search.search(inline_query.query)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    page = [catalog.products_by_id[i] for i in ids[offset:offset + INLINE_PAGE_SIZE] if i in catalog.products_by_id]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(ids) else ""
+    await inline_query.answer([_inline_result(p, context.bot.username) for p in page],
+                              cache_time=30, next_offset=next_offset)
+
+async def show_product_from_link(chat_id, product_id):
+    """Membuka konfirmasi pembelian dari deep link hasil pencarian inline (/start beli_<id>)."""
+    product = catalog.products_by_id.get(product_id)
+    if product is None:
+        sender.post(chat_id, "Produk tidak ditemukan.")
+        return
+    text, reply_markup = catalog.confirmation_views[product['product_code']]
+    sender.post(chat_id, text, reply_markup=reply_markup, parse_mode='HTML')
+
+
+# --- Pengiriman Pesan Keluar ---
+
+PRIORITY_HIGH = 0  # Struk pembelian, notifikasi saldo, balasan langsung
+PRIORITY_BULK = 1  # Broadcast
+
+class TokenBucket:
+    """Token bucket sederhana; waktu diberikan oleh pemanggil (time.monotonic())."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Waktu tunggu (detik) sampai satu token tersedia, tanpa mengambilnya."""
+        self._refill(now)
+        # `updated` bisa berada di masa depan jika token sudah dipesan untuk waktu tertentu.
+        return max(self.updated - now, 0.0) + max((1 - self.tokens) / self.rate, 0.0)
+
+    def reserve(self, now):
+        """Mengambil satu token dan mengembalikan berapa lama harus menunggu sebelum memakainya.
+
+        Token boleh negatif (dipesan di muka), sehingga beberapa pekerja yang memesan
+        bersamaan otomatis mendapat giliran berurutan.
+        """
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, seconds, now):
+        """Menahan bucket selama `seconds` (dipakai saat Telegram membalas 429)."""
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _SendJob:
+    __slots__ = ("chat_id", "kwargs", "future", "attempts")
+
+    def __init__(self, chat_id, kwargs, future):
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+
+class OutboundSender:
+    """Penjadwal pengiriman pesan dengan batas global, batas per chat, dan jalur prioritas.
+
+    Semua pemanggilan send_message melewati antrean ini. Pesan prioritas tinggi
+    (struk pembelian) selalu didahulukan dari pesan broadcast, dan balasan 429
+    (RetryAfter) menahan seluruh pengiriman selama waktu yang diminta Telegram.
+    """
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, global_rate=GLOBAL_SEND_RATE, per_chat_rate=PER_CHAT_SEND_RATE, workers=SENDER_WORKERS):
+        self.per_chat_rate = per_chat_rate
+        self.workers = workers
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._queue = None
+        self._seq = itertools.count()
+        self._tasks = []
+        self._outstanding = set()  # Future pesan yang belum selesai (antre, ditunda, atau sedang dikirim)
+        self._delayed = {}  # Job yang ditunda (batas per chat atau 429) -> handle call_later-nya
+        self.bot = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self, bot):
+        self.bot = bot
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job, handle in self._delayed.items():
+            handle.cancel()
+            job.future.cancel()
+        self._delayed.clear()
+        while not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            job.future.cancel()
+
+    async def drain(self, timeout=SENDER_DRAIN_TIMEOUT):
+        """Menunggu pesan yang sudah diantrekan selesai dikirim, maksimal timeout detik.
+
+        Dipanggil saat bot berhenti, sebelum koneksi HTTP bot ditutup, karena handler
+        tidak lagi menunggu pesannya terkirim (lihat post()).
+        """
+        if self._outstanding:
+            await asyncio.wait(set(self._outstanding), timeout=timeout)
+
+    @property
+    def pending(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def enqueue(self, chat_id, text, priority=PRIORITY_HIGH, **kwargs):
+        """Menjadwalkan pesan dan mengembalikan Future berisi Message hasil kirim."""
+        future = asyncio.get_running_loop().create_future()
+        kwargs['text'] = text
+        self._outstanding.add(future)
+        future.add_done_callback(self._outstanding.discard)
+        self._push(priority, _SendJob(chat_id, kwargs, future))
+        return future
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_HIGH, **kwargs):
+        return await self.enqueue(chat_id, text, priority, **kwargs)
+
+    def post(self, chat_id, text, priority=PRIORITY_HIGH, **kwargs):
+        """Seperti enqueue(), untuk handler yang tidak butuh Message hasilnya: handler selesai tanpa
+        menunggu token bucket, dan kegagalan kirim hanya dicatat di log."""
+        future = self.enqueue(chat_id, text, priority, **kwargs)
+
+        def log_failure(done):
+            if not done.cancelled() and done.exception():
+                logger.warning(f"Pesan ke {chat_id} gagal dikirim: {done.exception()}")
+
+        future.add_done_callback(log_failure)
+        return future
+
+    def _push(self, priority, job, seq=None):
+        # seq menjaga urutan FIFO di dalam satu prioritas (dan tetap dipakai saat job ditunda ulang).
+        self._queue.put_nowait((priority, next(self._seq) if seq is None else seq, job))
+
+    def _push_later(self, delay, priority, job, seq):
+        def push():
+            del self._delayed[job]
+            self._push(priority, job, seq)
+
+        self._delayed[job] = asyncio.get_running_loop().call_later(delay, push)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Buang bucket chat yang sudah penuh kembali; perilakunya sama dengan bucket baru.
+                now = time.monotonic()
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_idle(now)}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, 1)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            priority, seq, job = await self._queue.get()
+            bucket = self._chat_bucket(job.chat_id)
+            now = time.monotonic()
+            wait = bucket.delay(now)
+            if wait > 0:
+                # Chat ini belum boleh dikirimi; tunda tanpa menghalangi chat lain.
+                self._push_later(wait, priority, job, seq)
+                continue
+            wait = self._global.reserve(now)
+            # Token chat dipesan untuk waktu kirim sebenarnya (setelah antre di bucket global).
+            bucket.reserve(now + wait)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                message = await self.bot.send_message(chat_id=job.chat_id, **job.kwargs)
+            except RetryAfter as e:
+                job.attempts += 1
+                self.retried += 1
+                logger.warning(f"Telegram membatasi pengiriman (429), menunggu {e.retry_after} detik.")
+                self._global.penalize(e.retry_after, time.monotonic())
+                if job.attempts < self.MAX_ATTEMPTS:
+                    self._push_later(e.retry_after, priority, job, seq)
+                else:
+                    self.failed += 1
+                    if not job.future.done():
+                        job.future.set_exception(e)
+            except TelegramError as e:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                # Worker tetap berjalan; pemanggil (misalnya broadcast) menerima error-nya lewat future.
+                self.failed += 1
+                logger.error(f"Pengiriman pesan ke {job.chat_id} gagal dengan error tak terduga: {e!r}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.sent += 1
+                if not job.future.done():
+                    job.future.set_result(message)
+
+
+sender = OutboundSender()
+
+metrics.register_callback("bot_sender_sent_total", "counter", "Pesan keluar yang terkirim.", lambda: sender.sent)
+metrics.register_callback("bot_sender_failed_total", "counter", "Pesan keluar yang gagal.", lambda: sender.failed)
+metrics.register_callback("bot_sender_retried_total", "counter", "Pesan keluar yang diulang setelah 429.",
+                          lambda: sender.retried)
+metrics.register_callback("bot_sender_queue", "gauge", "Pesan yang menunggu di antrean pengirim.",
+                          lambda: sender.pending)
+
+
+# --- Cache Tampilan Pesan ---
+
+class ViewCache:
+    """LRU + TTL berisi hash tampilan (teks + markup) terakhir untuk setiap (chat_id, message_id)."""
+
+    def __init__(self, maxsize=VIEW_CACHE_SIZE, ttl=VIEW_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self.hits = 0  # Edit dilewati karena tampilan sama
+        self.not_modified = 0  # Edit terkirim tetapi Telegram menjawab "message is not modified"
+        self.misses = 0
+
+    def is_current(self, key, signature, now=None):
+        entry = self._items.get(key)
+        if entry is None:
+            return False
+        stored, expires = entry
+        if expires < (now or time.monotonic()):
+            del self._items[key]
+            return False
+        self._items.move_to_end(key)
+        return stored == signature
+
+    def store(self, key, signature, now=None):
+        self._items[key] = (signature, (now or time.monotonic()) + self.ttl)
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def forget(self, key):
+        self._items.pop(key, None)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.not_modified + self.misses
+        return (self.hits + self.not_modified) / total if total else 0.0
+
+
+view_cache = ViewCache()
+
+metrics.register_callback("bot_view_cache_hits_total", "counter", "Edit pesan yang dilewati karena tampilannya sama.",
+                          lambda: view_cache.hits)
+metrics.register_callback("bot_view_cache_not_modified_total", "counter",
+                          "Edit pesan yang dijawab Telegram dengan 'message is not modified'.",
+                          lambda: view_cache.not_modified)
+metrics.register_callback("bot_view_cache_misses_total", "counter", "Edit pesan yang benar-benar dikirim.",
+                          lambda: view_cache.misses)
+
+
+class ViewCachingBot(ExtBot):
+    """ExtBot yang tidak mengirim editMessageText jika pesan tujuan sudah menampilkan hal yang sama.
+
+    Semua edit (termasuk query.edit_message_text) melewati method ini. Jika dilewati,
+    hasilnya True, sama seperti jawaban Bot API untuk pesan inline.
+    """
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None, **kwargs):
+        if chat_id is None or message_id is None:
+            return await super().edit_message_text(text, chat_id, message_id, inline_message_id, **kwargs)
+        key = (chat_id, message_id)
+        markup = kwargs.get("reply_markup")
+        signature = hash((text, str(kwargs.get("parse_mode")), str(kwargs.get("disable_web_page_preview")),
+                          markup.to_json() if markup else None, str(kwargs.get("entities"))))
+        if view_cache.is_current(key, signature):
+            view_cache.hits += 1
+            return True
+        try:
+            result = await super().edit_message_text(text, chat_id, message_id, inline_message_id, **kwargs)
+        except BadRequest as e:
+            if "message is not modified" in e.message.lower():
+                view_cache.not_modified += 1
+                view_cache.store(key, signature)
+                return True
+            view_cache.forget(key)
+            raise
+        except TelegramError:
+            view_cache.forget(key)
+            raise
+        view_cache.misses += 1
+        view_cache.store(key, signature)
+        return result
+
+
 # --- Handler Perintah Pengguna ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Menyapa pengguna dan menampilkan menu utama."""
     user = update.effective_user
-    if not get_user(user.id):
-        register_user(user)
-    
+    if not await get_user(user.id):
+        await register_user(user)
+
+    # Deep link dari hasil pencarian inline: t.me/<bot>?start=beli_<id produk>
+    if context.args and context.args[0].startswith("beli_") and context.args[0][5:].isdigit():
+        await show_product_from_link(user.id, int(context.args[0][5:]))
+        return ConversationHandler.END
+
     await send_main_menu(user.id, context)
     return ConversationHandler.END
 
 async def send_main_menu(chat_id, context, message_id=None):
     """Mengirim atau mengedit pesan untuk menampilkan menu utama."""
-    db_user = get_user(chat_id)
+    db_user = await get_user(chat_id)
     
     # Pemeriksaan keamanan untuk mencegah error jika pengguna tidak ditemukan
     if not db_user:
         logger.error(f"Kritis: Gagal mengambil data pengguna untuk chat_id {chat_id} di send_main_menu.")
-        await context.bot.send_message(chat_id=chat_id, text="Maaf, terjadi kesalahan saat memuat data Anda. Silakan coba lagi dengan /start.")
+        sender.post(chat_id, "Maaf, terjadi kesalahan saat memuat data Anda. Silakan coba lagi dengan /start.")
         return
 
     shop_name_str = str(SHOP_NAME) if SHOP_NAME is not None else "Toko Bot"
@@ -200,15 +2468,15 @@ async def send_main_menu(chat_id, context, message_id=None):
     
     keyboard = []
     if config.get("ENABLE_DIGITAL_PRODUCTS"):
-        keyboard.append([InlineKeyboardButton("📦 Beli Produk Digital", callback_data="list_kategori")])
+        keyboard.append([InlineKeyboardButton("📦 Beli Produk Digital", callback_data=callback_data("list_kategori"))])
     
     keyboard.append([
-        InlineKeyboardButton("💰 TopUp Saldo", callback_data="deposit"),
-        InlineKeyboardButton("🔑 Akunku", callback_data="my_account")
+        InlineKeyboardButton("💰 TopUp Saldo", callback_data=callback_data("deposit")),
+        InlineKeyboardButton("🔑 Akunku", callback_data=callback_data("my_account"))
     ])
 
     if chat_id in ADMIN_IDS:
-        keyboard.append([InlineKeyboardButton("⚙️ Panel Admin", callback_data="admin_main")])
+        keyboard.append([InlineKeyboardButton("⚙️ Panel Admin", callback_data=callback_data("admin_main"))])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -217,7 +2485,7 @@ async def send_main_menu(chat_id, context, message_id=None):
     if message_id:
         await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=full_message, reply_markup=reply_markup, parse_mode='HTML')
     else:
-        await context.bot.send_message(chat_id=chat_id, text=full_message, reply_markup=reply_markup, parse_mode='HTML')
+        sender.post(chat_id, full_message, reply_markup=reply_markup, parse_mode='HTML')
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Membatalkan proses saat ini (misal: tambah produk)."""
@@ -230,148 +2498,317 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Handler Callback Query (Tombol Inline) ---
 
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Menangani input dari tombol inline."""
+    """Menangani input dari tombol inline lewat tabel rute CALLBACK_HANDLERS."""
     query = update.callback_query
     await query.answer()
-    
-    data = query.data
-    chat_id = query.message.chat_id
-    message_id = query.message.message_id
-
-    # Routing
-    if data == "main_menu":
-        await send_main_menu(chat_id, context, message_id)
-    elif data == "list_kategori":
-        await show_categories(query)
-    elif data.startswith("list_produk:"):
-        await show_products_in_category(query)
-    elif data.startswith("beli:"):
-        await show_purchase_confirmation(query)
-    elif data.startswith("konfirmasi_beli:"):
-        await process_purchase(query, context)
-    elif data == "my_account":
-        await show_my_account(query)
-    elif data == "deposit":
-        await query.edit_message_text(text="Fitur TopUp Saldo sedang dalam pengembangan. Untuk saat ini, silakan hubungi admin.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data="main_menu")]]))
-    
-    # Admin routing
-    elif data == "admin_main":
-        await send_admin_panel(query)
-    elif data == "admin_manage_users":
-        await admin_list_users(query)
-    elif data.startswith("admin_user_details:"):
-        await admin_show_user_details(query)
-    elif data.startswith("admin_user_balance:"):
-        await admin_ask_balance_amount(query, context)
-    elif data == "admin_manage_products":
-        await send_product_management_menu(query)
-    elif data == "admin_add_product":
-        await admin_ask_product_category(query, context)
+
+    decoded = decode_callback(query.data)
+    if decoded is None:
+        await show_expired_button(query)
+        return
+    route, args = decoded
+    if route.startswith("admin_") and query.from_user.id not in ADMIN_IDS:
+        return
+    handler = CALLBACK_HANDLERS.get(route)
+    if handler is not None:
+        await handler(query, context, *args)
+
+async def show_expired_button(query):
+    await query.edit_message_text(
+        text="Tombol ini sudah tidak berlaku. Silakan buka menu lagi.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Menu Utama", callback_data=callback_data("main_menu"))]]))
+
+async def admin_reset_user_list(query, context):
+    context.user_data.pop('admin_user_search', None)
+    await admin_list_users(query, context)
+
+# Rute yang ditangani entry point ConversationHandler (admin_add_product, admin_user_balance, ...)
+# tidak ada di sini; handler-nya dipilih lewat callback_pattern().
+CALLBACK_HANDLERS = {
+    "main_menu": lambda query, context: send_main_menu(query.message.chat_id, context, query.message.message_id),
+    "list_kategori": lambda query, context: show_categories(query),
+    "list_produk": lambda query, context, key: show_products_in_category(query, key),
+    "beli": lambda query, context, product_id, fingerprint: show_purchase_confirmation(query, product_id, fingerprint),
+    "konfirmasi_beli": lambda query, context, product_id, fingerprint: process_purchase(query, context, product_id, fingerprint),
+    "my_account": lambda query, context: show_my_account(query),
+    "my_account_older": lambda query, context, seconds, trx_id: show_my_account(query, (seconds, trx_id)),
+    "deposit": lambda query, context: show_deposit_info(query),
+    "deposit_amount": lambda query, context, index: create_deposit(query, index),
+    "admin_main": lambda query, context: send_admin_panel(query),
+    "admin_manage_users": admin_reset_user_list,
+    "admin_users_page": lambda query, context, direction, cursor_id: admin_list_users(
+        query, context, cursor_id, backward=(direction == 1)),
+    "admin_user_details": lambda query, context, user_id: admin_show_user_details(query, user_id),
+    "admin_manage_products": lambda query, context: send_product_management_menu(query),
+    "admin_reports": lambda query, context: admin_show_report(query, db.run(render_sales_summary)),
+    "admin_report_hourly": lambda query, context: admin_show_report(query, db.run(render_hourly_report)),
+    "admin_report_top": lambda query, context, period: admin_show_report(
+        query, render_top_report("month" if period == 1 else "day")),
+}
 
 async def show_categories(query):
-    categories = get_categories()
-    if not categories:
-        await query.edit_message_text(text="Maaf, belum ada produk.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data="main_menu")]]))
+    if not catalog.categories:
+        await query.edit_message_text(text="Maaf, belum ada produk.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("main_menu"))]]))
         return
-    keyboard = [[InlineKeyboardButton(cat, callback_data=f"list_produk:{cat}")] for cat in categories]
-    keyboard.append([InlineKeyboardButton("⬅️ Kembali", callback_data="main_menu")])
-    await query.edit_message_text(text="Silakan pilih kategori:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text(text="Silakan pilih kategori:", reply_markup=catalog.categories_markup)
 
-async def show_products_in_category(query):
-    category = query.data.split(":")[1]
-    products = get_products_by_category(category)
-    if not products:
-        await query.edit_message_text(text=f"Tidak ada produk di kategori {category}.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data="list_kategori")]]))
+async def show_products_in_category(query, key):
+    category = catalog.categories_by_key.get(key)
+    reply_markup = catalog.category_markups.get(category)
+    if reply_markup is None:
+        await query.edit_message_text(text="Kategori ini sudah tidak tersedia.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("list_kategori"))]]))
         return
-    keyboard = [[InlineKeyboardButton(f"{p['name']} - Rp{p['price']:,.0f}", callback_data=f"beli:{p['product_code']}")] for p in products]
-    keyboard.append([InlineKeyboardButton("⬅️ Kembali", callback_data="list_kategori")])
-    await query.edit_message_text(text=f"Produk dalam kategori *{category}*:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text=f"Produk dalam kategori *{category}*:", reply_markup=reply_markup, parse_mode='Markdown')
+
+def _product_for_button(product_id, fingerprint):
+    """Produk untuk tombol beli/konfirmasi, atau None jika produk sudah dihapus atau berubah sejak tombol dibuat."""
+    product = catalog.products_by_id.get(product_id)
+    if product is None or product['fingerprint'] != fingerprint:
+        return None
+    return product
+
+async def show_product_changed(query):
+    await query.edit_message_text(
+        text="Produk ini sudah berubah atau tidak tersedia lagi. Silakan pilih ulang dari daftar produk.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("list_kategori"))]]))
+
+async def show_purchase_confirmation(query, product_id, fingerprint):
+    product = _product_for_button(product_id, fingerprint)
+    view = catalog.confirmation_views.get(product['product_code']) if product else None
+    if view is None:
+        await show_product_changed(query)
+        return
+    text, reply_markup = view
+    await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode='HTML')
 
-async def show_purchase_confirmation(query):
-    product_code = query.data.split(":")[1]
-    product = get_product_by_code(product_code)
-    if not product:
-        await query.edit_message_text(text="Produk tidak ditemukan.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data="list_kategori")]]))
+PURCHASE_LEDGER_SQL = (
+    "SELECT r.item, r.transaction_id, t.product_name FROM purchase_requests r "
+    "LEFT JOIN transactions t ON t.transaction_id = r.transaction_id "
+    "WHERE r.callback_query_id = ? OR r.message_ref = ?"
+)
+
+def _find_purchase(conn, callback_query_id, message_ref):
+    """Hasil asli pembelian yang sudah tercatat di ledger untuk callback/pesan ini, atau None."""
+    previous = conn.execute(PURCHASE_LEDGER_SQL, (callback_query_id, message_ref)).fetchone()
+    if previous is None:
+        return None
+    return {'status': 'SUCCESS', 'item': previous['item'], 'transaction_id': previous['transaction_id'],
+            'product_name': previous['product_name'], 'balance': None, 'duplicate': True}
+
+def _execute_purchase(conn, user_id, product, callback_query_id, message_ref):
+    """Cek ledger, potong saldo bersyarat, klaim stok, dan catat transaksi dalam satu transaksi.
+
+    Jika callback query atau pesan konfirmasi yang sama sudah pernah berhasil diproses,
+    hasil aslinya dikembalikan tanpa menulis apa pun. Hasil sukses dan gagal membawa baris
+    users terbaru ('account') untuk user_cache.apply().
+    """
+    previous = _find_purchase(conn, callback_query_id, message_ref)
+    if previous:
+        return previous
+
+    conn.execute("SAVEPOINT purchase")
+    account = _debit_purchase(conn, user_id, product['price'])
+    if account is None:
+        conn.execute("RELEASE purchase")
+        account = dict(conn.execute(
+            "SELECT id, balance, transaction_count, version FROM users WHERE id = ?", (user_id,)
+        ).fetchone())
+        return {'status': 'INSUFFICIENT_BALANCE', 'balance': account['balance'], 'account': account}
+    item = _claim_stock_item(conn, product['id'], user_id)
+    if item is None:
+        conn.execute("ROLLBACK TO purchase")  # Saldo dikembalikan; tidak ada yang terjual
+        conn.execute("RELEASE purchase")
+        return {'status': 'OUT_OF_STOCK'}
+    conn.execute("RELEASE purchase")
+    trx_id = _insert_purchase(conn, user_id, product, item)
+    conn.execute(
+        "INSERT INTO purchase_requests (callback_query_id, message_ref, user_id, product_id, transaction_id, item) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (callback_query_id, message_ref, user_id, product['id'], trx_id, item)
+    )
+    return {'status': 'SUCCESS', 'item': item, 'transaction_id': trx_id, 'product_name': product['name'],
+            'balance': account['balance'], 'account': account, 'duplicate': False}
+
+class RecentResults:
+    """Cache LRU kecil untuk hasil pembelian terbaru, agar callback ganda dijawab tanpa ke DB."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def get(self, *keys):
+        for key in keys:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        return None
+
+    def put(self, result, *keys):
+        for key in keys:
+            self._items[key] = result
+            self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+
+recent_purchases = RecentResults()
+
+def _purchase_success_text(product_name, item):
+    return (f"✅ <b>TRANSAKSI BERHASIL</b>\n\nTerima kasih telah membeli <b>{product_name}</b>.\n\n"
+            f"Berikut detail produk Anda:\n<pre>{item}</pre>")
+
+async def process_purchase(query, context, product_id, fingerprint):
+    # Pesan sukses tidak memiliki tombol, jadi satu pesan konfirmasi hanya bisa menghasilkan satu pembelian.
+    message_ref = f"{query.message.chat_id}:{query.message.message_id}"
+    # Ledger diperiksa sebelum cek produk/saldo/stok: callback yang dikirim ulang atau ketukan ganda
+    # harus menampilkan struk aslinya, walaupun pembelian itu sendiri menghabiskan stok atau saldo.
+    # recent_purchases hanya ada di memori proses ini (kosong setelah restart), jadi ledger DB tetap dibaca.
+    previous = recent_purchases.get(query.id, message_ref) or await db.run(_find_purchase, query.id, message_ref)
+    if previous:
+        recent_purchases.put(previous, query.id, message_ref)
+        await query.edit_message_text(text=_purchase_success_text(previous['product_name'], previous['item']),
+                                      parse_mode='HTML')
         return
-    text = (f"<b>KONFIRMASI PESANAN</b>\n\nAnda akan membeli:\n<b>{product['name']}</b>\n\n"
-            f"Harga: <b>Rp{product['price']:,.0f}</b>\nDeskripsi: {product['description']}\n\nLanjutkan pesanan?")
-    keyboard = [[InlineKeyboardButton("✅ YA, LANJUTKAN", callback_data=f"konfirmasi_beli:{product_code}")],
-                [InlineKeyboardButton("❌ BATALKAN", callback_data=f"list_produk:{product['category']}")] ]
-    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
 
-async def process_purchase(query, context):
-    product_code = query.data.split(":")[1]
-    product = get_product_by_code(product_code)
-    user = get_user(query.message.chat_id)
-    if not product or not user:
-        await query.edit_message_text(text="Terjadi kesalahan, produk atau pengguna tidak ditemukan.")
+    product = _product_for_button(product_id, fingerprint)
+    if not product:
+        await show_product_changed(query)
+        return
+    user = await get_user(query.message.chat_id)
+    if not user:
+        await query.edit_message_text(text="Terjadi kesalahan, pengguna tidak ditemukan.")
         return
 
     if user['balance'] < product['price']:
-        await query.edit_message_text(text=f"❌ Saldo Anda tidak mencukupi. Saldo: Rp{user['balance']:,.0f}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data=f"list_produk:{product['category']}")]]) )
+        # Saldo di cache bisa tertinggal dari top up yang diproses worker lain; cek ulang sebelum menolak.
+        user = await get_user(user['id'], fresh=True)
+    if user['balance'] < product['price']:
+        await query.edit_message_text(text=f"❌ Saldo Anda tidak mencukupi. Saldo: Rp{user['balance']:,.0f}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("list_produk", category_key(product['category'])))]]) )
         return
 
-    stock_data_list = (product['stock_data'] or "").split('|')
-    if not stock_data_list or stock_data_list[0] == '':
+    # Stok di cache katalog bisa tertinggal dari worker lain; yang menentukan adalah klaim bersyarat di DB.
+    result = await db.transaction(_execute_purchase, user['id'], product, query.id, message_ref)
+    if 'account' in result:
+        user_cache.apply(result['account'])
+    if result['status'] == 'INSUFFICIENT_BALANCE':
+        await query.edit_message_text(text=f"❌ Saldo Anda tidak mencukupi. Saldo: Rp{result['balance']:,.0f}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("list_produk", category_key(product['category'])))]]) )
+        return
+    if result['status'] == 'OUT_OF_STOCK':
+        catalog.set_stock(product['product_code'], 0)
         await query.edit_message_text(text="Maaf, stok produk ini habis.")
         return
-    
-    item_diberikan = stock_data_list.pop(0)
-    sisa_stok = "|".join(stock_data_list)
-    cursor.execute("UPDATE products SET stock_data = ? WHERE product_code = ?", (sisa_stok, product_code))
-    create_transaction(user['id'], product, item_diberikan)
-    
-    await query.edit_message_text(text=f"✅ <b>TRANSAKSI BERHASIL</b>\n\nTerima kasih telah membeli <b>{product['name']}</b>.\n\nBerikut detail produk Anda:\n<pre>{item_diberikan}</pre>", parse_mode='HTML')
-    updated_user = get_user(user['id'])
-    await context.bot.send_message(chat_id=user['id'], text=f"Saldo Anda sekarang: Rp{updated_user['balance']:,.0f}")
 
-async def show_my_account(query):
-    transactions = get_user_transactions(query.message.chat_id)
+    recent_purchases.put(result, query.id, message_ref)
+    await query.edit_message_text(text=_purchase_success_text(result['product_name'], result['item']), parse_mode='HTML')
+    if result['duplicate']:
+        return
+    catalog.adjust_stock(product['product_code'], -1)
+    sender.post(user['id'], f"Saldo Anda sekarang: Rp{result['balance']:,.0f}")
+
+async def show_my_account(query, before=None):
+    """Riwayat transaksi per halaman. Satu baris ekstra dibaca untuk mengetahui apakah ada halaman berikutnya."""
+    limit = ACCOUNT_HISTORY_PAGE_SIZE
+    transactions = await get_user_transactions(query.message.chat_id, limit + 1, before)
+    back = [InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("main_menu"))]
     if not transactions:
-        await query.edit_message_text(text="Anda belum memiliki riwayat transaksi.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data="main_menu")]]))
+        text = "Tidak ada transaksi yang lebih lama." if before else "Anda belum memiliki riwayat transaksi."
+        await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup([back]))
         return
-    
-    history_text = "📜 *10 Transaksi Terakhir Anda*\n\n"
+
+    has_more = len(transactions) > limit
+    transactions = transactions[:limit]
+    history_text = "📜 *Riwayat Transaksi Lebih Lama*\n\n" if before else f"📜 *{limit} Transaksi Terakhir Anda*\n\n"
     for trx in transactions:
         tgl = datetime.fromisoformat(trx['timestamp']).strftime('%d-%m-%y %H:%M')
         price_formatted = f"Rp{trx['price']:,.0f}"
         history_text += f"*{trx['product_name']}* - {price_formatted}\n"
         history_text += f"  _ID: {trx['transaction_id']}_\n"
         history_text += f"  _Tgl: {tgl}_\n\n"
-    
-    await query.edit_message_text(text=history_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data="main_menu")]]))
+
+    nav = []
+    if before:
+        nav.append(InlineKeyboardButton("🔝 Terbaru", callback_data=callback_data("my_account")))
+    if has_more:
+        nav.append(InlineKeyboardButton("Lebih Lama ➡️",
+                                        callback_data=callback_data("my_account_older", *_history_cursor(transactions[-1]))))
+    keyboard = [nav, back] if nav else [back]
+    await query.edit_message_text(text=history_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
 # --- Handler Admin ---
 
 async def send_admin_panel(query):
     keyboard = [
-        [InlineKeyboardButton("👥 Manajemen Pengguna", callback_data="admin_manage_users")],
-        [InlineKeyboardButton("📦 Manajemen Produk", callback_data="admin_manage_products")],
-        [InlineKeyboardButton("⬅️ Kembali ke Menu Utama", callback_data="main_menu")]
+        [InlineKeyboardButton("👥 Manajemen Pengguna", callback_data=callback_data("admin_manage_users"))],
+        [InlineKeyboardButton("📦 Manajemen Produk", callback_data=callback_data("admin_manage_products"))],
+        [InlineKeyboardButton("📢 Broadcast", callback_data=callback_data("admin_broadcast"))],
+        [InlineKeyboardButton("📈 Laporan Penjualan", callback_data=callback_data("admin_reports"))],
+        [InlineKeyboardButton("⬅️ Kembali ke Menu Utama", callback_data=callback_data("main_menu"))]
     ]
     await query.edit_message_text(text="⚙️ *Panel Admin*", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-async def admin_list_users(query):
-    users = get_all_users()
-    keyboard = [[InlineKeyboardButton(f"{u['first_name']} (@{u['username'] or 'N/A'})", callback_data=f"admin_user_details:{u['id']}")] for u in users]
-    keyboard.append([InlineKeyboardButton("⬅️ Kembali", callback_data="admin_main")])
-    await query.edit_message_text(text="Pilih pengguna untuk dikelola:", reply_markup=InlineKeyboardMarkup(keyboard))
+async def admin_list_users(query, context, cursor_id=0, backward=False):
+    text, reply_markup = await render_users_page(context, cursor_id, backward)
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+
+async def render_users_page(context, cursor_id=0, backward=False):
+    """Menyusun teks dan keyboard satu halaman daftar pengguna untuk panel admin."""
+    search = context.user_data.get('admin_user_search')
+    users, has_more = await get_users_page(cursor_id, backward, search)
+    keyboard = [[InlineKeyboardButton(f"{u['first_name']} (@{u['username'] or 'N/A'})", callback_data=callback_data("admin_user_details", u['id']))] for u in users]
+
+    # Tombol navigasi: halaman sebelumnya ada jika kita datang dari "berikutnya" (atau masih ada
+    # baris saat mundur), halaman berikutnya ada jika masih ada baris saat maju (atau saat mundur).
+    has_prev = has_more if backward else cursor_id > 0
+    has_next = True if backward else has_more
+    nav = []
+    if users and has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Sebelumnya", callback_data=callback_data("admin_users_page", 1, users[0]['id'])))
+    if users and has_next:
+        nav.append(InlineKeyboardButton("Berikutnya ➡️", callback_data=callback_data("admin_users_page", 0, users[-1]['id'])))
+    if nav:
+        keyboard.append(nav)
+
+    keyboard.append([InlineKeyboardButton("🔍 Cari Pengguna", callback_data=callback_data("admin_user_search"))])
+    keyboard.append([InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("admin_main"))])
+    if search:
+        text = f"Hasil pencarian '{search}':" if users else f"Tidak ada pengguna yang cocok dengan '{search}'."
+    else:
+        text = "Pilih pengguna untuk dikelola:"
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def admin_ask_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in ADMIN_IDS:
+        return ConversationHandler.END
+    await query.edit_message_text(text="Masukkan awalan username atau nama pengguna yang dicari. Ketik /batal untuk membatalkan.")
+    return SEARCH_USER
+
+async def admin_receive_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    search = update.message.text.strip().lstrip('@')
+    context.user_data['admin_user_search'] = search
+    text, reply_markup = await render_users_page(context)
+    await update.message.reply_text(text=text, reply_markup=reply_markup)
+    return ConversationHandler.END
 
-async def admin_show_user_details(query):
-    user_id = int(query.data.split(":")[1])
-    user = get_user(user_id)
+async def admin_show_user_details(query, user_id):
+    user = await get_user(user_id, fresh=True)
     text = (f"<b>Detail Pengguna:</b> {user['first_name']}\n"
             f"<b>ID:</b> <code>{user['id']}</code>\n"
             f"<b>Username:</b> @{user['username']}\n"
             f"<b>Saldo:</b> Rp{user['balance']:,.0f}")
     keyboard = [
-        [InlineKeyboardButton("💰 Ubah Saldo", callback_data=f"admin_user_balance:{user_id}")],
-        [InlineKeyboardButton("⬅️ Kembali ke Daftar Pengguna", callback_data="admin_manage_users")]
+        [InlineKeyboardButton("💰 Ubah Saldo", callback_data=callback_data("admin_user_balance", user_id))],
+        [InlineKeyboardButton("⬅️ Kembali ke Daftar Pengguna", callback_data=callback_data("admin_manage_users"))]
     ]
     await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
 
-async def admin_ask_balance_amount(query, context):
-    user_id = int(query.data.split(":")[1])
+async def admin_ask_balance_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in ADMIN_IDS:
+        return ConversationHandler.END
+    _, (user_id,) = decode_callback(query.data)
     context.user_data['managed_user_id'] = user_id
     await query.edit_message_text(text="Masukkan jumlah untuk mengubah saldo (gunakan - untuk mengurangi, misal: -5000). Ketik /batal untuk membatalkan.")
     return MANAGE_USER_BALANCE
@@ -393,30 +2830,229 @@ async def admin_receive_balance_reason(update: Update, context: ContextTypes.DEF
     user_id = context.user_data['managed_user_id']
     amount = context.user_data['balance_change_amount']
     
-    admin_update_balance(user_id, amount, reason)
+    await admin_update_balance(user_id, amount, reason)
     
-    user = get_user(user_id)
+    user = await get_user(user_id)
     await update.message.reply_text(f"✅ Saldo untuk {user['first_name']} berhasil diubah. Saldo baru: Rp{user['balance']:,.0f}")
     
     # Notifikasi ke pengguna
     action_text = "ditambahkan" if amount > 0 else "dipotong"
-    await context.bot.send_message(
-        chat_id=user_id,
-        text=f"ℹ️ Saldo Anda telah {action_text} oleh admin sebesar Rp{abs(amount):,.0f}.\nAlasan: {reason}\nSaldo Anda sekarang: Rp{user['balance']:,.0f}"
+    sender.post(
+        user_id,
+        f"ℹ️ Saldo Anda telah {action_text} oleh admin sebesar Rp{abs(amount):,.0f}.\nAlasan: {reason}\nSaldo Anda sekarang: Rp{user['balance']:,.0f}"
     )
     
     context.user_data.clear()
     return ConversationHandler.END
 
+# --- Admin Statistik ---
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    return f"{days}h {hours}j {minutes}m" if days else f"{hours}j {minutes}m {seconds}d"
+
+def render_stats():
+    """Ringkasan metrik proses ini untuk perintah /stats."""
+    lines = [f"📊 <b>STATISTIK BOT</b> (PID {os.getpid()}, aktif {_format_duration(time.time() - metrics.started)})", ""]
+
+    errors = metrics.counters("bot_handler_errors_total")
+    handlers = sorted(metrics.histograms("bot_handler_seconds").items(), key=lambda kv: -kv[1].count)[:12]
+    table = [f"{'rute':<22}{'n':>7}{'p50':>7}{'p95':>7}{'err':>5}"]
+    for route, h in handlers:
+        table.append(f"{route[:21]:<22}{h.count:>7}{h.quantile(0.5) * 1000:>7.0f}{h.quantile(0.95) * 1000:>7.0f}"
+                     f"{errors.get(route, 0):>5}")
+    lines += ["<b>Handler</b> (ms)", f"<pre>{escape(chr(10).join(table), quote=False)}</pre>"]
+
+    rows = metrics.counters("bot_sql_rows_total")
+    statements = sorted(metrics.histograms("bot_sql_seconds").items(), key=lambda kv: -kv[1].sum)[:8]
+    table = [f"{'statement':<34}{'n':>7}{'total':>8}{'baris':>7}"]
+    for label, h in statements:
+        table.append(f"{label[:33]:<34}{h.count:>7}{h.sum * 1000:>8.0f}{rows.get(label, 0) / h.count:>7.1f}")
+    lines += ["<b>SQL</b> (total ms, rata-rata baris)", f"<pre>{escape(chr(10).join(table), quote=False)}</pre>"]
+
+    api_errors = metrics.counters("bot_api_errors_total")
+    calls = sorted(metrics.histograms("bot_api_seconds").items(), key=lambda kv: -kv[1].count)
+    table = [f"{'method':<22}{'n':>7}{'p95':>7}{'err':>5}"]
+    for method, h in calls:
+        table.append(f"{method[:21]:<22}{h.count:>7}{h.quantile(0.95) * 1000:>7.0f}{api_errors.get(method, 0):>5}")
+    lines += ["<b>Bot API</b> (ms)", f"<pre>{escape(chr(10).join(table), quote=False)}</pre>"]
+
+    lines.append(f"<b>Cache tampilan:</b> {view_cache.hit_rate:.1%} edit dilewati "
+                 f"({view_cache.hits} lokal, {view_cache.not_modified} not modified, {view_cache.misses} terkirim)")
+    lines.append(f"<b>Cache pengguna:</b> {user_cache.hit_rate:.1%} hit ({user_cache.misses} baca DB), "
+                 f"{user_cache.profile_writes} profil ditulis, {user_cache.pending} tertunda")
+    lines.append(f"<b>Pengirim:</b> {sender.sent} terkirim, {sender.failed} gagal, "
+                 f"{sender.retried} diulang, {sender.pending} antre")
+    return "\n".join(lines)
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Perintah /stats: menampilkan metrik proses ini (khusus admin)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text(render_stats(), parse_mode='HTML')
+
+
+# --- Admin Laporan Penjualan ---
+# Semua laporan hanya membaca sales_rollups (beberapa lookup primary key per layar), bukan tabel transactions.
+
+def _report_table(header, rows):
+    """rows: (label, row rollup atau None). Bucket tanpa penjualan ditampilkan sebagai nol."""
+    table = [f"{header:<12}{'trx':>6}{'omzet':>13}{'pembeli':>8}"]
+    for label, row in rows:
+        sales, revenue, buyers = (row['sales'], row['revenue'], row['buyers']) if row else (0, 0, 0)
+        table.append(f"{label[:11]:<12}{sales:>6}{revenue:>13,.0f}{buyers:>8}")
+    return f"<pre>{escape(chr(10).join(table), quote=False)}</pre>"
+
+def render_sales_summary(conn):
+    now = report_time()
+    today = now.date()
+    days = [today - timedelta(days=i) for i in range(7)]
+    last_month = today.replace(day=1) - timedelta(days=1)
+    daily = _fetch_rollups(conn, "total", "day", [d.strftime(ROLLUP_PERIODS["day"]) for d in days])
+    monthly = _fetch_rollups(conn, "total", "month", [rollup_bucket("month", d) for d in (today, last_month)])
+
+    def day_row(day):
+        return daily.get(day.strftime(ROLLUP_PERIODS["day"]))
+
+    lines = [
+        f"📈 <b>LAPORAN PENJUALAN</b> (UTC{REPORT_UTC_OFFSET_HOURS:+d}, {now:%d-%m-%y %H:%M})", "",
+        _report_table("periode", [
+            ("Hari ini", day_row(days[0])), ("Kemarin", day_row(days[1])),
+            ("Bulan ini", monthly.get(rollup_bucket("month", today))),
+            ("Bulan lalu", monthly.get(rollup_bucket("month", last_month))),
+        ]),
+        "<b>7 hari terakhir</b>",
+        _report_table("tanggal", [(d.strftime("%d-%m"), day_row(d)) for d in days]),
+    ]
+    return "\n".join(lines)
+
+def render_hourly_report(conn):
+    now = report_time().replace(minute=0, second=0, microsecond=0)
+    hours = [now - timedelta(hours=i) for i in range(23, -1, -1)]
+    rows = {row['bucket']: row for row in _fetch_rollup_series(conn, "hour", rollup_bucket("hour", hours[0]))}
+    series = [(h, rows.get(rollup_bucket("hour", h))) for h in hours]
+    peak = max((row['revenue'] for _, row in series if row), default=0)
+    table = [f"{'jam':<6}{'trx':>5}{'omzet':>12}"]
+    for hour, row in series:
+        sales, revenue = (row['sales'], row['revenue']) if row else (0, 0)
+        bar = "█" * round(8 * revenue / peak) if peak else ""
+        table.append(f"{hour:%H}:00{sales:>5}{revenue:>12,.0f} {bar}")
+    return (f"🕒 <b>PENJUALAN PER JAM</b> (24 jam terakhir, UTC{REPORT_UTC_OFFSET_HOURS:+d})\n\n"
+            f"<pre>{escape(chr(10).join(table), quote=False)}</pre>")
+
+def _fetch_top_report(conn, period, bucket):
+    return (_fetch_top_rollups(conn, "product", period, bucket, REPORT_TOP_LIMIT),
+            _fetch_top_rollups(conn, "category", period, bucket, REPORT_TOP_LIMIT))
+
+async def render_top_report(period):
+    bucket = rollup_bucket(period, report_time())
+    # Hanya rollup (id produk) yang dibaca di thread database; nama diambil dari katalog di event loop.
+    products, categories = await db.run(_fetch_top_report, period, bucket)
+    def product_label(key):
+        product = catalog.products_by_id.get(int(key))
+        return product['name'] if product else f"Produk #{key}"
+    title = "HARI INI" if period == "day" else "BULAN INI"
+    lines = [f"🏆 <b>TERLARIS {title}</b> ({bucket})", ""]
+    if not products:
+        lines.append("Belum ada penjualan.")
+        return "\n".join(lines)
+    lines += ["<b>Produk</b>", _report_table("produk", [(product_label(r['key']), r) for r in products]),
+              "<b>Kategori</b>", _report_table("kategori", [(r['key'], r) for r in categories])]
+    return "\n".join(lines)
+
+async def admin_show_report(query, report):
+    """report: coroutine yang menghasilkan teks laporan (HTML)."""
+    text = await report
+    keyboard = [
+        [InlineKeyboardButton("📈 Ringkasan", callback_data=callback_data("admin_reports")),
+         InlineKeyboardButton("🕒 Per Jam", callback_data=callback_data("admin_report_hourly"))],
+        [InlineKeyboardButton("🏆 Terlaris Hari Ini", callback_data=callback_data("admin_report_top", 0)),
+         InlineKeyboardButton("🏆 Terlaris Bulan Ini", callback_data=callback_data("admin_report_top", 1))],
+        [InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("admin_main"))],
+    ]
+    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+
+
+# --- Admin Broadcast ---
+async def admin_ask_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in ADMIN_IDS:
+        return ConversationHandler.END
+    if context.bot_data.get('broadcast_running'):
+        await query.edit_message_text(text="Broadcast sebelumnya masih berjalan. Tunggu hingga selesai.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("admin_main"))]]))
+        return ConversationHandler.END
+    await query.edit_message_text(text="Kirim pesan yang akan disiarkan ke semua pengguna. Ketik /batal untuk membatalkan.")
+    return BROADCAST_MESSAGE
+
+async def admin_receive_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    status_message = await update.message.reply_text("📢 Broadcast dimulai...")
+    context.bot_data['broadcast_running'] = True
+    context.application.create_task(
+        run_broadcast(context.bot, status_message, update.message.text_html, context.bot_data)
+    )
+    return ConversationHandler.END
+
+async def run_broadcast(bot, status_message, text, bot_data, report_interval=3.0):
+    """Mengirim pesan ke semua pengguna lewat jalur prioritas rendah dan melaporkan progresnya.
+
+    Penerima dibaca per batch dengan keyset pagination, dan batch berikutnya baru
+    dibaca setelah batch sebelumnya selesai dikirim, sehingga memori tetap datar.
+    """
+    sent = failed = blocked = 0
+    last_id = 0
+    started = last_report = time.monotonic()
+    total = (await db.fetchone("SELECT COUNT(*) AS n FROM users"))['n']
+
+    async def report(title):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        done = sent + failed + blocked
+        text = (f"{title}\n\nProgres: {done}/{total}\nTerkirim: {sent}\n"
+                f"Gagal: {failed}\nMemblokir bot: {blocked}\nKecepatan: {done / elapsed:.1f} pesan/detik")
+        try:
+            await bot.edit_message_text(chat_id=status_message.chat_id, message_id=status_message.message_id, text=text)
+        except TelegramError as e:
+            logger.warning(f"Gagal memperbarui status broadcast: {e}")
+
+    try:
+        while True:
+            rows = await db.fetchall("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_id, BROADCAST_BATCH_SIZE))
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            futures = [sender.enqueue(row['id'], text, PRIORITY_BULK, parse_mode='HTML') for row in rows]
+            for future in asyncio.as_completed(futures):
+                try:
+                    await future
+                    sent += 1
+                except Forbidden:
+                    blocked += 1
+                except TelegramError:
+                    failed += 1
+                if time.monotonic() - last_report >= report_interval:
+                    last_report = time.monotonic()
+                    await report("📢 Broadcast berjalan...")
+        await report("✅ Broadcast selesai.")
+        logger.info(f"Broadcast selesai: {sent} terkirim, {failed} gagal, {blocked} memblokir bot.")
+    finally:
+        bot_data['broadcast_running'] = False
+
 # --- Admin Product Management ---
 async def send_product_management_menu(query):
     keyboard = [
-        [InlineKeyboardButton("➕ Tambah Produk", callback_data="admin_add_product")],
-        [InlineKeyboardButton("⬅️ Kembali", callback_data="admin_main")]
+        [InlineKeyboardButton("➕ Tambah Produk", callback_data=callback_data("admin_add_product"))],
+        [InlineKeyboardButton("📥 Impor Stok dari File", callback_data=callback_data("admin_import_stock"))],
+        [InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("admin_main"))]
     ]
     await query.edit_message_text(text="📦 *Manajemen Produk*", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-async def admin_ask_product_category(query, context):
+async def admin_ask_product_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in ADMIN_IDS:
+        return ConversationHandler.END
     await query.edit_message_text(text="Masukkan nama Kategori untuk produk baru (misal: Streaming, Voucher Game). Ketik /batal untuk membatalkan.")
     return ADD_PRODUCT_CATEGORY
 
@@ -454,11 +3090,9 @@ async def admin_receive_product_stock(update: Update, context: ContextTypes.DEFA
     product['stock'] = update.message.text
     
     try:
-        cursor.execute(
-            "INSERT INTO products (category, product_code, name, price, description, stock_data) VALUES (?, ?, ?, ?, ?, ?)",
-            (product['category'], product['code'], product['name'], product['price'], product['desc'], product['stock'])
-        )
-        await update.message.reply_text(f"✅ Produk '{product['name']}' berhasil ditambahkan!")
+        jumlah_stok = await db.transaction(_insert_product, product)
+        await catalog.refresh_category(product['category'])
+        await update.message.reply_text(f"✅ Produk '{product['name']}' berhasil ditambahkan dengan {jumlah_stok} item stok!")
     except sqlite3.IntegrityError:
         await update.message.reply_text(f"❌ Gagal! Kode produk '{product['code']}' sudah ada. Proses dibatalkan.")
     except Exception as e:
@@ -468,17 +3102,843 @@ async def admin_receive_product_stock(update: Update, context: ContextTypes.DEFA
     return ConversationHandler.END
 
 
+# --- Admin Impor Stok dari File ---
+
+class ImportProgress:
+    """Penghitung progres impor; ditulis oleh thread database dan dibaca oleh handler."""
+
+    def __init__(self):
+        self.lines = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.skipped = 0
+
+    def summary(self):
+        return (f"Baris dibaca: {self.lines}\nItem baru: {self.inserted}\n"
+                f"Duplikat dilewati: {self.duplicates}\nBaris kosong: {self.skipped}")
+
+def _import_stock_file(conn, product_id, path, is_csv, progress):
+    """Membaca file baris per baris dan memasukkan item stok per batch transaksi.
+
+    Setiap batch di-commit terpisah sehingga write lock dilepas secara berkala dan
+    pembelian tetap bisa berjalan selama impor besar berlangsung.
+    """
+    def flush(batch):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            inserted = _insert_stock_items(conn, product_id, batch)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        progress.inserted += inserted
+        progress.duplicates += len(batch) - inserted
+
+    with open(path, encoding='utf-8-sig', errors='replace', newline='') as f:
+        rows = csv.reader(f) if is_csv else f
+        batch = []
+        for row in rows:
+            progress.lines += 1
+            item = (row[0] if row else '') if is_csv else row
+            item = item.strip()
+            if not item:
+                progress.skipped += 1
+                continue
+            batch.append(item)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+async def admin_ask_import_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in ADMIN_IDS:
+        return ConversationHandler.END
+    await query.edit_message_text(text="Masukkan Kode Produk yang akan ditambah stoknya. Ketik /batal untuk membatalkan.")
+    return IMPORT_STOCK_PRODUCT
+
+async def admin_receive_import_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    product_code = update.message.text.strip().upper()
+    if product_code not in catalog.products_by_code:
+        await update.message.reply_text(f"Produk dengan kode '{product_code}' tidak ditemukan. Coba lagi atau ketik /batal.")
+        return IMPORT_STOCK_PRODUCT
+    context.user_data['import_product_code'] = product_code
+    await update.message.reply_text("✅ Produk ditemukan. Sekarang kirim file .txt atau .csv berisi stok (satu item per baris; untuk CSV diambil kolom pertama).")
+    return IMPORT_STOCK_FILE
+
+async def admin_receive_import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text("❌ File terlalu besar (maksimal 20 MB). Pecah file lalu kirim ulang, atau ketik /batal.")
+        return IMPORT_STOCK_FILE
+
+    product = catalog.products_by_code[context.user_data['import_product_code']]
+    is_csv = (document.file_name or '').lower().endswith('.csv')
+    status_message = await update.message.reply_text("⏳ Mengunduh file...")
+    fd, path = tempfile.mkstemp(suffix='.csv' if is_csv else '.txt')
+    os.close(fd)
+    progress = ImportProgress()
+    started = time.monotonic()
+    try:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+        task = asyncio.ensure_future(db.run(_import_stock_file, product['id'], path, is_csv, progress))
+        while not task.done():
+            await asyncio.wait({task}, timeout=3)
+            if not task.done():
+                await status_message.edit_text(f"⏳ Mengimpor stok {product['name']}...\n\n{progress.summary()}")
+        await task
+        catalog.adjust_stock(product['product_code'], progress.inserted)
+        await status_message.edit_text(
+            f"✅ Impor stok {product['name']} selesai dalam {time.monotonic() - started:.1f} detik.\n\n{progress.summary()}"
+        )
+    except Exception as e:
+        # Batch yang sudah di-commit tetap tersimpan; sinkronkan penghitung stok di cache.
+        catalog.adjust_stock(product['product_code'], progress.inserted)
+        logger.error(f"Impor stok gagal: {e}")
+        await status_message.edit_text(f"❌ Impor terhenti: {e}\n\n{progress.summary()}")
+    finally:
+        os.remove(path)
+
+    context.user_data.clear()
+    return ConversationHandler.END
+
+
+# --- Admin Ekspor Data ---
+
+# Ekspor berjalan di thread sendiri dengan koneksi read-only, jadi tidak memakai pool database
+# yang melayani pembelian. Satu thread: ekspor berikutnya menunggu giliran.
+export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+
+EXPORT_KINDS = {"pengguna": "users", "users": "users", "transaksi": "transactions", "transactions": "transactions"}
+EXPORT_COLUMNS = {
+    "users": ("id", "username", "first_name", "last_name", "balance", "transaction_count"),
+    "transactions": ("id", "transaction_id", "user_id", "product_id", "product_name", "price", "details", "status",
+                     "timestamp"),
+}
+EXPORT_USAGE = ("Cara pakai:\n/export transaksi|pengguna [csv|jsonl] [dari=YYYY-MM-DD] [sampai=YYYY-MM-DD] [user=ID]\n\n"
+                f"Tanggal mengikuti zona waktu laporan (UTC{REPORT_UTC_OFFSET_HOURS:+d}) dan inklusif. "
+                "Transaksi yang sudah diarsipkan ikut diekspor.")
+
+class ExportProgress:
+    """Penghitung progres ekspor; ditulis oleh thread ekspor dan dibaca oleh handler."""
+
+    def __init__(self):
+        self.rows = 0
+        self.parts = 0
+        self.bytes = 0
+
+    def summary(self):
+        return f"Baris: {self.rows}\nFile: {self.parts} ({self.bytes / 1024 / 1024:.1f} MB terkompresi)"
+
+def parse_export_args(args):
+    """Mengurai argumen /export menjadi (kind, fmt, filters). ValueError jika tidak valid."""
+    if not args or args[0].lower() not in EXPORT_KINDS:
+        raise ValueError("Jenis data harus 'transaksi' atau 'pengguna'.")
+    kind, fmt, filters = EXPORT_KINDS[args[0].lower()], "csv", {}
+    offset = timedelta(hours=REPORT_UTC_OFFSET_HOURS)
+    for arg in args[1:]:
+        name, _, value = arg.partition("=")
+        name = name.lower()
+        if not value and name in ("csv", "jsonl"):
+            fmt = name
+        elif name in ("dari", "sampai") and kind == "transactions":
+            try:
+                day = datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise ValueError(f"Tanggal '{value}' harus berformat YYYY-MM-DD.") from None
+            # Batas hari lokal diubah ke UTC, sama seperti kolom timestamp.
+            bound = day - offset + (timedelta(days=1) if name == "sampai" else timedelta())
+            filters["since" if name == "dari" else "until"] = bound.strftime('%Y-%m-%d %H:%M:%S')
+        elif name == "user" and value.lstrip("-").isdigit():
+            filters["user_id"] = int(value)
+        else:
+            raise ValueError(f"Argumen '{arg}' tidak dikenali.")
+    return kind, fmt, filters
+
+def _export_chunks(conn, kind, filters, chunk_size=EXPORT_CHUNK_SIZE):
+    """Generator potongan baris (list tuple) dengan keyset pagination.
+
+    Setiap potongan adalah query autocommit terpisah, sehingga ekspor panjang tidak menahan
+    satu snapshot baca (yang akan menghalangi checkpoint WAL) dan memori tetap sebesar satu potongan.
+    """
+    columns = ", ".join(EXPORT_COLUMNS[kind])
+    user_id = filters.get("user_id")
+    if kind == "users":
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT {columns} FROM users WHERE id > ? {'AND id = ?' if user_id else ''} ORDER BY id LIMIT ?",
+                (last_id, *((user_id,) if user_id else ()), chunk_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    last_time, last_id = filters.get("since", ""), 0
+    until = filters.get("until", "9999-12-31")
+    while True:
+        # timestamp >= ? menentukan awal range index; (timestamp > ? OR id > ?) melewati baris
+        # dengan timestamp yang sama yang sudah diekspor.
+        rows = conn.execute(
+            f"SELECT {columns} FROM transactions WHERE timestamp >= ? AND timestamp < ? "
+            f"AND (timestamp > ? OR id > ?) {'AND user_id = ?' if user_id else ''} ORDER BY timestamp, id LIMIT ?",
+            (last_time, until, last_time, last_id, *((user_id,) if user_id else ()), chunk_size)
+        ).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_time, last_id = rows[-1][-1], rows[-1][0]  # timestamp kolom terakhir, id kolom pertama
+
+def _open_read_only(path):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+    return conn
+
+def _export_sources(kind, filters):
+    """Database yang dibaca untuk ekspor, terlama dulu: arsip bulanan yang masuk range, lalu bot.db."""
+    if kind != "transactions":
+        return [DB_PATH]
+    since, until = filters.get("since", "")[:7], filters.get("until", "9999-12-31")
+    months = [m for m in reversed(archive_months()) if m >= since and m + "-01" < until]
+    return [archive_path(m) for m in months] + [DB_PATH]
+
+def _write_export(kind, fmt, filters, directory, progress):
+    """Menulis hasil ekspor ke file .gz di directory, dipecah per EXPORT_PART_SIZE. Mengembalikan daftar path."""
+    columns = EXPORT_COLUMNS[kind]
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    paths, raw, out, writer = [], None, None, None
+
+    def open_part():
+        nonlocal raw, out, writer
+        path = os.path.join(directory, f"{kind}-{stamp}-{len(paths) + 1}.{fmt}.gz")
+        paths.append(path)
+        raw = open(path, "wb")
+        out = gzip.open(raw, "wt", encoding="utf-8", newline="", compresslevel=6)
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(columns)
+        progress.parts = len(paths)
+
+    def close_part():
+        out.close()
+        raw.close()
+
+    open_part()
+    try:
+        for source in _export_sources(kind, filters):
+            conn = _open_read_only(source)
+            try:
+                for rows in _export_chunks(conn, kind, filters):
+                    if fmt == "csv":
+                        writer.writerows(rows)
+                    else:
+                        out.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+                    progress.rows += len(rows)
+                    # raw.tell() hanya menghitung data yang sudah dikompresi; sisakan ruang untuk buffer zlib.
+                    progress.bytes = sum(os.path.getsize(p) for p in paths[:-1]) + raw.tell()
+                    if raw.tell() > EXPORT_PART_SIZE - 4 * 1024 * 1024:
+                        close_part()
+                        open_part()
+            finally:
+                conn.close()
+    finally:
+        close_part()
+    progress.bytes = sum(os.path.getsize(p) for p in paths)
+    return paths
+
+async def admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Perintah /export: mengirim data pengguna/transaksi sebagai file CSV/JSONL terkompresi (khusus admin)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        kind, fmt, filters = parse_export_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{EXPORT_USAGE}")
+        return
+
+    status_message = await update.message.reply_text("⏳ Menyiapkan ekspor...")
+    directory = tempfile.mkdtemp(prefix="export-")
+    progress = ExportProgress()
+    started = time.monotonic()
+    try:
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(export_executor, _write_export, kind, fmt, filters, directory, progress)
+        while not task.done():
+            await asyncio.wait({task}, timeout=3)
+            if not task.done():
+                await status_message.edit_text(f"⏳ Mengekspor {kind}...\n\n{progress.summary()}")
+        paths = await task
+        for number, path in enumerate(paths, start=1):
+            caption = f"{kind} {fmt.upper()}, bagian {number}/{len(paths)}" if len(paths) > 1 else f"{kind} {fmt.upper()}"
+            with open(path, "rb") as f:
+                await context.bot.send_document(update.effective_chat.id, document=f, filename=os.path.basename(path),
+                                                caption=caption, write_timeout=600)
+        await status_message.edit_text(
+            f"✅ Ekspor selesai dalam {time.monotonic() - started:.1f} detik.\n\n{progress.summary()}")
+    except Exception as e:
+        logger.error(f"Ekspor gagal: {e}")
+        await status_message.edit_text(f"❌ Ekspor gagal: {e}\n\n{progress.summary()}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# --- Top Up Saldo Otomatis ---
+
+def payment_signature(message):
+    """HMAC-SHA256 (hex) dengan private key gateway, untuk permintaan invoice maupun body callback."""
+    if isinstance(message, str):
+        message = message.encode()
+    return hmac.new(PAYMENT_PRIVATE_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+class PaymentGatewayError(Exception):
+    pass
+
+class PaymentGateway:
+    """Klien API pembuatan invoice pada payment gateway."""
+
+    def __init__(self, base_url=PAYMENT_API_URL, api_key=PAYMENT_API_KEY, merchant_code=PAYMENT_MERCHANT_CODE):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.merchant_code = merchant_code
+        self._client = None
+
+    @property
+    def enabled(self):
+        return bool(self.base_url and PAYMENT_PRIVATE_KEY)
+
+    def start(self):
+        self._client = httpx.AsyncClient(timeout=15)
+
+    async def stop(self):
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+    async def create_invoice(self, merchant_ref, amount, user, expires_at):
+        """Membuat transaksi di gateway. Mengembalikan data invoice (reference, checkout_url, ...)."""
+        payload = {
+            "method": PAYMENT_METHOD,
+            "merchant_ref": merchant_ref,
+            "amount": int(amount),
+            "customer_name": user['first_name'] or str(user['id']),
+            "order_items": [{"name": f"Top Up Saldo {SHOP_NAME}", "price": int(amount), "quantity": 1}],
+            "expired_time": int(expires_at.timestamp()),
+            "signature": payment_signature(f"{self.merchant_code}{merchant_ref}{int(amount)}"),
+        }
+        try:
+            headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+            response = await self._client.post(f"{self.base_url}/transaction/create", json=payload, headers=headers)
+            body = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise PaymentGatewayError(f"gateway tidak bisa dihubungi: {e}") from e
+        if response.status_code != 200 or not body.get("success"):
+            raise PaymentGatewayError(body.get("message") or f"HTTP {response.status_code}")
+        return body["data"]
+
+
+payment_gateway = PaymentGateway()
+
+def _apply_payments(conn, payments):
+    """Menerapkan satu batch callback pembayaran dalam satu transaksi. Mengembalikan hasil per callback.
+
+    Idempoten: invoice hanya dikreditkan saat berpindah dari UNPAID ke PAID, jadi callback yang dikirim
+    ulang (termasuk dua kali dalam batch yang sama) menjadi DUPLICATE tanpa mengubah saldo. Callback
+    yang tidak bisa dikreditkan (jumlah berbeda, invoice sudah kedaluwarsa/gagal, pengguna tidak ada)
+    hanya menggagalkan entrinya sendiri, bukan seluruh batch.
+    """
+    results = []
+    for payment in payments:
+        merchant_ref, status = payment['merchant_ref'], payment['status']
+        # Transaksi dibuka dengan BEGIN IMMEDIATE, jadi baris yang dibaca di sini tidak berubah
+        # sebelum UPDATE di bawah; entri sebelumnya dalam batch yang sama sudah terlihat.
+        deposit = conn.execute(
+            "SELECT d.user_id, d.amount, d.status, u.id IS NOT NULL AS has_user FROM deposits d "
+            "LEFT JOIN users u ON u.id = d.user_id WHERE d.merchant_ref = ?", (merchant_ref,)
+        ).fetchone()
+        if deposit is None:
+            results.append({'status': 'UNKNOWN'})
+        elif status == "PAID":
+            results.append(_credit_payment(conn, payment, deposit))
+        elif status in ("EXPIRED", "FAILED", "REFUND"):
+            changed = conn.execute("UPDATE deposits SET status = ? WHERE merchant_ref = ? AND status = 'UNPAID'",
+                                   (status, merchant_ref)).rowcount
+            results.append({'status': 'UPDATED' if changed else 'DUPLICATE'})
+        else:
+            results.append({'status': 'IGNORED'})
+    return results
+
+def _credit_payment(conn, payment, deposit):
+    merchant_ref = payment['merchant_ref']
+    if deposit['status'] == 'PAID':
+        return {'status': 'DUPLICATE'}
+    if deposit['status'] != 'UNPAID':
+        # Dibayar setelah invoice ditutup; dana ada di gateway, tetapi saldo tidak dikreditkan otomatis.
+        logger.warning(f"Callback PAID untuk invoice {merchant_ref} berstatus {deposit['status']} "
+                       f"(ref {payment.get('reference')}); periksa dan kreditkan manual bila perlu.")
+        return {'status': 'LATE'}
+    if payment.get('amount') is None or payment['amount'] != deposit['amount']:
+        logger.warning(f"Jumlah pembayaran invoice {merchant_ref} tidak sesuai: dibayar {payment.get('amount')}, "
+                       f"invoice Rp{deposit['amount']:,.0f} (ref {payment.get('reference')}).")
+        conn.execute("UPDATE deposits SET status = 'MISMATCH', reference = ? WHERE merchant_ref = ? AND status = 'UNPAID'",
+                     (payment.get('reference'), merchant_ref))
+        return {'status': 'MISMATCH'}
+    if not deposit['has_user']:
+        logger.error(f"Invoice {merchant_ref} dibayar, tetapi pengguna {deposit['user_id']} tidak ditemukan.")
+        return {'status': 'FAILED'}
+    conn.execute("UPDATE deposits SET status = 'PAID', reference = ?, paid_at = CURRENT_TIMESTAMP "
+                 "WHERE merchant_ref = ? AND status = 'UNPAID'", (payment.get('reference'), merchant_ref))
+    account = dict(conn.execute(
+        "UPDATE users SET balance = balance + ?, version = version + 1 WHERE id = ? "
+        "RETURNING id, balance, transaction_count, version",
+        (deposit['amount'], deposit['user_id'])
+    ).fetchone())
+    conn.execute(
+        "INSERT INTO transactions (transaction_id, user_id, product_name, price, details, status) "
+        "VALUES (?, ?, ?, ?, ?, 'DEPOSIT')",
+        (merchant_ref, deposit['user_id'], "Top Up Saldo", deposit['amount'], payment.get('reference'))
+    )
+    return {'status': 'CREDITED', 'user_id': deposit['user_id'], 'amount': deposit['amount'],
+            'balance': account['balance'], 'account': account}
+
+class TopUpProcessor:
+    """Antrean konfirmasi pembayaran yang dikreditkan per batch oleh satu task asyncio.
+
+    Callback HTTP (dari thread server) menunggu sampai batch-nya di-commit, sehingga gateway
+    baru menerima 200 setelah saldo benar-benar tersimpan dan mengirim ulang jika gagal.
+    """
+
+    def __init__(self, batch_size=TOPUP_BATCH_SIZE, window=TOPUP_BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.window = window
+        self._loop = None
+        self._queue = None
+        self._task = None
+        self.outcomes = {}
+        self.batches = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def submit_threadsafe(self, payment):
+        """Dipanggil dari thread lain. Mengembalikan concurrent.futures.Future berisi hasil callback."""
+        future = Future()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (payment, future))
+        return future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Jendela singkat agar konfirmasi yang datang bersamaan ikut dalam satu commit.
+            await asyncio.sleep(self.window)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                results = await db.transaction(_apply_payments, [payment for payment, _ in batch])
+            except Exception as e:
+                logger.error(f"Gagal memproses {len(batch)} konfirmasi pembayaran: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            for (payment, future), result in zip(batch, results):
+                self.outcomes[result['status']] = self.outcomes.get(result['status'], 0) + 1
+                future.set_result(result['status'])
+                if result['status'] == 'CREDITED':
+                    user_cache.apply(result['account'])
+                    sender.post(
+                        result['user_id'],
+                        f"✅ Top up Rp{result['amount']:,.0f} berhasil (ref {payment['merchant_ref']}).\n"
+                        f"Saldo Anda sekarang: Rp{result['balance']:,.0f}")
+
+
+topups = TopUpProcessor()
+
+for _outcome in ("CREDITED", "DUPLICATE", "UNKNOWN", "MISMATCH", "LATE", "FAILED"):
+    metrics.register_callback(f"bot_topup_{_outcome.lower()}_total", "counter",
+                              f"Callback pembayaran dengan hasil {_outcome}.",
+                              lambda outcome=_outcome: topups.outcomes.get(outcome, 0))
+
+def _make_payment_callback_handler(processor):
+    class PaymentCallbackHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, success, message=""):
+            body = json.dumps({"success": success, "message": message}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if urlparse(self.path).path != PAYMENT_CALLBACK_PATH:
+                return self._reply(404, False, "not found")
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > 65536:
+                return self._reply(413, False, "body terlalu besar")
+            body = self.rfile.read(length)
+            signature = self.headers.get("X-Callback-Signature", "")
+            if not hmac.compare_digest(payment_signature(body), signature):
+                return self._reply(403, False, "signature tidak valid")
+            try:
+                payment = json.loads(body)
+                # total_amount sudah termasuk biaya yang ditanggung pembeli; sisanya harus sama dengan invoice.
+                amount = None
+                if payment.get('total_amount') is not None:
+                    amount = int(payment['total_amount']) - int(payment.get('fee_customer') or 0)
+                payment = {'merchant_ref': str(payment['merchant_ref']), 'status': str(payment['status']).upper(),
+                           'reference': payment.get('reference'), 'amount': amount}
+            except (ValueError, KeyError, TypeError):
+                return self._reply(400, False, "payload tidak valid")
+            try:
+                outcome = processor.submit_threadsafe(payment).result(timeout=30)
+            except Exception as e:
+                # Gateway akan mengirim ulang callback ini.
+                return self._reply(500, False, str(e))
+            if outcome == "UNKNOWN":
+                return self._reply(404, False, "invoice tidak dikenal")
+            if outcome == "MISMATCH":
+                return self._reply(400, False, "jumlah pembayaran tidak sesuai invoice")
+            if outcome == "FAILED":
+                return self._reply(500, False, "saldo tidak bisa dikreditkan")
+            self._reply(200, True)
+
+    return PaymentCallbackHandler
+
+def start_payment_callback_server(processor, port=PAYMENT_CALLBACK_PORT, listen=PAYMENT_CALLBACK_LISTEN):
+    """Menjalankan endpoint callback gateway di thread latar belakang. Mengembalikan servernya, atau None."""
+    if not port or not PAYMENT_PRIVATE_KEY:
+        return None
+    try:
+        server = ThreadingHTTPServer((listen, port), _make_payment_callback_handler(processor))
+    except OSError as e:
+        logger.error(f"Endpoint callback pembayaran tidak bisa dibuka di {listen}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="payment-callback", daemon=True).start()
+    logger.info(f"Callback pembayaran diterima di http://{listen}:{port}{PAYMENT_CALLBACK_PATH}")
+    return server
+
+async def show_deposit_info(query):
+    back = [InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("main_menu"))]
+    if not payment_gateway.enabled:
+        await query.edit_message_text(text="Fitur TopUp Saldo sedang dalam pengembangan. Untuk saat ini, silakan hubungi admin.", reply_markup=InlineKeyboardMarkup([back]))
+        return
+    amounts = [InlineKeyboardButton(f"Rp{amount:,.0f}", callback_data=callback_data("deposit_amount", index))
+               for index, amount in enumerate(DEPOSIT_AMOUNTS)]
+    keyboard = [amounts[i:i + 2] for i in range(0, len(amounts), 2)] + [back]
+    await query.edit_message_text(text="💰 *TopUp Saldo*\n\nPilih jumlah top up:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+def _insert_deposit(conn, user_id, merchant_ref, amount, expires_at):
+    """Mencatat invoice baru, kecuali pengguna sudah punya terlalu banyak invoice yang belum dibayar."""
+    pending = conn.execute(
+        "SELECT COUNT(*) FROM deposits WHERE user_id = ? AND status = 'UNPAID' AND expires_at > ?",
+        (user_id, datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+    ).fetchone()[0]
+    if pending >= DEPOSIT_MAX_PENDING:
+        return False
+    conn.execute("INSERT INTO deposits (merchant_ref, user_id, amount, expires_at) VALUES (?, ?, ?, ?)",
+                 (merchant_ref, user_id, amount, expires_at.strftime('%Y-%m-%d %H:%M:%S')))
+    return True
+
+async def create_deposit(query, index):
+    back = [InlineKeyboardButton("⬅️ Kembali", callback_data=callback_data("deposit"))]
+    user = await get_user(query.message.chat_id)
+    if not payment_gateway.enabled or not user or not 0 <= index < len(DEPOSIT_AMOUNTS):
+        await show_expired_button(query)
+        return
+    amount = DEPOSIT_AMOUNTS[index]
+    merchant_ref = transaction_ids.next("DEP")
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=DEPOSIT_EXPIRY_SECONDS)
+    if not await db.transaction(_insert_deposit, user['id'], merchant_ref, amount, expires_at):
+        await query.edit_message_text(
+            text="Anda masih punya invoice top up yang belum dibayar. Selesaikan pembayaran itu atau tunggu sampai kedaluwarsa.",
+            reply_markup=InlineKeyboardMarkup([back]))
+        return
+    try:
+        invoice = await payment_gateway.create_invoice(merchant_ref, amount, user, expires_at)
+    except PaymentGatewayError as e:
+        logger.error(f"Gagal membuat invoice {merchant_ref}: {e}")
+        await db.execute("UPDATE deposits SET status = 'FAILED' WHERE merchant_ref = ?", (merchant_ref,))
+        await query.edit_message_text(text="❌ Invoice gagal dibuat. Silakan coba lagi nanti.", reply_markup=InlineKeyboardMarkup([back]))
+        return
+    await db.execute("UPDATE deposits SET reference = ?, checkout_url = ? WHERE merchant_ref = ?",
+                     (invoice.get('reference'), invoice.get('checkout_url'), merchant_ref))
+    text = (f"🧾 <b>INVOICE TOP UP</b>\n\nJumlah: <b>Rp{amount:,.0f}</b>\nRef: <code>{merchant_ref}</code>\n"
+            f"Berlaku sampai: {report_time(expires_at):%d-%m-%y %H:%M}\n\n"
+            "Saldo ditambahkan otomatis setelah pembayaran diterima.")
+    keyboard = [[InlineKeyboardButton("💳 Bayar Sekarang", url=invoice['checkout_url'])], back]
+    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+
+
+# --- Mode Webhook Multi-Worker ---
+
+def shard_key(update_data):
+    """Mengambil id pengguna (atau chat) dari update mentah untuk menentukan worker tujuan.
+
+    Semua update dari pengguna yang sama selalu diarahkan ke worker yang sama, sehingga
+    state ConversationHandler dan context.user_data tetap berada di satu proses.
+    """
+    for value in update_data.values():
+        if isinstance(value, dict):
+            sender_user = value.get('from')
+            if sender_user:
+                return sender_user['id']
+            chat = value.get('chat') or (value.get('message') or {}).get('chat')
+            if chat:
+                return chat['id']
+    return 0
+
+def _make_webhook_handler(queues):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path != WEBHOOK_PATH:
+                return self._reply(404)
+            if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                return self._reply(403)
+            try:
+                key = shard_key(json.loads(body))
+            except (ValueError, AttributeError, KeyError, TypeError):
+                return self._reply(400)
+            try:
+                queues[key % len(queues)].put(body, timeout=5)
+            except queue.Full:
+                # Telegram akan mengirim ulang update ini nanti.
+                return self._reply(503)
+            self._reply(200)
+
+    return WebhookHandler
+
+def _webhook_worker(index, update_queue):
+    """Proses worker: menjalankan Application tanpa Updater dan memproses update dari antreannya."""
+    # Worker dihentikan oleh proses utama lewat sentinel None, bukan oleh sinyal.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    async def run():
+        app = build_application(updater=False)
+        await app.initialize()
+        await start_services(app, METRICS_PORT + index if METRICS_PORT else 0, maintenance=(index == 0))
+        refresher = asyncio.create_task(_refresh_catalog_periodically())
+        await app.start()
+        logger.info(f"Worker webhook #{index} siap.")
+        loop = asyncio.get_running_loop()
+        while True:
+            body = await loop.run_in_executor(None, update_queue.get)
+            if body is None:
+                break
+            await app.update_queue.put(Update.de_json(json.loads(body), app.bot))
+        refresher.cancel()
+        await app.stop()
+        await on_stop(app)
+        await app.shutdown()  # Menulis sisa perubahan persistensi, jadi harus sebelum database ditutup
+        await on_shutdown(app)
+
+    asyncio.run(run())
+
+async def _refresh_catalog_periodically():
+    # Setiap worker punya cache katalog sendiri; perubahan dari worker lain diambil secara berkala.
+    while True:
+        await asyncio.sleep(CATALOG_REFRESH_SECONDS)
+        try:
+            await catalog.sync()
+        except sqlite3.Error as e:
+            logger.error(f"Gagal memuat ulang katalog: {e}")
+
+async def _register_webhook():
+    async with Bot(BOT_TOKEN, base_url=BOT_API_BASE_URL, base_file_url=BOT_API_FILE_URL) as bot:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                              max_connections=100, allowed_updates=Update.ALL_TYPES)
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(0)
+
+def run_webhook():
+    """Menerima update lewat webhook dan membagikannya ke beberapa proses worker."""
+    if not WEBHOOK_URL:
+        raise SystemExit("BOT_WEBHOOK_URL harus diisi untuk mode webhook.")
+
+    # Migrasi dijalankan sekali di sini agar worker tidak saling balapan saat start.
+    asyncio.run(setup_database())
+    db.close()
+    asyncio.run(_register_webhook())
+
+    # Batas 30 pesan/detik berlaku untuk seluruh bot, jadi dibagi rata antar worker.
+    os.environ["BOT_GLOBAL_SEND_RATE"] = str(GLOBAL_SEND_RATE / WEBHOOK_WORKERS)
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=10000) for _ in range(WEBHOOK_WORKERS)]
+    workers = [None] * WEBHOOK_WORKERS
+
+    def spawn(index):
+        process = ctx.Process(target=_webhook_worker, args=(index, queues[index]), name=f"bot-worker-{index}")
+        process.start()
+        workers[index] = process
+
+    for index in range(WEBHOOK_WORKERS):
+        spawn(index)
+
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), _make_webhook_handler(queues))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="webhook-http", daemon=True).start()
+    print(f"Bot berjalan dalam mode webhook di {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} dengan {WEBHOOK_WORKERS} worker...")
+
+    signal.signal(signal.SIGTERM, _raise_system_exit)
+    try:
+        while True:
+            time.sleep(1)
+            for index, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.error(f"Worker webhook #{index} berhenti (exit code {process.exitcode}), menjalankan ulang.")
+                    spawn(index)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.shutdown()
+        for q in queues:
+            q.put(None)
+        for process in workers:
+            process.join(timeout=30)
+        print("Bot berhenti.")
+
+
 # --- Fungsi Utama ---
-def main():
-    """Membangun dan menjalankan aplikasi bot Telegram."""
-    setup_database()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+metrics_server = None
+payment_callback_server = None
+
+async def start_services(app, metrics_port=METRICS_PORT, maintenance=True):
+    """post_init: layanan per proses. maintenance=False untuk worker webhook selain #0,
+    agar job arsip hanya berjalan di satu proses."""
+    global metrics_server, payment_callback_server
+    product_search.fts_enabled = await db.run(_ensure_search_index)
+    await catalog.load()
+    sender.start(app.bot)
+    user_cache.start()
+    metrics_server = start_metrics_server(metrics_port)
+    if payment_gateway.enabled:
+        payment_gateway.start()
+    if maintenance:
+        # Hanya satu proses yang membuka port callback; invoice bisa dibuat oleh worker mana pun.
+        topups.start()
+        payment_callback_server = start_payment_callback_server(topups)
+    if maintenance:
+        if app.job_queue is None:
+            logger.warning("JobQueue tidak tersedia (pasang python-telegram-bot[job-queue]); "
+                           "arsip riwayat dan retensi data bantu nonaktif.")
+        else:
+            app.job_queue.run_repeating(retention_job, interval=RETENTION_INTERVAL_SECONDS, first=60, name="retention")
+            if ARCHIVE_AFTER_DAYS > 0:
+                app.job_queue.run_repeating(archive_job, interval=ARCHIVE_INTERVAL_SECONDS, first=60,
+                                            name="archive_history")
+
+async def on_stop(app):
+    """post_stop: mengirim sisa antrean pesan selagi koneksi bot masih terbuka."""
+    await sender.drain()
+
+async def on_shutdown(app):
+    if payment_callback_server:
+        payment_callback_server.shutdown()
+    await topups.stop()
+    await payment_gateway.stop()
+    await sender.stop()
+    await user_cache.stop()
+    if metrics_server:
+        metrics_server.shutdown()
+    print("Bot berhenti. Menutup koneksi database.")
+    export_executor.shutdown(wait=False, cancel_futures=True)
+    db.close()
+
+class PerUserApplication(Application):
+    """Application yang memproses update dari pengguna yang sama satu per satu, sesuai urutan datang.
+
+    concurrent_updates tetap aktif untuk update dari pengguna yang berbeda, tetapi ConversationHandler
+    tidak aman jika dua pesan dari satu pengguna diproses bersamaan: pesan kedua akan dicocokkan
+    dengan state lama yang belum diperbarui handler pertama (dan state yang salah itu ikut tersimpan).
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._user_locks = {}  # user_id -> [Lock, jumlah update yang memakai/menunggu lock]
+
+    async def process_update(self, update):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            return await super().process_update(update)
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Lock asyncio melayani penunggu secara FIFO, jadi urutan update per pengguna tetap terjaga.
+            async with entry[0]:
+                return await super().process_update(update)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+
+
+def build_application(updater=True):
+    """Membangun Application beserta semua handler-nya.
+
+    updater=False dipakai oleh worker webhook, yang menerima update dari proses utama.
+    """
+    # concurrent_updates: update dari pengguna yang berbeda diproses bersamaan, karena akses database
+    # tidak lagi memblokir event loop. Update dari pengguna yang sama tetap berurutan (PerUserApplication)
+    # agar state ConversationHandler benar. Pembelian ganda tetap dicegah oleh UPDATE bersyarat dan
+    # ledger di dalam transaksi (_execute_purchase), bukan oleh urutan ini.
+    bot = ViewCachingBot(
+        BOT_TOKEN,
+        base_url=BOT_API_BASE_URL,
+        base_file_url=BOT_API_FILE_URL,
+        request=InstrumentedRequest(connection_pool_size=256),
+        get_updates_request=HTTPXRequest(connection_pool_size=1),
+    )
+    builder = (
+        ApplicationBuilder()
+        .application_class(PerUserApplication)
+        .bot(bot)
+        .concurrent_updates(True)
+        .persistence(SQLitePersistence())
+        .post_init(start_services)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
 
     # Conversation handler untuk proses multi-langkah
+    # callback_data bisa dipalsukan klien, jadi setiap entry point admin memeriksa ADMIN_IDS sendiri;
+    # pemeriksaan di handle_callback_query tidak berlaku untuk percakapan ini.
     conv_handler = ConversationHandler(
         entry_points=[
-            CallbackQueryHandler(admin_ask_product_category, pattern="^admin_add_product$"),
-            CallbackQueryHandler(admin_ask_balance_amount, pattern="^admin_user_balance:"),
+            CallbackQueryHandler(admin_ask_product_category, pattern=callback_pattern("admin_add_product")),
+            CallbackQueryHandler(admin_ask_balance_amount, pattern=callback_pattern("admin_user_balance")),
+            CallbackQueryHandler(admin_ask_user_search, pattern=callback_pattern("admin_user_search")),
+            CallbackQueryHandler(admin_ask_broadcast_message, pattern=callback_pattern("admin_broadcast")),
+            CallbackQueryHandler(admin_ask_import_product, pattern=callback_pattern("admin_import_stock")),
         ],
         states={
             ADD_PRODUCT_CATEGORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_product_category)],
@@ -489,20 +3949,57 @@ def main():
             ADD_PRODUCT_STOCK: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_product_stock)],
             MANAGE_USER_BALANCE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_balance_amount)],
             SELECTING_ACTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_balance_reason)],
+            SEARCH_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_user_search)],
+            BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_broadcast_message)],
+            IMPORT_STOCK_PRODUCT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_import_product)],
+            IMPORT_STOCK_FILE: [MessageHandler(filters.Document.ALL, admin_receive_import_file)],
         },
         fallbacks=[CommandHandler("batal", cancel)],
+        name="admin_flow",
+        persistent=True,
     )
 
+    # conv_handler didaftarkan lebih dulu agar /batal di tengah percakapan ditangani fallback-nya
+    # dan mengakhiri state (yang kini tersimpan permanen), bukan oleh handler /batal biasa.
+    app.add_handler(conv_handler)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("batal", cancel)) # Command /batal
-    app.add_handler(conv_handler)
+    app.add_handler(CommandHandler("stats", admin_stats))
+    app.add_handler(CommandHandler("export", admin_export))
+    app.add_handler(InlineQueryHandler(inline_search))
     app.add_handler(CallbackQueryHandler(handle_callback_query)) # Harus setelah conv_handler
+    instrument_handlers(itertools.chain.from_iterable(app.handlers.values()))
+    # Grup -1 berjalan sebelum handler lain untuk setiap update dan tidak dihitung di metrik per rute.
+    app.add_handler(TypeHandler(Update, track_user), group=-1)
+    return app
+
+def check_database():
+    """Menjalankan migrasi dan konversi auto_vacuum, lalu memeriksa bahwa query utama memakai index
+    (python bot.py --check-db). Jalankan saat bot berhenti."""
+    asyncio.run(setup_database(maintenance=True))
+    problems, notes = asyncio.run(db.run(check_query_plans))
+    db.close()
+    for problem in problems:
+        print(f"GAGAL  {problem}")
+    for note in notes:
+        print(f"INFO   {note}")
+    print(f"{len(HOT_QUERIES) - len(problems)}/{len(HOT_QUERIES)} query memakai index yang diharapkan.")
+    return 1 if problems else 0
+
+def main():
+    """Membangun dan menjalankan aplikasi bot Telegram."""
+    if "--check-db" in sys.argv[1:]:
+        sys.exit(check_database())
+    if BOT_MODE == "webhook":
+        run_webhook()
+        return
 
+    # Migrasi harus selesai sebelum Application.initialize() memuat persistensi.
+    asyncio.run(setup_database())
+    asyncio.set_event_loop(asyncio.new_event_loop())  # asyncio.run() melepas loop yang dipakai run_polling()
+    app = build_application()
     print("Bot sedang berjalan...")
     app.run_polling()
 
-    print("Bot berhenti. Menutup koneksi database.")
-    conn.close()
-
 if __name__ == "__main__":
     main()
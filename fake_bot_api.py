@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""Server Bot API Telegram tiruan untuk pengujian lokal.
+
+Jalankan server ini, lalu jalankan bot dengan:
+
+    BOT_API_BASE_URL=http://127.0.0.1:8081/bot BOT_API_FILE_URL=http://127.0.0.1:8081/file/bot python bot.py
+
+Semua panggilan Bot API (sendMessage, editMessageText, getUpdates, ...) akan
+dijawab oleh server ini. Update palsu bisa dikirim ke bot lewat endpoint kontrol
+POST /_fake/updates, dan statistik panggilan bisa dilihat di GET /_fake/stats.
+File untuk diunduh bot (getFile) didaftarkan lewat POST /_fake/files/<file_id>.
+Dengan --enforce-limits server membalas 429 seperti Telegram jika batas 30 pesan/detik
+global atau batas per chat dilanggar.
+"""
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Fake Bot", "username": "fake_bot"}
+
+# Parameter yang dikirim sebagai teks biasa (bukan JSON) oleh python-telegram-bot.
+TEXT_FIELDS = {"text", "caption", "parse_mode", "callback_query_id", "inline_query_id",
+               "inline_message_id", "url", "secret_token", "file_id", "next_offset"}
+
+
+class _Bucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FakeBotAPI:
+    """State server tiruan: antrean update, penomoran pesan, dan statistik."""
+
+    def __init__(self, enforce_limits=False, global_rate=30, per_chat_rate=1, per_chat_burst=3, latency=0.0):
+        self.enforce_limits = enforce_limits
+        self.global_rate = global_rate
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.latency = latency
+        self.blocked_chats = set()
+        self.files = {}
+        self.calls = Counter()
+        self.rate_limited = 0
+        self.listeners = []
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._global_bucket = _Bucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._message_views = {}  # (chat_id, message_id) -> (text, reply_markup) terakhir
+        self.started = time.monotonic()
+
+    # --- Update masuk (dari "pengguna" ke bot) ---
+
+    def push_update(self, update):
+        """Menambahkan update ke antrean getUpdates; update_id diisi otomatis jika kosong."""
+        with self._cond:
+            update.setdefault("update_id", next(self._update_ids))
+            self._updates.append(update)
+            self._cond.notify_all()
+        return update["update_id"]
+
+    def next_message_id(self):
+        return next(self._message_ids)
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._cond:
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+            return list(itertools.islice(self._updates, limit))
+
+    # --- Pesan keluar (dari bot) ---
+
+    def _check_limits(self, chat_id):
+        if not self.enforce_limits:
+            return None
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = _Bucket(self.per_chat_rate, self.per_chat_burst)
+            if self._global_bucket.take() and bucket.take():
+                return None
+            self.rate_limited += 1
+        return 1
+
+    def _message(self, chat_id, message_id=None, **fields):
+        message = {
+            "message_id": message_id or self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        message.update({k: v for k, v in fields.items() if v is not None})
+        return message
+
+    def handle(self, method, params):
+        """Menjawab satu panggilan Bot API. Mengembalikan (status_http, body_json)."""
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = params.get("chat_id")
+
+        if method in ("sendMessage", "sendDocument"):
+            if chat_id in self.blocked_chats:
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            retry_after = self._check_limits(chat_id)
+            if retry_after:
+                return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                             "parameters": {"retry_after": retry_after}}
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result = self._get_updates(params)
+        elif method == "sendMessage":
+            result = self._message(chat_id, text=params.get("text"), reply_markup=params.get("reply_markup"))
+        elif method == "sendDocument":
+            document = params.get("document") or {}
+            result = self._message(chat_id, caption=params.get("caption"), document={
+                "file_id": f"doc{self.next_message_id()}", "file_unique_id": f"udoc{self.next_message_id()}",
+                "file_name": document.get("filename"), "file_size": document.get("size"),
+            })
+        elif method == "getFile":
+            file_id = params.get("file_id")
+            if file_id not in self.files:
+                return 400, {"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}
+            result = {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": len(self.files[file_id]),
+                      "file_path": f"documents/{file_id}"}
+        elif method == "editMessageText":
+            if params.get("inline_message_id"):
+                result = True
+            else:
+                view = (params.get("text"), json.dumps(params.get("reply_markup"), sort_keys=True))
+                key = (chat_id, params.get("message_id"))
+                with self._lock:
+                    unchanged = self._message_views.get(key) == view
+                    self._message_views[key] = view
+                if unchanged:
+                    return 400, {"ok": False, "error_code": 400, "description":
+                                 "Bad Request: message is not modified: specified new message content and reply "
+                                 "markup are exactly the same as a current content and reply markup of the message"}
+                result = self._message(chat_id, params.get("message_id"), text=params.get("text"),
+                                       reply_markup=params.get("reply_markup"))
+        elif method in ("answerCallbackQuery", "answerInlineQuery", "deleteWebhook", "setWebhook",
+                        "setMyCommands", "deleteMessage", "close", "logOut"):
+            result = True
+        else:
+            return 404, {"ok": False, "error_code": 404, "description": f"Not Found: method {method} tidak didukung"}
+
+        for listener in self.listeners:
+            listener(method, params, result)
+        return 200, {"ok": True, "result": result}
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {
+            "calls": dict(self.calls),
+            "rate_limited": self.rate_limited,
+            "pending_updates": len(self._updates),
+            "messages_per_second": (self.calls["sendMessage"] + self.calls["editMessageText"]) / elapsed,
+        }
+
+
+def _parse_params(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            filename = part.get_filename()
+            payload = part.get_payload(decode=True) or b""
+            if filename:
+                params[name] = {"filename": filename, "size": len(payload), "content": payload}
+            else:
+                params[name] = _decode_value(name, payload.decode())
+        # Berkas dirujuk lewat "attach://<nama>".
+        for key, value in list(params.items()):
+            if isinstance(value, str) and value.startswith("attach://"):
+                params[key] = params.pop(value[len("attach://"):], value)
+        return params
+    return {key: _decode_value(key, values[-1]) for key, values in parse_qs(body.decode(), keep_blank_values=True).items()}
+
+
+def _decode_value(key, value):
+    if key in TEXT_FIELDS:
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api = None  # Diisi oleh serve()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/_fake/stats":
+            return self._reply(200, self.api.stats())
+        if path.startswith("/file/"):
+            # Bentuk path: /file/bot<token>/documents/<file_id>
+            content = self.api.files.get(path.rsplit("/", 1)[-1])
+            if content is None:
+                return self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return None
+        return self._dispatch(path, {})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._body()
+        if path == "/_fake/updates":
+            updates = json.loads(body)
+            ids = [self.api.push_update(u) for u in (updates if isinstance(updates, list) else [updates])]
+            return self._reply(200, {"ok": True, "result": ids})
+        if path.startswith("/_fake/files/"):
+            self.api.files[path.rsplit("/", 1)[-1]] = body
+            return self._reply(200, {"ok": True, "result": True})
+        if path == "/_fake/block":
+            self.api.blocked_chats.update(json.loads(body))
+            return self._reply(200, {"ok": True, "result": True})
+        return self._dispatch(path, _parse_params(self.headers.get("Content-Type", ""), body))
+
+    def _dispatch(self, path, params):
+        # Bentuk path: /bot<token>/<method>
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+        status, payload = self.api.handle(parts[1], params)
+        self._reply(status, payload)
+
+
+def serve(api, host="127.0.0.1", port=8081):
+    """Menjalankan server di thread latar belakang dan mengembalikan objek server-nya."""
+    handler = type("Handler", (_Handler,), {"api": api})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True).start()
+    return server
+
+
+# --- Pembuat update palsu ---
+
+_ids = itertools.count(1)
+
+def make_user(user_id, first_name=None, username=None):
+    return {"id": user_id, "is_bot": False, "first_name": first_name or f"User{user_id}",
+            "username": username or f"user{user_id}"}
+
+def make_command_update(user_id, text, **user_fields):
+    user = make_user(user_id, **user_fields)
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+    return {"message": {"message_id": next(_ids), "date": int(time.time()), "from": user,
+                        "chat": {"id": user_id, "type": "private"}, "text": text, "entities": entities}}
+
+def make_document_update(user_id, file_id, file_name, file_size, **user_fields):
+    update = make_command_update(user_id, "", **user_fields)
+    message = update["message"]
+    del message["text"], message["entities"]
+    message["document"] = {"file_id": file_id, "file_unique_id": f"u{file_id}",
+                           "file_name": file_name, "file_size": file_size}
+    return update
+
+def make_callback_update(user_id, data, message_id, **user_fields):
+    user = make_user(user_id, **user_fields)
+    return {"callback_query": {
+        "id": f"cbq{next(_ids)}", "from": user, "chat_instance": str(user_id), "data": data,
+        "message": {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                    "chat": {"id": user_id, "type": "private"}, "text": "..."},
+    }}
+
+def make_inline_query_update(user_id, query, offset="", **user_fields):
+    return {"inline_query": {"id": f"iq{next(_ids)}", "from": make_user(user_id, **user_fields),
+                             "query": query, "offset": offset}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--enforce-limits", action="store_true", help="balas 429 jika batas Telegram dilanggar")
+    parser.add_argument("--latency", type=float, default=0.0, help="jeda buatan per panggilan (detik)")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(enforce_limits=args.enforce_limits, latency=args.latency)
+    server = serve(api, args.host, args.port)
+    print(f"Fake Bot API berjalan di http://{args.host}:{args.port}/bot<token>/")
+    try:
+        while True:
+            time.sleep(5)
+            print(json.dumps(api.stats()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Payment gateway tiruan (API gaya Tripay) untuk menguji top up otomatis secara lokal.
+
+Jalankan server ini, lalu jalankan bot dengan:
+
+    BOT_PAYMENT_API_URL=http://127.0.0.1:8090 BOT_PAYMENT_PRIVATE_KEY=rahasia python bot.py
+
+dan jalankan gateway dengan --callback-url http://127.0.0.1:8444/tripay-callback --private-key rahasia.
+
+Bot membuat invoice lewat POST /transaction/create. Invoice dibayar dengan membuka
+checkout_url-nya di browser (GET menampilkan tombol, POST membayar), atau lewat endpoint
+kontrol POST /_fake/pay/<reference> dan POST /_fake/pay-all (membayar semua invoice yang
+belum dibayar secara paralel, untuk uji beban). Setiap pembayaran mengirim callback
+bertanda tangan HMAC-SHA256 ke bot, dan diulang seperti gateway sungguhan jika bot tidak
+membalas 200. Statistik ada di GET /_fake/stats.
+"""
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+def sign(private_key, message):
+    if isinstance(message, str):
+        message = message.encode()
+    return hmac.new(private_key.encode(), message, hashlib.sha256).hexdigest()
+
+
+class FakePaymentGateway:
+    """State gateway tiruan: invoice, pengiriman callback, dan statistik."""
+
+    def __init__(self, private_key, callback_url, merchant_code="", public_url="http://127.0.0.1:8090",
+                 retries=3, duplicate_rate=0.0):
+        self.private_key = private_key
+        self.callback_url = callback_url
+        self.merchant_code = merchant_code
+        self.public_url = public_url
+        self.retries = retries
+        self.duplicate_rate = duplicate_rate  # Porsi callback yang sengaja dikirim dua kali
+        self.invoices = {}
+        self.callbacks = Counter()
+        self.listeners = []
+        self._references = itertools.count(1)
+        self._duplicates = itertools.count()
+        self._lock = threading.Lock()
+
+    def create(self, params):
+        """Membuat invoice dari parameter /transaction/create. Mengembalikan (status HTTP, body)."""
+        expected = sign(self.private_key, f"{self.merchant_code}{params.get('merchant_ref')}{params.get('amount')}")
+        if not hmac.compare_digest(expected, str(params.get("signature", ""))):
+            return 400, {"success": False, "message": "Invalid signature"}
+        reference = f"T{next(self._references):010d}"
+        invoice = {
+            "reference": reference, "merchant_ref": params["merchant_ref"], "payment_method": params.get("method"),
+            "amount": int(params["amount"]), "status": "UNPAID", "expired_time": params.get("expired_time"),
+            "checkout_url": f"{self.public_url}/checkout/{reference}",
+        }
+        with self._lock:
+            self.invoices[reference] = invoice
+        return 200, {"success": True, "message": "", "data": dict(invoice)}
+
+    def pay(self, reference, status="PAID"):
+        """Mengubah status invoice dan mengirim callback ke bot. Mengembalikan status HTTP terakhir dari bot."""
+        with self._lock:
+            invoice = self.invoices.get(reference)
+            if invoice is None:
+                return 404
+            invoice["status"] = status
+        body = json.dumps({
+            "reference": reference, "merchant_ref": invoice["merchant_ref"],
+            "payment_method": invoice["payment_method"], "total_amount": invoice["amount"],
+            "amount_received": invoice["amount"], "status": status, "paid_at": int(time.time()),
+        }).encode()
+        code = self._send_callback(body)
+        # Gateway sungguhan kadang mengirim callback yang sama lebih dari sekali.
+        if self.duplicate_rate and next(self._duplicates) % round(1 / self.duplicate_rate) == 0:
+            self._send_callback(body)
+        return code
+
+    def pay_all(self, status="PAID", concurrency=32):
+        """Membayar semua invoice UNPAID secara paralel. Mengembalikan Counter status HTTP dari bot."""
+        with self._lock:
+            references = [r for r, invoice in self.invoices.items() if invoice["status"] == "UNPAID"]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return Counter(executor.map(lambda reference: self.pay(reference, status), references))
+
+    def _send_callback(self, body):
+        request = urllib.request.Request(self.callback_url, data=body, method="POST", headers={
+            "Content-Type": "application/json", "X-Callback-Event": "payment_status",
+            "X-Callback-Signature": sign(self.private_key, body),
+        })
+        code = 0
+        for attempt in range(self.retries):
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    code = response.status
+            except urllib.error.HTTPError as e:
+                code = e.code
+            except OSError:
+                code = 0
+            self.callbacks[code] += 1
+            for listener in self.listeners:
+                listener(body, code)
+            if code == 200 or code in (400, 403, 404):
+                break
+            time.sleep(0.5 * (attempt + 1))
+        return code
+
+    def stats(self):
+        with self._lock:
+            statuses = Counter(invoice["status"] for invoice in self.invoices.values())
+        return {"invoices": dict(statuses), "callbacks": {str(k): v for k, v in self.callbacks.items()}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    gateway = None  # Diisi oleh serve()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload, content_type="application/json"):
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/_fake/stats":
+            return self._reply(200, self.gateway.stats())
+        if path.startswith("/checkout/"):
+            invoice = self.gateway.invoices.get(path.rsplit("/", 1)[-1])
+            if invoice is None:
+                return self._reply(404, "Invoice tidak ditemukan", "text/plain; charset=utf-8")
+            page = (f"<h1>Rp{invoice['amount']:,}</h1><p>{invoice['merchant_ref']} - {invoice['status']}</p>"
+                    f"<form method='post'><button>Bayar</button></form>")
+            return self._reply(200, page, "text/html; charset=utf-8")
+        return self._reply(404, {"success": False, "message": "Not Found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._body()
+        if path.endswith("/transaction/create"):
+            try:
+                params = json.loads(body)
+            except ValueError:
+                return self._reply(400, {"success": False, "message": "Invalid JSON"})
+            return self._reply(*self.gateway.create(params))
+        if path.startswith("/checkout/") or path.startswith("/_fake/pay/"):
+            code = self.gateway.pay(path.rsplit("/", 1)[-1])
+            return self._reply(200 if code == 200 else 502, {"success": code == 200, "callback_status": code})
+        if path == "/_fake/pay-all":
+            return self._reply(200, {"success": True, "callback_status": self.gateway.pay_all()})
+        return self._reply(404, {"success": False, "message": "Not Found"})
+
+
+def serve(gateway, host="127.0.0.1", port=8090):
+    """Menjalankan server di thread latar belakang dan mengembalikan objek server-nya."""
+    handler = type("Handler", (_Handler,), {"gateway": gateway})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-payment-gateway", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--callback-url", default="http://127.0.0.1:8444/tripay-callback")
+    parser.add_argument("--private-key", required=True)
+    parser.add_argument("--merchant-code", default="")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="porsi callback yang dikirim dua kali")
+    args = parser.parse_args()
+
+    gateway = FakePaymentGateway(args.private_key, args.callback_url, args.merchant_code,
+                                 public_url=f"http://{args.host}:{args.port}", duplicate_rate=args.duplicate_rate)
+    server = serve(gateway, args.host, args.port)
+    print(f"Fake payment gateway berjalan di http://{args.host}:{args.port}/")
+    try:
+        while True:
+            time.sleep(5)
+            print(json.dumps(gateway.stats()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()